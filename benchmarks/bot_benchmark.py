@@ -0,0 +1,321 @@
+"""
+End-to-end throughput and latency benchmark for slackAskBot.py, using the local fake Slack and fake OpenAI servers.
+
+The driver starts both fakes, launches the bot as a subprocess pointed at them (SLACK_API_URL / OPENAI_BASE_URL),
+then pushes a Poisson stream of mention, DM and thread-reply events over Socket Mode at each requested rate.
+For every request it measures:
+    time to first reply   event sent -> first model answer posted in the thread
+    time to final answer  event sent -> the "please wait" status message is deleted (the last thing the worker does)
+and per step it reports p50/p95/p99 of both, Slack and OpenAI calls per request, and whether the step kept up.
+The highest rate whose requests all completed with p95 final latency within --slo is the max sustainable rate.
+
+Example:
+    python benchmarks/bot_benchmark.py --rates 0.5,1,2,4 --duration 30 \\
+        --openai-latency "gpt-4*=lognormal:3000,0.5" --openai-latency "gpt-3.5*=lognormal:800,0.4" \\
+        --slack-latency "*=lognormal:80,0.3" --tool-call-rate 0.2 --json bench_output.json
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_openai import ANSWER_MARKER, FakeOpenAI
+from fake_slack import BOT_USER_ID, FakeSlack
+
+# The bot's default "please_wait_message"; every request posts exactly one and deletes it when done
+STATUS_TEXT = "Just a moment..."
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_SCRIPT = os.path.join(REPO_DIR, "slackAskBot.py")
+
+# A helper program for the bot's tool calls; it just waits and answers, like a slow search script would
+FAKE_HELPER = """#!{python}
+import sys, time
+time.sleep({delay})
+print("{marker} from the helper for " + sys.argv[1])
+"""
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    # Nearest-rank percentile
+    index = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def start_bot(slack, openai_fake, workdir, helper_delay=None, extra_env=None, log_path=None, extra_args=None):
+    """Launch slackAskBot.py against the fakes; returns the Popen. Writes functions.json if helper_delay is set."""
+    if helper_delay is not None:
+        helper_path = os.path.join(workdir, "fake_helper.py")
+        with open(helper_path, "w") as f:
+            f.write(FAKE_HELPER.format(python=sys.executable, delay=helper_delay, marker=ANSWER_MARKER))
+        os.chmod(helper_path, 0o755)
+        with open(os.path.join(workdir, "functions.json"), "w") as f:
+            json.dump([{
+                "name": "search_workspace",
+                "description": "Search the Slack workspace for messages relevant to a question.",
+                "parameters": {"question": "string"},
+                "helper_program": helper_path,
+            }], f)
+
+    env = os.environ.copy()
+    env.update({
+        "SLACK_BOT_TOKEN": "xoxb-fake",
+        "SLACK_APP_TOKEN": "xapp-fake",
+        "SLACK_API_URL": slack.api_url,
+        "OPENAI_BASE_URL": openai_fake.base_url,
+        "OPENAI_API_KEY": "sk-fake",
+        "PYTHONUNBUFFERED": "1",
+    })
+    env.update(extra_env or {})
+    log = open(log_path or os.path.join(workdir, "bot.log"), "w")
+    return subprocess.Popen([sys.executable, BOT_SCRIPT] + (extra_args or []), cwd=workdir, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+
+def event_body(event, n):
+    return {
+        "token": "fake-verification-token",
+        "team_id": "TFAKE",
+        "api_app_id": "AFAKEAPP",
+        "event": event,
+        "type": "event_callback",
+        "event_id": f"EvFAKE{n:08d}",
+        "event_time": int(time.time()),
+        "authorizations": [{"team_id": "TFAKE", "user_id": BOT_USER_ID, "is_bot": True}],
+    }
+
+
+def make_request(slack, kind, n):
+    """Create the Slack-side state for one request and return (root key, list of event bodies to push)."""
+    user = f"UBENCH{n % 50:04d}"
+    question = f"Benchmark question number {n}: how do I configure the deploy pipeline?"
+    if kind == "dm":
+        channel = f"DBENCH{n % 20:04d}"
+        message = slack.add_message(channel, question, user)
+        events = [dict(message, channel=channel, channel_type="im", event_ts=message["ts"])]
+        return (channel, message["ts"]), events
+    if kind == "mention":
+        channel = f"CBENCH{n % 10:04d}"
+        message = slack.add_message(channel, f"<@{BOT_USER_ID}> {question}", user)
+        # Slack sends both a message.channels event and an app_mention event for a mention
+        events = [
+            dict(message, channel=channel, channel_type="channel", event_ts=message["ts"]),
+            dict(message, type="app_mention", channel=channel, event_ts=message["ts"]),
+        ]
+        return (channel, message["ts"]), events
+    if kind == "thread":
+        channel = f"CBENCH{n % 10:04d}"
+        parent = slack.add_message(channel, f"<@{BOT_USER_ID}> an earlier question", user)
+        reply = slack.add_message(channel, f"Follow-up: {question}", user, thread_ts=parent["ts"])
+        events = [dict(reply, channel=channel, channel_type="channel", event_ts=reply["ts"])]
+        return (channel, parent["ts"]), events
+    raise ValueError(f"Unknown request kind: {kind}")
+
+
+def send_request(slack, kind, n, sent):
+    root, events = make_request(slack, kind, n)
+    sent.append({"root": root, "kind": kind, "sent": time.monotonic()})
+    for i, event in enumerate(events):
+        slack.push_event(event_body(event, n * 10 + i))
+    return root
+
+
+def request_timings(slack, sent, status_text=STATUS_TEXT):
+    """
+    Work out first-reply and final-answer times for each sent request from the fake Slack's call log.
+    Requests in the same thread are matched, in order, to the status messages posted in that thread.
+    """
+    with slack.lock:
+        calls = list(slack.calls)
+    statuses = {}
+    answers = {}
+    deletes = {}
+    for call in calls:
+        if call["root"] is None:
+            continue
+        root = (call["channel"], call["root"])
+        if call["method"] == "chat.postMessage" and call["text"] == status_text:
+            statuses.setdefault(root, []).append(call)
+        elif call["method"] == "chat.postMessage" and call["text"] and ANSWER_MARKER in call["text"]:
+            answers.setdefault(root, []).append(call["time"])
+        elif call["method"] == "chat.delete":
+            deletes[(call["channel"], call["ts"])] = call["time"]
+
+    timings = []
+    seen = {}
+    for request in sent:
+        root = request["root"]
+        index = seen.get(root, 0)
+        seen[root] = index + 1
+        timing = {"kind": request["kind"], "first_reply": None, "final": None}
+        root_statuses = statuses.get(root, [])
+        if index < len(root_statuses):
+            status = root_statuses[index]
+            next_status_time = root_statuses[index + 1]["time"] if index + 1 < len(root_statuses) else float("inf")
+            replies = [t for t in answers.get(root, []) if status["time"] <= t < next_status_time]
+            if replies:
+                timing["first_reply"] = replies[0] - request["sent"]
+            deleted = deletes.get((root[0], status["ts"]))
+            if deleted is not None:
+                timing["final"] = deleted - request["sent"]
+        timings.append(timing)
+    return timings
+
+
+def wait_for_completion(slack, sent, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        timings = request_timings(slack, sent)
+        if all(t["final"] is not None for t in timings):
+            return timings
+        time.sleep(0.2)
+    return request_timings(slack, sent)
+
+
+def summarize(slack, openai_fake, timings, elapsed, slo=None):
+    completed = [t for t in timings if t["final"] is not None]
+    first = [t["first_reply"] for t in completed if t["first_reply"] is not None]
+    final = [t["final"] for t in completed]
+    slack_counts = slack.call_counts()
+    slack_calls = sum(n for method, n in slack_counts.items() if method != "apps.connections.open")
+    with slack.lock:
+        ratelimited = sum(1 for call in slack.calls if call["ratelimited"])
+    openai_counts = openai_fake.call_counts()
+    openai_calls = sum(openai_counts.values())
+    per_request = max(1, len(completed))
+    summary = {
+        "requests": len(timings),
+        "completed": len(completed),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(completed) / elapsed, 3) if elapsed else None,
+        "first_reply_s": {f"p{p}": percentile(first, p) for p in (50, 95, 99)},
+        "final_answer_s": {f"p{p}": percentile(final, p) for p in (50, 95, 99)},
+        "slack_calls_per_request": round(slack_calls / per_request, 2),
+        "openai_calls_per_request": round(openai_calls / per_request, 2),
+        "slack_ratelimited": ratelimited,
+        "slack_calls": slack_counts,
+        "openai_calls": openai_counts,
+    }
+    p95 = summary["final_answer_s"]["p95"]
+    summary["sustainable"] = len(completed) == len(timings) and (slo is None or (p95 is not None and p95 <= slo))
+    return summary
+
+
+def run_step(slack, openai_fake, rate, duration, mix, drain_timeout, slo, rng, start_n=0):
+    slack.reset_stats()
+    openai_fake.reset_stats()
+    kinds, weights = zip(*mix.items())
+    sent = []
+    started = time.monotonic()
+    n = start_n
+    next_send = started
+    while next_send < started + duration:
+        time.sleep(max(0.0, next_send - time.monotonic()))
+        send_request(slack, rng.choices(kinds, weights)[0], n, sent)
+        n += 1
+        # Poisson arrivals: exponential gaps between requests
+        next_send += rng.expovariate(rate)
+    timings = wait_for_completion(slack, sent, drain_timeout)
+    completed = [t for t in timings if t["final"] is not None]
+    elapsed = max([started] + [r["sent"] + t["final"] for r, t in zip(sent, timings) if t["final"] is not None]) - started
+    summary = summarize(slack, openai_fake, timings, elapsed, slo)
+    summary["rate_rps"] = rate
+    print(f"rate {rate}/s: {len(completed)}/{len(timings)} completed, "
+          f"first reply p50/p95/p99 {fmt(summary['first_reply_s'])}, final p50/p95/p99 {fmt(summary['final_answer_s'])}, "
+          f"{summary['slack_calls_per_request']} Slack + {summary['openai_calls_per_request']} OpenAI calls/request"
+          f"{'' if summary['sustainable'] else ' (NOT sustainable)'}")
+    return summary, n
+
+
+def fmt(percentiles):
+    return "/".join("-" if v is None else f"{v:.2f}s" for v in percentiles.values())
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+
+def add_fake_arguments(parser):
+    parser.add_argument("--slack-latency", action="append", default=[], help='Slack API latency per method, e.g. "chat.*=lognormal:120,0.3"')
+    parser.add_argument("--slack-rate-limit", type=float, default=None, help="Slack calls per minute allowed per method")
+    parser.add_argument("--openai-latency", action="append", default=[], help='Time to first token per model, e.g. "gpt-4*=lognormal:3000,0.5"')
+    parser.add_argument("--openai-token-latency", type=float, default=0.0, help="Milliseconds per generated token")
+    parser.add_argument("--openai-rate-limit", type=float, default=None, help="OpenAI requests per minute allowed per model")
+    parser.add_argument("--tool-call-rate", type=float, default=0.0, help="Fraction of tool-enabled completions answered with a tool call")
+    parser.add_argument("--helper-delay", type=float, default=1.0, help="Seconds the fake tool helper takes (only used with tool calls)")
+    parser.add_argument("--review-mix", default="1,1,1", help="Weights for GOOD AS-IS, ADDITIONAL RESPONSE and replacement reviews")
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def start_fakes(args):
+    slack = FakeSlack(latency_specs=args.slack_latency, rate_limit=args.slack_rate_limit, seed=args.seed).start()
+    openai_fake = FakeOpenAI(latency_specs=args.openai_latency, token_latency_ms=args.openai_token_latency,
+                             tool_call_rate=args.tool_call_rate,
+                             review_mix=tuple(float(w) for w in args.review_mix.split(",")),
+                             rate_limit=args.openai_rate_limit, seed=args.seed).start()
+    return slack, openai_fake
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark slackAskBot.py against local fake Slack and OpenAI servers")
+    parser.add_argument("--rates", default="0.5,1,2", help="Comma-separated request rates (requests/second) to step through")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds of load per rate step")
+    parser.add_argument("--mix", default="mention=1,dm=1,thread=1", help="Relative weights of mention, dm and thread requests")
+    parser.add_argument("--slo", type=float, default=None, help="p95 final-answer latency (s) a step must meet to count as sustainable")
+    parser.add_argument("--drain-timeout", type=float, default=120, help="Seconds to wait for outstanding requests after each step")
+    parser.add_argument("--bot-workers", type=int, default=1, help="Run the bot in supervisor mode with this many worker processes")
+    parser.add_argument("--search-store", help="Answer tool calls with the bot's built-in search_workspace tool over this "
+                                               "embedding store instead of the fake helper program")
+    parser.add_argument("--json", help="Write the results as JSON to this file")
+    add_fake_arguments(parser)
+    args = parser.parse_args()
+
+    slack, openai_fake = start_fakes(args)
+    workdir = tempfile.mkdtemp(prefix="slackaskbot-bench-")
+    bot = start_bot(slack, openai_fake, workdir,
+                    helper_delay=args.helper_delay if args.tool_call_rate and not args.search_store else None,
+                    extra_env={"WORKSPACE_SEARCH_STORES": os.path.abspath(args.search_store)} if args.search_store else None,
+                    extra_args=["--workers", str(args.bot_workers)])
+    print(f"Bot started (pid {bot.pid}); logs in {workdir}/bot.log")
+    results = []
+    try:
+        if not slack.wait_for_connection(30):
+            print("Bot did not open a Socket Mode connection within 30 seconds")
+            sys.exit(1)
+        rng = random.Random(args.seed)
+        mix = parse_mix(args.mix)
+        n = 0
+        for rate in [float(r) for r in args.rates.split(",")]:
+            summary, n = run_step(slack, openai_fake, rate, args.duration, mix, args.drain_timeout, args.slo, rng, n)
+            results.append(summary)
+    finally:
+        bot.terminate()
+        try:
+            bot.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        slack.stop()
+        openai_fake.stop()
+
+    sustainable = [r["rate_rps"] for r in results if r["sustainable"]]
+    max_rate = max(sustainable) if sustainable else None
+    print(f"Max sustainable rate: {max_rate if max_rate is not None else 'none of the tested rates'} requests/second")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"steps": results, "max_sustainable_rps": max_rate}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Throughput benchmark for unused/token_chunker.py against the loops it replaced:
+    truncation  `while tokens > limit: text = text[:-1000]; re-encode` (search_with_slack_api.py)
+                vs. one encode and a token slice (token_chunker.truncate)
+    chunking    get_embeddings' per-line get_encoding, token count, then slicing the line by *characters*
+                vs. splitting on token boundaries (token_chunker.chunk_text)
+
+Texts are synthetic Slack-like messages (words, mentions, links, emoji, code) of random lengths.  For chunking it
+also reports the largest chunk in tokens and how much of the text the chunks cover, since the character slicing
+both overshoots the limit and drops text.  Both sides use the same encoding, so only the loops are compared.
+
+Example:
+    python benchmarks/chunker_benchmark.py --texts 200 --max-tokens 30000 --json chunker_bench.json
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import tiktoken
+
+from bot_benchmark import REPO_DIR
+
+sys.path.insert(0, os.path.join(REPO_DIR, "unused"))
+from token_chunker import chunk_text, count_tokens, get_encoder, truncate  # noqa: E402
+
+WORDS = ("the deploy pipeline is failing again after the last merge can someone take a look at staging "
+         "logs show a timeout in the auth service we rolled back and it works now thanks for the quick fix").split()
+EXTRAS = ["<@U024BE7LH>", "<https://example.com/runbook|runbook>", ":tada:", ":white_check_mark:", "`kubectl get pods`",
+          "```\nTraceback (most recent call last):\n  File \"app.py\", line 42\n```", "👍", "naïve café"]
+
+
+def make_texts(count, max_tokens, seed):
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(count):
+        target = rng.randint(max_tokens // 20, max_tokens)
+        parts = []
+        # About one token per word; extras are a few tokens each
+        while len(parts) < target:
+            parts.append(rng.choice(EXTRAS) if rng.random() < 0.05 else rng.choice(WORDS))
+            if rng.random() < 0.08:
+                parts.append("\n")
+        texts.append(" ".join(parts))
+    return texts
+
+
+def old_truncate(text, limit, encoding):
+    enc = tiktoken.get_encoding(encoding)
+    tokens = enc.encode(text)
+    while len(tokens) > limit:
+        text = text[:-1000]
+        tokens = enc.encode(text)
+    return text
+
+
+def old_chunks(line, encoding, limit=8000):
+    enc = tiktoken.get_encoding(encoding)
+    line_token_count = len(enc.encode(line))
+    if line_token_count > limit:
+        num_chunks = line_token_count // limit
+        return [line[i * limit:(i + 1) * limit] for i in range(num_chunks + 1)]
+    return [line]
+
+
+def timed(function, texts):
+    started = time.perf_counter()
+    results = [function(text) for text in texts]
+    return results, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark token_chunker against the character-slicing loops")
+    parser.add_argument("--texts", type=int, default=200)
+    parser.add_argument("--max-tokens", type=int, default=30000, help="Longest synthetic text, in tokens")
+    parser.add_argument("--truncate-to", type=int, default=3000, help="Truncation limit (the summary prompt uses 3000)")
+    parser.add_argument("--chunk-tokens", type=int, default=8000, help="Chunk limit (the embedding input limit)")
+    parser.add_argument("--encoding", default="cl100k_base")
+    parser.add_argument("--json", help="Write the results as JSON to this file")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    texts = make_texts(args.texts, args.max_tokens, args.seed)
+    megabytes = sum(len(t.encode("utf-8")) for t in texts) / 1e6
+    # Load the encoder before timing, as a long-running process would have it already
+    get_encoder()
+    tiktoken.get_encoding(args.encoding)
+    total_tokens = sum(count_tokens(t) for t in texts)
+
+    results = {"texts": len(texts), "megabytes": round(megabytes, 2), "tokens": total_tokens}
+    old, old_s = timed(lambda t: old_truncate(t, args.truncate_to, args.encoding), texts)
+    new, new_s = timed(lambda t: truncate(t, args.truncate_to), texts)
+    results["truncate"] = {
+        "old_mb_per_s": round(megabytes / old_s, 2), "new_mb_per_s": round(megabytes / new_s, 2),
+        "speedup": round(old_s / new_s, 1),
+        # The old loop drops up to 1000 characters more than it needs to
+        "old_tokens_kept": sum(count_tokens(t) for t in old), "new_tokens_kept": sum(count_tokens(t) for t in new),
+    }
+
+    old, old_s = timed(lambda t: old_chunks(t, args.encoding, args.chunk_tokens), texts)
+    new, new_s = timed(lambda t: [c for c, _ in chunk_text(t, args.chunk_tokens)], texts)
+    results["chunk"] = {
+        "old_mb_per_s": round(megabytes / old_s, 2), "new_mb_per_s": round(megabytes / new_s, 2),
+        "speedup": round(old_s / new_s, 1),
+        "old_max_chunk_tokens": max(count_tokens(c) for chunks in old for c in chunks),
+        "new_max_chunk_tokens": max(count_tokens(c) for chunks in new for c in chunks),
+        "old_chunks_per_text": round(sum(len(c) for c in old) / len(texts), 2),
+        "new_chunks_per_text": round(sum(len(c) for c in new) / len(texts), 2),
+        "old_coverage": round(sum(len("".join(c)) for c in old) / sum(len(t) for t in texts), 4),
+        "new_coverage": round(sum(len("".join(c)) for c in new) / sum(len(t) for t in texts), 4),
+    }
+
+    t, c = results["truncate"], results["chunk"]
+    print(f"{len(texts)} texts, {megabytes:.1f} MB, {total_tokens} tokens")
+    print(f"truncate to {args.truncate_to}: {t['old_mb_per_s']} -> {t['new_mb_per_s']} MB/s ({t['speedup']}x); "
+          f"tokens kept {t['old_tokens_kept']} -> {t['new_tokens_kept']}")
+    print(f"chunk at {args.chunk_tokens}: {c['old_mb_per_s']} -> {c['new_mb_per_s']} MB/s ({c['speedup']}x); "
+          f"largest chunk {c['old_max_chunk_tokens']} -> {c['new_max_chunk_tokens']} tokens; "
+          f"text covered {c['old_coverage']:.1%} -> {c['new_coverage']:.1%}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""
+A local stand-in for the OpenAI chat completions and embeddings APIs, for benchmarking without real API calls.
+
+Chat completions support streaming (server-sent events), tool-call responses when the request includes tools,
+and scripted answers to the bot's GPT-4 review prompt (GOOD AS-IS / ADDITIONAL RESPONSE / full replacement).
+Latency is the time to first token (per model, see latency.py) plus a per-token delay for the generated text.
+Embeddings are deterministic pseudo-random unit vectors derived from a hash of each input.
+
+Run standalone:
+    python benchmarks/fake_openai.py --port 8701 --latency "gpt-4*=lognormal:3000,0.5" --latency "gpt-3.5*=lognormal:800,0.4"
+then start the bot with OPENAI_BASE_URL=http://127.0.0.1:8701/v1
+"""
+
+import argparse
+import base64
+import hashlib
+import itertools
+import json
+import math
+import random
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from latency import LatencyTable, RateLimiter
+
+# Every generated answer starts with this, so the driver can tell model output apart from status messages
+ANSWER_MARKER = "Fake answer"
+EMBEDDING_DIMENSIONS = 1536
+
+
+class FakeOpenAI:
+    def __init__(self, host="127.0.0.1", port=0, latency_specs=None, token_latency_ms=0.0, answer_tokens=60,
+                 tool_call_rate=0.0, review_mix=(1, 1, 1), rate_limit=None, seed=None):
+        self.latency = LatencyTable(latency_specs, seed=seed)
+        self.token_latency_ms = token_latency_ms
+        self.answer_tokens = answer_tokens
+        self.tool_call_rate = tool_call_rate
+        # Relative weights for GOOD AS-IS, ADDITIONAL RESPONSE and full replacement answers to the review prompt
+        self.review_mix = review_mix
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.calls = []
+
+        fake = self
+
+        class Handler(FakeOpenAIHandler):
+            server_state = fake
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address[:2]
+        self.base_url = f"http://{self.host}:{self.port}/v1"
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = []
+
+    def record_call(self, endpoint, model, started, **extra):
+        with self.lock:
+            self.calls.append(dict(endpoint=endpoint, model=model, time=started, duration=time.monotonic() - started, **extra))
+
+    def call_counts(self):
+        counts = {}
+        with self.lock:
+            for call in self.calls:
+                key = f"{call['endpoint']}:{call['model']}"
+                counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def choose(self, probability):
+        with self.lock:
+            return self.random.random() < probability
+
+    def make_answer(self, messages):
+        words = " ".join(f"word{i}" for i in range(max(0, self.answer_tokens - 2)))
+        review_requested = any("GOOD AS-IS" in (m.get("content") or "") for m in messages)
+        if not review_requested:
+            return f"{ANSWER_MARKER}: {words}"
+        with self.lock:
+            choice = self.random.choices(["good", "additional", "replace"], weights=self.review_mix)[0]
+        if choice == "good":
+            return "GOOD AS-IS"
+        if choice == "additional":
+            return f"ADDITIONAL RESPONSE: {ANSWER_MARKER} (addendum): {words}"
+        return f"{ANSWER_MARKER} (replacement): {words}"
+
+    def make_tool_calls(self, messages, tools):
+        question = next((m.get("content") for m in reversed(messages) if m.get("role") == "user"), "") or ""
+        function = tools[0]["function"]
+        arguments = {name: question[:200] for name in function.get("parameters", {}).get("properties", {})}
+        return [{
+            "id": f"call_{next(self.ids)}",
+            "type": "function",
+            "function": {"name": function["name"], "arguments": json.dumps(arguments)},
+        }]
+
+    def embedding(self, text):
+        # Seed from the text so the same input always gets the same vector
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        rng = random.Random(seed)
+        vector = [rng.gauss(0, 1) for _ in range(EMBEDDING_DIMENSIONS)]
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    server_state = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        state = self.server_state
+        if not state.rate_limiter.allow(request.get("model", "*")):
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                            {"Retry-After": "1", "x-should-retry": "true"})
+            return
+        if self.path.endswith("/chat/completions"):
+            self._chat_completion(request)
+        elif self.path.endswith("/embeddings"):
+            self._embeddings(request)
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def _chat_completion(self, request):
+        state = self.server_state
+        started = time.monotonic()
+        model = request.get("model", "unknown")
+        messages = request.get("messages", [])
+        tools = request.get("tools")
+        completion_id = f"chatcmpl-fake{next(state.ids)}"
+        created = int(time.time())
+
+        # Time to first token
+        state.latency.get(model).sleep()
+
+        tool_calls = state.make_tool_calls(messages, tools) if tools and state.choose(state.tool_call_rate) else None
+        content = None if tool_calls else state.make_answer(messages)
+        tokens = content.split(" ") if content else []
+
+        if request.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+
+            def send_chunk(delta, finish_reason=None):
+                chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                         "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+
+            send_chunk({"role": "assistant", "content": ""})
+            if tool_calls:
+                send_chunk({"tool_calls": [dict(index=0, **tool_calls[0])]})
+            for i, token in enumerate(tokens):
+                if state.token_latency_ms:
+                    time.sleep(state.token_latency_ms / 1000.0)
+                send_chunk({"content": token if i == 0 else " " + token})
+            send_chunk({}, "tool_calls" if tool_calls else "stop")
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        else:
+            if state.token_latency_ms:
+                time.sleep(state.token_latency_ms * len(tokens) / 1000.0)
+            message = {"role": "assistant", "content": content}
+            if tool_calls:
+                message["tool_calls"] = tool_calls
+            self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_calls else "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+            })
+        state.record_call("chat", model, started, stream=bool(request.get("stream")), tool_calls=bool(tool_calls))
+
+    def _embeddings(self, request):
+        state = self.server_state
+        started = time.monotonic()
+        model = request.get("model", "unknown")
+        inputs = request.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        state.latency.get(model).sleep()
+        data = []
+        for i, text in enumerate(inputs):
+            vector = state.embedding(text if isinstance(text, str) else json.dumps(text))
+            if request.get("encoding_format") == "base64":
+                vector = base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode("ascii")
+            data.append({"object": "embedding", "index": i, "embedding": vector})
+        self._send_json(200, {"object": "list", "data": data, "model": model,
+                              "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+        state.record_call("embeddings", model, started, inputs=len(inputs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI chat/embeddings server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8701)
+    parser.add_argument("--latency", action="append", default=[], help='Time to first token per model, e.g. "gpt-4*=lognormal:3000,0.5"')
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Milliseconds per generated token")
+    parser.add_argument("--answer-tokens", type=int, default=60)
+    parser.add_argument("--tool-call-rate", type=float, default=0.0, help="Fraction of tool-enabled requests answered with a tool call")
+    parser.add_argument("--review-mix", default="1,1,1", help="Weights for GOOD AS-IS, ADDITIONAL RESPONSE and replacement reviews")
+    parser.add_argument("--rate-limit", type=float, default=None, help="Requests per minute allowed per model")
+    args = parser.parse_args()
+
+    review_mix = tuple(float(w) for w in args.review_mix.split(","))
+    fake = FakeOpenAI(args.host, args.port, args.latency, args.token_latency, args.answer_tokens,
+                      args.tool_call_rate, review_mix, args.rate_limit).start()
+    print(f"Fake OpenAI listening on {fake.base_url}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+"""
+A local stand-in for the Slack Web API and Socket Mode, for benchmarking slackAskBot.py without touching Slack.
+
+It implements the Web API methods the bot uses (auth.test, conversations.info, conversations.replies,
+chat.postMessage, chat.update, chat.delete, users.info) plus apps.connections.open, which hands the bot's
+SocketModeHandler a ws:// URL served by this same process.  Events are pushed to the bot with push_event(),
+and every Web API call is recorded with its arrival time so the driver can compute latencies per thread.
+
+Run standalone (e.g. to point a manually started bot at it):
+    python benchmarks/fake_slack.py --port 8700 --latency "chat.*=lognormal:120,0.3" --rate-limit 50
+then start the bot with SLACK_API_URL=http://127.0.0.1:8700/api/
+"""
+
+import argparse
+import base64
+import hashlib
+import itertools
+import json
+import socket
+import struct
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from latency import LatencyTable, RateLimiter
+
+BOT_USER_ID = "UFAKEBOT"
+BOT_ID = "BFAKEBOT"
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# Methods that change what users see in Slack; the driver uses these to time replies
+WRITE_METHODS = ("chat.postMessage", "chat.update", "chat.delete")
+
+
+class FakeSlack:
+    def __init__(self, host="127.0.0.1", port=0, latency_specs=None, rate_limit=None, seed=None):
+        self.latency = LatencyTable(latency_specs, seed=seed)
+        # Slack rate limits are per method, so the bucket key is the method name
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.lock = threading.Lock()
+        self.calls = []
+        self.threads = {}  # (channel, thread_ts) -> list of messages, parent first
+        self.messages = {}  # (channel, ts) -> message
+        self.sockets = []
+        self.socket_cycle = None
+        self.acks = {}
+        self.envelope_ids = itertools.count(1)
+        self.ts_counter = itertools.count(1)
+        self.connected = threading.Event()
+
+        fake = self
+
+        class Handler(FakeSlackHandler):
+            server_state = fake
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address[:2]
+        self.api_url = f"http://{self.host}:{self.port}/api/"
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        with self.lock:
+            for sock in self.sockets:
+                try:
+                    sock.close()
+                except OSError:
+                    pass
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = []
+            self.acks = {}
+
+    def new_ts(self):
+        # Real Slack timestamps are "<unix seconds>.<6 digits>" and unique per channel
+        return f"{int(time.time())}.{next(self.ts_counter) % 1000000:06d}"
+
+    def add_message(self, channel, text, user, ts=None, thread_ts=None, bot=False):
+        ts = ts or self.new_ts()
+        message = {"type": "message", "ts": ts, "text": text, "user": user}
+        if bot:
+            message["bot_id"] = BOT_ID
+        if thread_ts and thread_ts != ts:
+            message["thread_ts"] = thread_ts
+        with self.lock:
+            self.messages[(channel, ts)] = message
+            root = thread_ts or ts
+            self.threads.setdefault((channel, root), []).append(message)
+        return message
+
+    def record_call(self, method, params, ratelimited=False, root=None, ts=None):
+        with self.lock:
+            self.calls.append({
+                "time": time.monotonic(),
+                "method": method,
+                "ratelimited": ratelimited,
+                "channel": params.get("channel"),
+                # The thread this call belongs to, so the driver can attribute it to a request
+                "root": root,
+                "ts": ts or params.get("ts"),
+                "text": params.get("text"),
+            })
+
+    def call_counts(self):
+        counts = {}
+        with self.lock:
+            for call in self.calls:
+                counts[call["method"]] = counts.get(call["method"], 0) + 1
+        return counts
+
+    def handle_api(self, method, params):
+        if not self.rate_limiter.allow(method):
+            self.record_call(method, params, ratelimited=True)
+            return 429, {"ok": False, "error": "ratelimited"}
+        self.latency.get(method).sleep()
+        channel = params.get("channel")
+        if method not in WRITE_METHODS:
+            self.record_call(method, params)
+
+        if method == "auth.test":
+            return 200, {"ok": True, "user_id": BOT_USER_ID, "bot_id": BOT_ID, "user": "fakebot", "team_id": "TFAKE"}
+        if method == "apps.connections.open":
+            return 200, {"ok": True, "url": f"ws://{self.host}:{self.port}/socket"}
+        if method == "conversations.info":
+            # Channel IDs starting with D are DMs, as in real Slack
+            is_im = bool(channel) and channel.startswith("D")
+            info = {"id": channel, "is_im": is_im}
+            if is_im:
+                info["user"] = "UFAKEUSER"
+            else:
+                info["name"] = f"bench-{channel.lower()}"
+            return 200, {"ok": True, "channel": info}
+        if method == "conversations.replies":
+            with self.lock:
+                messages = list(self.threads.get((channel, params.get("ts")), []))
+            return 200, {"ok": True, "messages": messages, "has_more": False}
+        if method == "users.info":
+            user = params.get("user")
+            return 200, {"ok": True, "user": {"id": user, "name": user, "real_name": f"Bench User {user}"}}
+        if method == "chat.postMessage":
+            message = self.add_message(channel, params.get("text"), BOT_USER_ID, thread_ts=params.get("thread_ts"), bot=True)
+            self.record_call(method, params, root=message.get("thread_ts", message["ts"]), ts=message["ts"])
+            return 200, {"ok": True, "channel": channel, "ts": message["ts"], "message": message}
+        if method == "chat.update":
+            with self.lock:
+                message = self.messages.get((channel, params.get("ts")))
+                if message is not None:
+                    message["text"] = params.get("text")
+            if message is None:
+                self.record_call(method, params)
+                return 200, {"ok": False, "error": "message_not_found"}
+            self.record_call(method, params, root=message.get("thread_ts", message["ts"]))
+            return 200, {"ok": True, "channel": channel, "ts": params.get("ts"), "text": params.get("text")}
+        if method == "chat.delete":
+            with self.lock:
+                message = self.messages.pop((channel, params.get("ts")), None)
+                if message is not None:
+                    root = message.get("thread_ts", message["ts"])
+                    thread = self.threads.get((channel, root), [])
+                    if message in thread:
+                        thread.remove(message)
+            if message is None:
+                self.record_call(method, params)
+                return 200, {"ok": False, "error": "message_not_found"}
+            self.record_call(method, params, root=root)
+            return 200, {"ok": True, "channel": channel, "ts": params.get("ts")}
+        return 200, {"ok": True}
+
+    def push_event(self, body):
+        """Send an Events API payload to a connected bot over Socket Mode; returns the envelope ID."""
+        envelope_id = f"env-{next(self.envelope_ids)}"
+        envelope = {
+            "envelope_id": envelope_id,
+            "type": "events_api",
+            "accepts_response_payload": False,
+            "retry_attempt": 0,
+            "retry_reason": "",
+            "payload": body,
+        }
+        data = json.dumps(envelope).encode("utf-8")
+        with self.lock:
+            if not self.sockets:
+                raise RuntimeError("No Socket Mode connection to push events to")
+            # Slack spreads events across open connections; round-robin is close enough
+            if self.socket_cycle is None:
+                self.socket_cycle = itertools.cycle(list(self.sockets))
+            sock = next(self.socket_cycle)
+            _send_frame(sock, data)
+        return envelope_id
+
+    def wait_for_connection(self, timeout=30):
+        return self.connected.wait(timeout)
+
+
+class FakeSlackHandler(BaseHTTPRequestHandler):
+    server_state = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        path = urllib.parse.urlparse(self.path).path
+        if not path.startswith("/api/"):
+            self._send_json(404, {"ok": False, "error": "unknown_method"})
+            return
+        method = path[len("/api/"):]
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length).decode("utf-8") if length else ""
+        # slack_sdk sends most methods form-encoded, but some as JSON
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(raw) if raw else {}
+        else:
+            params = {k: v[0] for k, v in urllib.parse.parse_qs(raw).items()}
+        status, payload = self.server_state.handle_api(method, params)
+        self._send_json(status, payload)
+
+    def do_GET(self):
+        if urllib.parse.urlparse(self.path).path == "/socket" and self.headers.get("Upgrade", "").lower() == "websocket":
+            self._serve_websocket()
+        else:
+            self._send_json(404, {"ok": False, "error": "not_found"})
+
+    def _serve_websocket(self):
+        key = self.headers["Sec-WebSocket-Key"]
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode("ascii")).digest()).decode("ascii")
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+        state = self.server_state
+        sock = self.connection
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        hello = {"type": "hello", "num_connections": 1, "connection_info": {"app_id": "AFAKEAPP"}}
+        with state.lock:
+            _send_frame(sock, json.dumps(hello).encode("utf-8"))
+            state.sockets.append(sock)
+            state.socket_cycle = None
+        state.connected.set()
+        try:
+            while True:
+                opcode, payload = _recv_frame(sock)
+                if opcode == 0x8:  # close
+                    break
+                if opcode == 0x9:  # ping
+                    with state.lock:
+                        _send_frame(sock, payload, opcode=0xA)
+                elif opcode == 0x1:
+                    # Acknowledgements look like {"envelope_id": "..."}
+                    message = json.loads(payload.decode("utf-8"))
+                    if "envelope_id" in message:
+                        with state.lock:
+                            state.acks[message["envelope_id"]] = time.monotonic()
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            with state.lock:
+                if sock in state.sockets:
+                    state.sockets.remove(sock)
+                state.socket_cycle = None
+                if not state.sockets:
+                    state.connected.clear()
+
+
+def _recv_exact(sock, n):
+    data = b""
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("WebSocket closed")
+        data += chunk
+    return data
+
+
+def _recv_frame(sock):
+    # Client frames are always masked; slack_sdk never fragments its small JSON messages
+    first, second = _recv_exact(sock, 2)
+    opcode = first & 0x0F
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", _recv_exact(sock, 2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", _recv_exact(sock, 8))[0]
+    mask = _recv_exact(sock, 4) if second & 0x80 else None
+    payload = _recv_exact(sock, length) if length else b""
+    if mask:
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return opcode, payload
+
+
+def _send_frame(sock, payload, opcode=0x1):
+    header = bytes([0x80 | opcode])
+    length = len(payload)
+    if length < 126:
+        header += bytes([length])
+    elif length < 65536:
+        header += bytes([126]) + struct.pack("!H", length)
+    else:
+        header += bytes([127]) + struct.pack("!Q", length)
+    sock.sendall(header + payload)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Slack Web API and Socket Mode server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8700)
+    parser.add_argument("--latency", action="append", default=[], help='Latency per method, e.g. "chat.*=lognormal:120,0.3"')
+    parser.add_argument("--rate-limit", type=float, default=None, help="Calls per minute allowed per method")
+    args = parser.parse_args()
+
+    fake = FakeSlack(args.host, args.port, args.latency, args.rate_limit).start()
+    print(f"Fake Slack listening on {fake.api_url}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Latency distributions shared by the fake Slack and fake OpenAI servers.
+
+A latency spec is a short string in milliseconds, for example:
+    fixed:50                  always 50ms
+    uniform:20,200            uniformly between 20ms and 200ms
+    normal:300,50             mean 300ms, standard deviation 50ms (clamped at 0)
+    lognormal:800,0.4         median 800ms, sigma 0.4 (long right tail, like real LLM calls)
+    empirical:120,80,450,95   resample from recorded values (used by trace replay)
+Specs can be keyed by a name pattern, e.g. "gpt-4*=lognormal:3000,0.5", and looked up with LatencyTable.
+"""
+
+import fnmatch
+import random
+import threading
+import time
+
+
+class Latency:
+    def __init__(self, spec="fixed:0", seed=None):
+        self.spec = spec
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        kind, _, args = spec.partition(":")
+        self.kind = kind
+        self.args = [float(a) for a in args.split(",") if a] if args else []
+        if kind not in ("fixed", "uniform", "normal", "lognormal", "empirical"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+        if kind == "empirical" and not self.args:
+            raise ValueError(f"Empirical latency needs at least one sample: {spec}")
+
+    def sample_ms(self):
+        # random.Random isn't safe to share between server threads without a lock
+        with self.lock:
+            if self.kind == "fixed":
+                return self.args[0] if self.args else 0.0
+            if self.kind == "uniform":
+                return self.random.uniform(self.args[0], self.args[1])
+            if self.kind == "normal":
+                return max(0.0, self.random.gauss(self.args[0], self.args[1]))
+            if self.kind == "lognormal":
+                # The first argument is the median, so mu = ln(median)
+                return self.random.lognormvariate(0, self.args[1]) * self.args[0]
+            return self.random.choice(self.args)
+
+    def sleep(self, scale=1.0):
+        delay = self.sample_ms() * scale / 1000.0
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+class LatencyTable:
+    """Map names (API methods or model names) to latencies using glob patterns; first match wins."""
+
+    def __init__(self, specs=None, default="fixed:0", seed=None):
+        self.entries = []
+        self.default = Latency(default, seed)
+        for spec in specs or []:
+            self.add(spec, seed)
+
+    def add(self, spec, seed=None):
+        if "=" in spec:
+            pattern, spec = spec.split("=", 1)
+        else:
+            pattern = "*"
+        self.entries.append((pattern, Latency(spec, seed)))
+
+    def get(self, name):
+        for pattern, latency in self.entries:
+            if fnmatch.fnmatch(name, pattern):
+                return latency
+        return self.default
+
+
+class RateLimiter:
+    """Token bucket per key, so the fakes can answer 429 like the real services do."""
+
+    def __init__(self, per_minute=None):
+        self.per_minute = per_minute
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def allow(self, key="*"):
+        if not self.per_minute:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(key, (self.per_minute, now))
+            # Refill at per_minute/60 tokens per second, capped at one minute's burst
+            tokens = min(self.per_minute, tokens + (now - last) * self.per_minute / 60.0)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return False
+            self.buckets[key] = (tokens - 1, now)
+            return True
@@ -0,0 +1,144 @@
+"""
+Throughput benchmark for unused/pack_messages.py against unused/combine_messages.py on a synthetic export.
+
+A per-day export (<channel>/<YYYY-MM-DD>.json, as extract_messages.py writes it) of Slack-like messages is generated
+in --workdir, then packed into windows of --max-tokens by:
+    combine_messages   the original script, run in the work directory
+    pack (1 worker)    pack_messages with an empty token cache, one channel at a time
+    pack (N workers)   the same with channels in a process pool
+    pack (cached)      a re-run over the same export, with every token count in the cache
+For each it reports messages per second, the number of windows, and the largest window in tokens (recounted from
+the written files), and checks that two runs of pack_messages write identical windows.
+
+Example:
+    python benchmarks/packer_benchmark.py --channels 8 --days 60 --messages 60 --json packer_bench.json
+"""
+
+import argparse
+import contextlib
+import filecmp
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from bot_benchmark import REPO_DIR
+
+sys.path.insert(0, os.path.join(REPO_DIR, "unused"))
+import combine_messages  # noqa: E402
+from pack_messages import find_channels, pack_channel  # noqa: E402
+from token_chunker import count_tokens  # noqa: E402
+
+WORDS = ("the deploy pipeline is failing again after the last merge can someone take a look at staging "
+         "logs show a timeout in the auth service we rolled back and it works now thanks for the quick fix").split()
+
+
+def make_export(path, channels, days, messages, seed):
+    rng = random.Random(seed)
+    total = 0
+    for c in range(channels):
+        channel_dir = os.path.join(path, f"channel-{c:02d}")
+        os.makedirs(channel_dir)
+        for day in range(days):
+            count = rng.randint(0, 2 * messages)
+            data = [{"client_msg_id": f"{c}-{day}-{i}", "ts": f"{1672531200 + day * 86400 + i * 60}.000100",
+                     "text": " ".join(rng.choice(WORDS) for _ in range(int(rng.lognormvariate(3, 1)) + 1))}
+                    for i in range(count)]
+            total += count
+            if data:
+                with open(os.path.join(channel_dir, f"2023-{1 + day // 28:02d}-{1 + day % 28:02d}.json"), "w") as f:
+                    json.dump(data, f)
+    return total
+
+
+def window_stats(path):
+    windows = 0
+    largest = 0
+    for channel in os.listdir(path):
+        channel_dir = os.path.join(path, channel)
+        if channel.startswith(".") or not os.path.isdir(channel_dir):
+            continue
+        for filename in os.listdir(channel_dir):
+            with open(os.path.join(channel_dir, filename)) as f:
+                largest = max(largest, count_tokens(f.read(), model="text-embedding-ada-002"))
+            windows += 1
+    return windows, largest
+
+
+def run_combine(workdir):
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            combine_messages.main()
+    finally:
+        os.chdir(cwd)
+
+
+def run_pack(input_dir, output_dir, max_tokens, workers):
+    channels = find_channels(input_dir)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(pack_channel, channels, channels.values(), [output_dir] * len(channels),
+                          [max_tokens] * len(channels)))
+
+
+def timed(function):
+    started = time.perf_counter()
+    function()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pack_messages against combine_messages")
+    parser.add_argument("--channels", type=int, default=8)
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--messages", type=int, default=60, help="Mean messages per channel per day")
+    parser.add_argument("--max-tokens", type=int, default=1000, help="Window budget (combine_messages uses 1000)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--workdir", help="Directory for the synthetic export (default: a temporary directory)")
+    parser.add_argument("--json", help="Write the results as JSON to this file")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(dir=args.workdir)
+    try:
+        trimmed = os.path.join(workdir, "trimmed")
+        messages = make_export(trimmed, args.channels, args.days, args.messages, args.seed)
+        megabytes = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(trimmed) for f in files) / 1e6
+        print(f"{args.channels} channels, {args.days} days, {messages} messages, {megabytes:.1f} MB")
+
+        runs = {}
+        runs["combine_messages"] = (timed(lambda: run_combine(workdir)), os.path.join(workdir, "combined"))
+        first = os.path.join(workdir, "packed-1")
+        runs["pack (1 worker)"] = (timed(lambda: run_pack(trimmed, first, args.max_tokens, 1)), first)
+        parallel = os.path.join(workdir, "packed-n")
+        runs[f"pack ({args.workers} workers)"] = (timed(lambda: run_pack(trimmed, parallel, args.max_tokens, args.workers)), parallel)
+        runs["pack (cached)"] = (timed(lambda: run_pack(trimmed, parallel, args.max_tokens, args.workers)), parallel)
+
+        channels = [c for c in os.listdir(first) if not c.startswith(".")]
+        deterministic = all(not (m := filecmp.dircmp(os.path.join(first, c), os.path.join(parallel, c))).diff_files
+                            and not m.left_only and not m.right_only for c in channels)
+        results = {"channels": args.channels, "days": args.days, "messages": messages, "megabytes": round(megabytes, 2),
+                   "deterministic": deterministic, "runs": []}
+        baseline = runs["combine_messages"][0]
+        for name, (seconds, output) in runs.items():
+            windows, largest = window_stats(output)
+            results["runs"].append({"name": name, "seconds": round(seconds, 3), "messages_per_s": round(messages / seconds),
+                                    "speedup": round(baseline / seconds, 1), "windows": windows, "largest_window_tokens": largest})
+            print(f"{name}: {seconds:.2f}s, {messages / seconds:.0f} messages/s ({baseline / seconds:.1f}x), "
+                  f"{windows} windows, largest {largest} tokens")
+        print(f"pack output identical across runs: {deterministic}")
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Replay a recorded event trace (see event_trace.py) against slackAskBot.py with Slack and OpenAI replaced by the
+local fakes.  The fakes answer with latencies resampled from the ones recorded in the trace, so queueing, caching
+and rate-limiting changes can be checked against real traffic before deploying.
+
+Events are replayed at their recorded spacing divided by --speed (1 = real time, 10 = ten times faster),
+or back to back with --speed max.  Mentions of the recorded bot are rewritten to mention the stand-in bot, and
+each user message is added to the fake Slack so conversations.replies sees the same thread history.
+
+Example:
+    EVENT_TRACE_FILE=trace.jsonl.gz EVENT_TRACE_REDACT=1 python slackAskBot.py     # record in production
+    python benchmarks/replay_trace.py trace.jsonl.gz --speed 10 --json replay.json  # replay locally
+    python benchmarks/replay_trace.py trace*.jsonl.gz --speed 10                     # recorded with --workers
+"""
+
+import argparse
+import json
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from bot_benchmark import REPO_DIR, fmt, start_bot, summarize, wait_for_completion
+from fake_openai import FakeOpenAI
+from fake_slack import BOT_USER_ID, FakeSlack
+
+sys.path.insert(0, REPO_DIR)
+from event_trace import read_trace  # noqa: E402
+
+
+def load_trace(paths):
+    """The first header, every event in time order, and the recorded latencies, from one or more trace files."""
+    header = {}
+    events = []
+    latencies = {"slack": {}, "openai": {}}
+    offset = 0.0
+    for record in (record for path in paths for record in read_trace(path)):
+        if record["k"] == "header":
+            # A restarted bot appends a new header to the same file; keep event times relative to the first one
+            if header:
+                offset = record["started"] - header["started"]
+                header["redacted"] = header["redacted"] and record["redacted"]
+            else:
+                header = record
+        elif record["k"] == "event":
+            record["t"] += offset
+            events.append(record)
+        elif record["k"] in latencies:
+            latencies[record["k"]].setdefault(record["m"], []).append(record["ms"])
+    # A bot run with --workers records each worker's events in a file of its own
+    events.sort(key=lambda record: record["t"])
+    return header, events, latencies
+
+
+def latency_specs(samples, max_samples=2000, seed=0):
+    """Turn recorded latencies into empirical specs for the fakes' LatencyTable."""
+    rng = random.Random(seed)
+    specs = []
+    for name, values in samples.items():
+        if len(values) > max_samples:
+            values = rng.sample(values, max_samples)
+        specs.append(f"{name}=empirical:" + ",".join(f"{v:g}" for v in values))
+    return specs
+
+
+def prepare_body(slack, body):
+    """Rewrite a recorded body for the stand-in bot and mirror its message into the fake Slack."""
+    event = dict(body.get("event", {}))
+    authorizations = body.get("authorizations") or [{}]
+    recorded_bot_id = authorizations[0].get("user_id")
+    if recorded_bot_id and event.get("text"):
+        event["text"] = event["text"].replace(f"<@{recorded_bot_id}>", f"<@{BOT_USER_ID}>")
+
+    channel, ts = event.get("channel"), event.get("ts")
+    # Mentions arrive as both a message and an app_mention event for the same ts; add the message only once
+    if channel and ts and event.get("user") and "subtype" not in event and (channel, ts) not in slack.messages:
+        slack.add_message(channel, event.get("text", ""), event["user"], ts=ts, thread_ts=event.get("thread_ts"))
+
+    body = dict(body, event=event)
+    body["authorizations"] = [{"team_id": body.get("team_id", "TFAKE"), "user_id": BOT_USER_ID, "is_bot": True}]
+    body.setdefault("type", "event_callback")
+    return body
+
+
+def expected_reply_root(slack, event):
+    """The thread the bot will answer in for this event, or None if the bot should ignore it (mirrors the handlers)."""
+    channel, ts, thread_ts = event.get("channel"), event.get("ts"), event.get("thread_ts")
+    mention = f"<@{BOT_USER_ID}>"
+    if event.get("type") == "app_mention":
+        if not thread_ts:
+            return (channel, ts)
+        thread = slack.threads.get((channel, thread_ts), [])
+        return (channel, thread_ts) if any(mention in (m.get("text") or "") for m in thread) else None
+    if event.get("type") == "message" and "subtype" not in event and "user" in event:
+        if thread_ts and thread_ts != ts:
+            parent = slack.messages.get((channel, thread_ts))
+            if (parent and mention in (parent.get("text") or "")) or event.get("channel_type") == "im":
+                return (channel, thread_ts)
+        elif event.get("channel_type") == "im":
+            return (channel, ts)
+    return None
+
+
+def replay(slack, events, speed):
+    sent = []
+    started = time.monotonic()
+    for record in events:
+        if speed:
+            time.sleep(max(0.0, started + record["t"] / speed - time.monotonic()))
+        body = prepare_body(slack, record["body"])
+        root = expected_reply_root(slack, body["event"])
+        if root:
+            sent.append({"root": root, "kind": body["event"].get("channel_type") or body["event"].get("type"), "sent": time.monotonic()})
+        slack.push_event(body)
+    return sent, started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded event trace against slackAskBot.py and local fakes")
+    parser.add_argument("trace", nargs="+",
+                        help="Trace file recorded with EVENT_TRACE_FILE, plus its worker files (trace.worker*.jsonl.gz) "
+                             "if the bot ran with --workers")
+    parser.add_argument("--speed", default="1", help='Replay speed multiplier (e.g. 1, 10) or "max" for no gaps')
+    parser.add_argument("--drain-timeout", type=float, default=300, help="Seconds to wait for outstanding requests after the last event")
+    parser.add_argument("--slo", type=float, default=None, help="p95 final-answer latency (s) the replay must meet")
+    parser.add_argument("--tool-call-rate", type=float, default=0.0, help="Fraction of tool-enabled completions answered with a tool call")
+    parser.add_argument("--helper-delay", type=float, default=1.0, help="Seconds the fake tool helper takes (only used with tool calls)")
+    parser.add_argument("--json", help="Write the results as JSON to this file")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    header, events, latencies = load_trace(args.trace)
+    speed = 0 if args.speed == "max" else float(args.speed)
+    print(f"Loaded {len(events)} events spanning {events[-1]['t'] if events else 0:.1f}s "
+          f"({'redacted' if header.get('redacted') else 'not redacted'}), replaying at {'max speed' if args.speed == 'max' else args.speed + 'x'}")
+
+    slack = FakeSlack(latency_specs=latency_specs(latencies["slack"], seed=args.seed), seed=args.seed).start()
+    openai_fake = FakeOpenAI(latency_specs=latency_specs(latencies["openai"], seed=args.seed),
+                             tool_call_rate=args.tool_call_rate, seed=args.seed).start()
+    workdir = tempfile.mkdtemp(prefix="slackaskbot-replay-")
+    bot = start_bot(slack, openai_fake, workdir, helper_delay=args.helper_delay if args.tool_call_rate else None)
+    print(f"Bot started (pid {bot.pid}); logs in {workdir}/bot.log")
+    try:
+        if not slack.wait_for_connection(30):
+            print("Bot did not open a Socket Mode connection within 30 seconds")
+            sys.exit(1)
+        slack.reset_stats()
+        openai_fake.reset_stats()
+        sent, started = replay(slack, events, speed)
+        timings = wait_for_completion(slack, sent, args.drain_timeout)
+    finally:
+        bot.terminate()
+        try:
+            bot.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        slack.stop()
+        openai_fake.stop()
+
+    elapsed = max([started] + [r["sent"] + t["final"] for r, t in zip(sent, timings) if t["final"] is not None]) - started
+    summary = summarize(slack, openai_fake, timings, elapsed, args.slo)
+    summary["speed"] = args.speed
+    summary["events"] = len(events)
+    print(f"{summary['completed']}/{summary['requests']} requests completed in {summary['elapsed_s']}s, "
+          f"first reply p50/p95/p99 {fmt(summary['first_reply_s'])}, final p50/p95/p99 {fmt(summary['final_answer_s'])}, "
+          f"{summary['slack_calls_per_request']} Slack + {summary['openai_calls_per_request']} OpenAI calls/request, "
+          f"{summary['slack_ratelimited']} Slack calls rate limited")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
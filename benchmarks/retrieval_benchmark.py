@@ -0,0 +1,335 @@
+"""
+Recall, latency and memory benchmark for every retrieval mode the export search scripts in unused/ can use.
+
+For each corpus size a synthetic Slack-like export is written to an embedding store in --workdir: messages in
+--channels channels, each about one of --topics topics, with text drawn from the topic's vocabulary plus filler
+words and a ticket number unique to the message (e.g. OPS-1234), and an embedding scattered around the topic's
+centroid.  Each query is a noisy copy of a random message's embedding with a text of the message's topic words and
+its ticket number, so every query has two kinds of ground truth: the exact top k by cosine similarity (computed by
+brute force before any mode runs) and the message it was made from.
+
+The modes are:
+    pandas       search_exports.py's original path: df.ada_search.apply(cosine_similarity) then sort_values, run on
+                 the first --baseline-rows rows with build and latency scaled linearly (marked "extrapolated")
+    vectorized   exact blocked matrix search with VectorIndex (vector_search.py)
+    ivf          the IVF-flat index (ann_index.py), once per --nprobe
+    int8, pq     compressed codes re-ranked on the full-precision rows (quantization.py)
+    sharded      exact search over a store split per channel, scored in a process pool (sharded_store.py)
+    hybrid       exact vector search fused with BM25 keyword search (lexical_index.py), as search_exports.py does
+
+Each mode runs in a fresh process, so its peak RSS is its own, and reports:
+    build_s       time to build the index (or the DataFrame, for pandas)
+    index_bytes   size on disk of what the mode searches (for pandas, None: the lists of floats only exist in RAM)
+    rss_mb        peak resident memory of the process, interpreter included (sharded: not counting its workers)
+    qps           queries per second, one query at a time; batch_qps with --batch queries per call, where the
+                  mode scores a batch in one pass
+    p50_ms        median and 99th percentile single-query latency
+    p99_ms
+    recall_at_k   share of the exact top k found
+    hit_at_k      share of queries whose source message is in the top k
+
+Example:
+    python benchmarks/retrieval_benchmark.py --rows 10000,100000,1000000 --queries 200 --json retrieval_bench.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+
+from bot_benchmark import REPO_DIR
+
+sys.path.insert(0, os.path.join(REPO_DIR, "unused"))
+from ann_index import IVFIndex  # noqa: E402
+from embedding_store import EmbeddingStore  # noqa: E402
+from lexical_index import LexicalIndex, fuse  # noqa: E402
+from quantization import QuantizedIndex  # noqa: E402
+from sharded_store import ShardedSearch, ShardedStore  # noqa: E402
+from vector_search import VectorIndex, normalize_rows  # noqa: E402
+
+MODES = ("pandas", "vectorized", "ivf", "int8", "pq", "sharded", "hybrid")
+WORDS = ("the deploy pipeline is failing again after the last merge can someone take a look at staging "
+         "logs show a timeout in the auth service we rolled back and it works now thanks for the quick fix").split()
+SYLLABLES = "ka ri to mu ne so la vi de po".split()
+START_TS = 1672531200
+
+
+def cosine_similarity(a, b):
+    # As in openai.embeddings_utils, which search_exports.py used per row
+    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+
+
+def make_corpus(path, rows, args, block_rows=50000):
+    """An embedding store of rows synthetic messages; message i is in channel i % args.channels."""
+    rng = np.random.default_rng(args.seed)
+    centroids = normalize_rows(rng.standard_normal((args.topics, args.dim), dtype=np.float32))
+    vocabulary = [["".join(rng.choice(SYLLABLES, 4)) for _ in range(12)] for _ in range(args.topics)]
+    store = EmbeddingStore.create(path, args.dim, args.dtype, "synthetic")
+    for start in range(0, rows, block_rows):
+        count = min(block_rows, rows - start)
+        topics = rng.integers(args.topics, size=count)
+        embeddings = centroids[topics] + rng.standard_normal((count, args.dim), dtype=np.float32) * (
+            args.topic_spread / np.sqrt(args.dim))
+        records = []
+        for row, topic in enumerate(topics.tolist(), start):
+            words = list(rng.choice(vocabulary[topic], 4)) + list(rng.choice(WORDS, rng.integers(4, 24)))
+            records.append({"messages": [{"ts": f"{START_TS + row * 60}.000100",
+                                          "text": " ".join(words) + f" (ticket OPS-{row})"}],
+                            "source": f"channel-{row % args.channels:02d}/{row}"})
+        store.append(embeddings, records)
+    return EmbeddingStore(path)
+
+
+def make_queries(store, args):
+    """(query embeddings, query texts, source rows): noisy copies of random messages."""
+    rng = np.random.default_rng(args.seed + 1)
+    sources = rng.choice(len(store), min(args.queries, len(store)), replace=False)
+    embeddings = normalize_rows(np.asarray(store.embeddings[np.sort(sources)], dtype=np.float32))
+    embeddings = embeddings[np.argsort(np.argsort(sources))]
+    embeddings += rng.standard_normal(embeddings.shape, dtype=np.float32) * (args.query_noise / np.sqrt(store.dim))
+    texts = [" ".join(record["messages"][0]["text"].split()[:4]) + f" OPS-{row}"
+             for row, record in zip(sources.tolist(), store.records(sources))]
+    return embeddings, texts, sources
+
+
+def exact_top_k(embeddings, queries, k, args):
+    index = VectorIndex(embeddings, block_rows=args.block_rows, max_memory_bytes=int(args.max_memory_gb * (1 << 30)))
+    return np.stack([ids for i in range(0, len(queries), args.batch)
+                     for ids, _ in index.search_batch(queries[i:i + args.batch], k)])
+
+
+def directory_bytes(*paths):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for path in paths for root, _, names in os.walk(path) for name in names)
+
+
+def peak_rss_mb():
+    # VmHWM is this process's own peak; ru_maxrss carries over the parent's across fork and exec
+    try:
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith("VmHWM:")) / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1 << 20 if sys.platform == "darwin" else 1024)
+
+
+def time_queries(search, count):
+    """(ids found for each query, latencies in ms)."""
+    found = []
+    latencies = []
+    for q in range(count):
+        started = time.perf_counter()
+        found.append(np.asarray(search(q)))
+        latencies.append((time.perf_counter() - started) * 1000)
+    return found, np.array(latencies)
+
+
+def time_batches(search_batch, count, batch):
+    started = time.perf_counter()
+    for i in range(0, count, batch):
+        search_batch(i, min(i + batch, count))
+    return count / (time.perf_counter() - started)
+
+
+def measure(found, latencies, expected, sources, k):
+    """Throughput, latency percentiles and recall; sources of -1 (not in the rows searched) don't count for hit_at_k."""
+    hits = [source in ids[:k] for ids, source in zip(found, sources) if source >= 0]
+    return {
+        "qps": round(1000 / latencies.mean(), 1),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 2),
+        "recall_at_k": round(float(np.mean([len(set(ids[:k].tolist()) & set(e.tolist())) / k
+                                            for ids, e in zip(found, expected)])), 4),
+        "hit_at_k": round(float(np.mean(hits)), 4) if hits else None,
+    }
+
+
+def run_mode(mode, store_path, queries_path, args):
+    """Build and query one mode in this (fresh) process; a list of result dicts, one per setting."""
+    store = EmbeddingStore(store_path)
+    data = np.load(queries_path)
+    queries, sources, expected = data["queries"], data["sources"], data["expected"]
+    with open(queries_path + ".texts.json") as f:
+        texts = json.load(f)
+    k = args.k
+    count = len(queries)
+    results = []
+
+    def result(name, build_s, index_bytes, found, latencies, batch_qps=None, truth=(expected, sources), **extra):
+        results.append({"mode": name, "build_s": round(build_s, 3), "index_bytes": index_bytes,
+                        "rss_mb": round(peak_rss_mb(), 1), **measure(found, latencies, *truth, k),
+                        "batch_qps": batch_qps and round(batch_qps, 1), **extra})
+
+    if mode == "pandas":
+        rows = min(len(store), args.baseline_rows)
+        scale = len(store) / rows
+        started = time.perf_counter()
+        # Lists like pd.read_json produces from the original JSON exports
+        df = pd.DataFrame({"ada_search": [row.tolist() for row in np.asarray(store.embeddings[:rows], dtype=np.float32)]})
+        build_s = time.perf_counter() - started
+        count = min(count, args.baseline_queries)
+
+        def search(q):
+            df["similarities"] = df.ada_search.apply(lambda x: cosine_similarity(x, queries[q]))
+            return df.sort_values("similarities", ascending=False).head(k).index.to_numpy()
+
+        found, latencies = time_queries(search, count)
+        # Ground truth over the rows the baseline searched, and only the sources among them
+        truth = (exact_top_k(np.asarray(store.embeddings[:rows]), queries[:count], k, args),
+                 np.where(sources[:count] < rows, sources[:count], -1))
+        result(mode, build_s * scale, None, found, latencies * scale, truth=truth, extrapolated=rows < len(store))
+    elif mode in ("vectorized", "hybrid"):
+        started = time.perf_counter()
+        index = VectorIndex(store.embeddings, block_rows=args.block_rows,
+                            max_memory_bytes=int(args.max_memory_gb * (1 << 30)))
+        vector_build_s = time.perf_counter() - started
+        embeddings_bytes = os.path.getsize(os.path.join(store_path, "embeddings.bin"))
+        if mode == "vectorized":
+            found, latencies = time_queries(lambda q: index.search(queries[q], k)[0], count)
+            batch_qps = time_batches(lambda i, j: index.search_batch(queries[i:j], k), count, args.batch)
+            result(mode, vector_build_s, embeddings_bytes, found, latencies, batch_qps,
+                   in_memory=index.inverse_norms is None)
+        else:
+            path = os.path.join(store_path, "bm25")
+            started = time.perf_counter()
+            lexical = LexicalIndex.build(store, path)
+            build_s = vector_build_s + time.perf_counter() - started
+            candidates = max(k, args.fusion_candidates)
+
+            def search(q):
+                vector = index.search(queries[q], candidates)
+                return fuse(vector, lexical.search(texts[q], candidates), args.fusion, args.lexical_weight)[0][:k]
+
+            found, latencies = time_queries(search, count)
+            result(mode, build_s, embeddings_bytes + directory_bytes(path), found, latencies, fusion=args.fusion)
+    elif mode == "ivf":
+        path = os.path.join(store_path, "ivf")
+        started = time.perf_counter()
+        index = IVFIndex.build(store.embeddings, path, nlist=args.nlist)
+        build_s = time.perf_counter() - started
+        for nprobe in (int(n) for n in args.nprobe.split(",")):
+            found, latencies = time_queries(lambda q: index.search(queries[q], k, nprobe)[0], count)
+            result(f"ivf (nprobe={nprobe})", build_s, directory_bytes(path), found, latencies,
+                   nlist=index.nlist, nprobe=nprobe)
+    elif mode in ("int8", "pq"):
+        started = time.perf_counter()
+        index = QuantizedIndex.build(store, mode, subspaces=args.subspaces or store.dim // 16)
+        build_s = time.perf_counter() - started
+        found, latencies = time_queries(lambda q: index.search(queries[q], k, args.rerank)[0], count)
+        batch_qps = time_batches(lambda i, j: index.search_batch(queries[i:j], k, args.rerank), count, args.batch)
+        # Codes are searched in RAM; the store's embeddings are only read for the re-ranked candidates
+        result(mode, build_s, index.nbytes, found, latencies, batch_qps, rerank=args.rerank)
+    elif mode == "sharded":
+        path = os.path.join(os.path.dirname(store_path), "sharded")
+        started = time.perf_counter()
+        ShardedStore.build(store, path, by="channel")
+        build_s = time.perf_counter() - started
+
+        def row_ids(found):
+            # Message i is row i // channels of shard channel-(i % channels), as shards keep the store's order
+            return np.array([row * args.channels + int(name.split("-")[1]) for _, name, row in found], dtype=np.int64)
+
+        with ShardedSearch(path, args.workers, args.block_rows) as searcher:
+            searcher.search(queries[0], k)  # start the pool before timing
+            found, latencies = time_queries(lambda q: row_ids(searcher.search(queries[q], k)), count)
+            batch_qps = time_batches(lambda i, j: searcher.search_batch(queries[i:j], k), count, args.batch)
+        result(mode, build_s, directory_bytes(path), found, latencies, batch_qps, workers=searcher.workers)
+    return results
+
+
+def format_mb(size):
+    return f"{'-':>8}" if size is None else f"{size / (1 << 20):>8.1f}"
+
+
+def run_size(rows, args, workdir):
+    size_dir = os.path.join(workdir, f"corpus-{rows}-{args.dim}-{args.dtype}")
+    shutil.rmtree(size_dir, ignore_errors=True)
+    started = time.perf_counter()
+    store = make_corpus(os.path.join(size_dir, "store"), rows, args)
+    generate_s = time.perf_counter() - started
+
+    queries, texts, sources = make_queries(store, args)
+    started = time.perf_counter()
+    expected = exact_top_k(store.embeddings, queries, args.k, args)
+    ground_truth_s = time.perf_counter() - started
+    queries_path = os.path.join(size_dir, "queries.npz")
+    np.savez(queries_path, queries=queries, sources=sources, expected=expected)
+    with open(queries_path + ".texts.json", "w") as f:
+        json.dump(texts, f)
+    print(f"{rows} rows x {args.dim} ({args.dtype}): generated in {generate_s:.1f}s, "
+          f"exact top {args.k} for {len(queries)} queries in {ground_truth_s:.1f}s")
+
+    results = []
+    for mode in args.modes.split(","):
+        # A fresh process per mode, so peak RSS and the page cache state are the mode's own
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+            mode_results = executor.submit(run_mode, mode, store.path, queries_path, args).result()
+        for result in mode_results:
+            result = {"rows": rows, "dim": args.dim, "dtype": args.dtype, "k": args.k, "queries": len(queries),
+                      "generate_s": round(generate_s, 2), **result}
+            results.append(result)
+            print(f"    {result['mode']:<18} build {result['build_s']:>8}s  index {format_mb(result['index_bytes'])} MB"
+                  f"  rss {result['rss_mb']:>7} MB  {result['qps']:>8} q/s  p50 {result['p50_ms']:>8} ms"
+                  f"  p99 {result['p99_ms']:>8} ms  recall@{args.k} {result['recall_at_k']:.3f}"
+                  f"  hit@{args.k} {'-' if result['hit_at_k'] is None else format(result['hit_at_k'], '.3f')}"
+                  f"{'  (extrapolated)' if result.get('extrapolated') else ''}")
+    if not args.keep:
+        shutil.rmtree(size_dir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark recall, latency and memory of every retrieval mode")
+    parser.add_argument("--rows", default="10000,100000", help="Comma-separated corpus sizes")
+    parser.add_argument("--dim", type=int, default=1536, help="Embedding dimension (1536 for text-embedding-ada-002)")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16"], help="On-disk embedding dtype")
+    parser.add_argument("--modes", default=",".join(MODES), help=f"Comma-separated modes, from {', '.join(MODES)}")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200, help="Queries timed per mode and size")
+    parser.add_argument("--batch", type=int, default=16, help="Queries per call for batch_qps")
+    parser.add_argument("--topics", type=int, default=256, help="Topics the messages are about")
+    parser.add_argument("--channels", type=int, default=16, help="Channels the messages are in (shards for sharded)")
+    parser.add_argument("--topic-spread", type=float, default=1.0,
+                        help="Noise around each topic centroid, relative to the centroid's length")
+    parser.add_argument("--query-noise", type=float, default=0.5,
+                        help="Noise added to a source message's embedding to make its query")
+    parser.add_argument("--nlist", type=int, default=None, help="IVF lists (default: 4 * sqrt(rows))")
+    parser.add_argument("--nprobe", default="4,16,64", help="Comma-separated IVF lists probed per query")
+    parser.add_argument("--subspaces", type=int, default=None, help="PQ subspaces (default: dim / 16)")
+    parser.add_argument("--rerank", type=int, default=100, help="Candidates re-ranked exactly by int8 and pq")
+    parser.add_argument("--fusion", default="rrf", choices=["rrf", "weighted"], help="How hybrid fuses the results")
+    parser.add_argument("--lexical-weight", type=float, default=0.5, help="Keyword side's share of the hybrid weight")
+    parser.add_argument("--fusion-candidates", type=int, default=50, help="Results taken from each side for hybrid")
+    parser.add_argument("--workers", type=int, default=None, help="Processes for sharded (default: one per core)")
+    parser.add_argument("--block-rows", type=int, default=65536, help="Rows scored per block for corpora kept on disk")
+    parser.add_argument("--max-memory-gb", type=float, default=2.0, help="Largest normalized corpus kept in RAM")
+    parser.add_argument("--baseline-rows", type=int, default=20000, help="Rows the pandas baseline runs on")
+    parser.add_argument("--baseline-queries", type=int, default=5, help="Queries timed for the pandas baseline")
+    parser.add_argument("--workdir", default=None, help="Directory for the corpora and indexes (default: a temp dir)")
+    parser.add_argument("--keep", action="store_true", help="Keep each corpus and its indexes in --workdir")
+    parser.add_argument("--json", help="Write the results as JSON to this file")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    unknown = set(args.modes.split(",")) - set(MODES)
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(sorted(unknown))}")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="retrieval-bench-")
+    results = []
+    for rows in (int(r) for r in args.rows.split(",")):
+        results += run_size(rows, args, workdir)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
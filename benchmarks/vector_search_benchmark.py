@@ -0,0 +1,138 @@
+"""
+Micro-benchmark for the vectorized top-k search in unused/vector_search.py against the original per-row
+pandas approach in search_exports.py (df.ada_search.apply(cosine_similarity) followed by sort_values).
+
+For each corpus size a random corpus is written to a memory-mapped file in --workdir (so sizes larger than RAM
+work and exercise the blocked path), and the benchmark reports:
+    build_s          time to build the VectorIndex (normalizing into RAM, or computing row norms for big corpora)
+    query_ms         mean single-query latency
+    batch_qps        queries per second when scoring --batch queries per matrix-matrix product
+    baseline_ms      per-query latency of the pandas apply approach; for sizes above --baseline-rows it is measured
+                     on the first --baseline-rows rows and scaled linearly (marked "extrapolated")
+    ranking_matches  whether the top k match the pandas ranking on the baseline rows, for every query
+
+Example:
+    python benchmarks/vector_search_benchmark.py --rows 100000,1000000 --dtype float16 --json search_bench.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from bot_benchmark import REPO_DIR
+
+sys.path.insert(0, os.path.join(REPO_DIR, "unused"))
+from vector_search import VectorIndex  # noqa: E402
+
+
+def cosine_similarity(a, b):
+    # As in openai.embeddings_utils, which search_exports.py used per row
+    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+
+
+def make_corpus(path, rows, dim, dtype, seed, block_rows=50000):
+    corpus = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(rows, dim))
+    rng = np.random.default_rng(seed)
+    for start in range(0, rows, block_rows):
+        block = rng.standard_normal((min(block_rows, rows - start), dim), dtype=np.float32)
+        corpus[start:start + len(block)] = block
+    corpus.flush()
+    return np.load(path, mmap_mode="r")
+
+
+def pandas_search(df, query, k):
+    df["similarities"] = df.ada_search.apply(lambda x: cosine_similarity(x, query))
+    return df.sort_values("similarities", ascending=False).head(k).index.to_numpy()
+
+
+def run_size(rows, args, queries, workdir):
+    path = os.path.join(workdir, f"corpus-{rows}-{args.dim}-{args.dtype}.npy")
+    started = time.perf_counter()
+    corpus = make_corpus(path, rows, args.dim, args.dtype, args.seed)
+    generate_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    index = VectorIndex(corpus, block_rows=args.block_rows, max_memory_bytes=int(args.max_memory_gb * (1 << 30)))
+    build_s = time.perf_counter() - started
+    in_memory = index.inverse_norms is None
+
+    started = time.perf_counter()
+    for query in queries:
+        index.search(query, args.k)
+    query_ms = (time.perf_counter() - started) / len(queries) * 1000
+
+    started = time.perf_counter()
+    for i in range(0, len(queries), args.batch):
+        index.search_batch(queries[i:i + args.batch], args.k)
+    batch_qps = len(queries) / (time.perf_counter() - started)
+
+    # Baseline on (at most) the first baseline_rows rows, as lists like pd.read_json produces
+    baseline_rows = min(rows, args.baseline_rows)
+    df = pd.DataFrame({"ada_search": [row.tolist() for row in np.asarray(corpus[:baseline_rows], dtype=np.float32)]})
+    subset_index = VectorIndex(np.asarray(corpus[:baseline_rows]))
+    baseline_queries = queries[:args.baseline_queries]
+    matches = True
+    started = time.perf_counter()
+    for query in baseline_queries:
+        expected = pandas_search(df, query, args.k)
+        matches = matches and bool((subset_index.search(query, args.k)[0] == expected).all())
+    baseline_ms = (time.perf_counter() - started) / len(baseline_queries) * 1000 * rows / baseline_rows
+
+    del index, corpus
+    os.remove(path)
+    return {
+        "rows": rows,
+        "dim": args.dim,
+        "dtype": args.dtype,
+        "in_memory": in_memory,
+        "generate_s": round(generate_s, 2),
+        "build_s": round(build_s, 3),
+        "query_ms": round(query_ms, 2),
+        "batch_qps": round(batch_qps, 1),
+        "baseline_ms": round(baseline_ms, 1),
+        "baseline_extrapolated": baseline_rows < rows,
+        "speedup": round(baseline_ms / query_ms, 1),
+        "ranking_matches": matches,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark vectorized top-k search against the pandas apply baseline")
+    parser.add_argument("--rows", default="100000,1000000", help="Comma-separated corpus sizes")
+    parser.add_argument("--dim", type=int, default=1536, help="Embedding dimension (1536 for text-embedding-ada-002)")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16"], help="On-disk embedding dtype")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=32, help="Queries timed per size")
+    parser.add_argument("--batch", type=int, default=16, help="Queries per batch for batch_qps")
+    parser.add_argument("--block-rows", type=int, default=65536, help="Rows scored per block for corpora kept on disk")
+    parser.add_argument("--max-memory-gb", type=float, default=2.0, help="Largest normalized corpus kept in RAM")
+    parser.add_argument("--baseline-rows", type=int, default=20000, help="Rows the pandas baseline runs on")
+    parser.add_argument("--baseline-queries", type=int, default=3, help="Queries timed for the pandas baseline")
+    parser.add_argument("--workdir", default=None, help="Directory for the memory-mapped corpora (default: a temp dir)")
+    parser.add_argument("--json", help="Write the results as JSON to this file")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="vector-search-bench-")
+    queries = np.random.default_rng(args.seed + 1).standard_normal((args.queries, args.dim), dtype=np.float32)
+    results = []
+    for rows in (int(r) for r in args.rows.split(",")):
+        result = run_size(rows, args, queries, workdir)
+        results.append(result)
+        print(f"{rows} rows ({'in RAM' if result['in_memory'] else 'blocked from disk'}): build {result['build_s']}s, "
+              f"{result['query_ms']} ms/query, {result['batch_qps']} queries/s batched; pandas apply "
+              f"{result['baseline_ms']} ms/query{' (extrapolated)' if result['baseline_extrapolated'] else ''}; "
+              f"{result['speedup']}x faster, ranking matches: {result['ranking_matches']}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Record the Slack events reaching slackAskBot.py, plus the latency of every Slack and OpenAI call the bot makes,
+into a compact gzip'd JSON-lines trace that benchmarks/replay_trace.py can replay against local stand-ins.
+
+Set EVENT_TRACE_FILE=/path/to/trace.jsonl.gz to turn recording on, and EVENT_TRACE_REDACT=1 to replace message
+text with same-shaped placeholder text and user/channel/team IDs with stable pseudonyms before anything is written.
+
+Each line is one of:
+    {"k":"header","v":1,"redacted":true,"started":1700000000.0}
+    {"k":"event","t":12.345,"body":{...}}       t is seconds since the trace started
+    {"k":"slack","t":12.400,"m":"chat.postMessage","ms":95.1}
+    {"k":"openai","t":13.000,"m":"gpt-4-turbo-preview","ms":4100.0}
+
+With --workers, each worker process writes its own file next to the trace (trace.worker0.jsonl.gz, ...), since
+processes appending to one gzip stream would interleave their compressed data; replay_trace.py takes them all.
+"""
+
+import atexit
+import gzip
+import hashlib
+import json
+import os
+import re
+import secrets
+import threading
+import time
+import zlib
+
+from slack_sdk import WebClient
+
+# Only these parts of an event body are used by the handlers, so nothing else is kept in the trace
+EVENT_FIELDS = ("type", "subtype", "user", "bot_id", "text", "channel", "channel_type", "ts", "thread_ts", "event_ts")
+BODY_FIELDS = ("type", "event_id", "event_time", "team_id", "api_app_id")
+
+# Slack IDs look like U024BE7LH, C1H9RESGL, D0C0F7S8Y, T12345
+SLACK_ID_PATTERN = re.compile(r'\b[UWCDGTB][A-Z0-9]{6,}\b')
+
+
+class TraceWriter:
+    def __init__(self, path, redact=False):
+        self.path = path
+        self.redact = redact
+        self.lock = threading.Lock()
+        # A per-trace salt keeps pseudonyms stable within a trace without being reversible from it
+        self.salt = secrets.token_hex(8)
+        self.started = time.time()
+        self.inherited_files = []
+        self._open()
+        atexit.register(self.close)
+
+    def _open(self):
+        opener = gzip.open if self.path.endswith(".gz") else open
+        self.file = opener(self.path, "at")
+        self._write({"k": "header", "v": 1, "redacted": self.redact, "started": self.started})
+
+    def open_worker_file(self, index):
+        """In a forked worker process: write to a file of its own from now on, keeping the salt and start time."""
+        # Closing the inherited stream, or letting it be garbage collected, would write its buffered data and
+        # trailer into the parent's file, so it is kept open and never written to again
+        self.inherited_files.append(self.file)
+        self.lock = threading.Lock()
+        self.path = worker_path(self.path, index)
+        self._open()
+
+    def _write(self, record):
+        line = json.dumps(record, separators=(",", ":"))
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def elapsed(self):
+        return round(time.time() - self.started, 4)
+
+    def record_event(self, body):
+        self._write({"k": "event", "t": self.elapsed(), "body": self.compact_body(body)})
+
+    def record_latency(self, kind, name, seconds):
+        self._write({"k": kind, "t": self.elapsed(), "m": name, "ms": round(seconds * 1000, 1)})
+
+    def compact_body(self, body):
+        compact = {k: body[k] for k in BODY_FIELDS if k in body}
+        event = body.get("event", {})
+        compact["event"] = {k: event[k] for k in EVENT_FIELDS if k in event}
+        # Keep the bot's own user ID so replay can map mentions of it onto the stand-in bot
+        authorizations = body.get("authorizations") or []
+        if authorizations:
+            compact["authorizations"] = [{"user_id": authorizations[0].get("user_id"), "is_bot": authorizations[0].get("is_bot")}]
+        if self.redact:
+            compact = self.redact_value(compact)
+        return compact
+
+    def pseudonym(self, slack_id):
+        digest = hashlib.sha256((self.salt + slack_id).encode("utf-8")).hexdigest().upper()
+        # Keep the leading letter: it tells DMs (D) from channels (C) and users (U) from bots (B)
+        return slack_id[0] + digest[:len(slack_id) - 1]
+
+    def redact_text(self, text):
+        parts = []
+        position = 0
+        for match in SLACK_ID_PATTERN.finditer(text):
+            parts.append(re.sub(r'[A-Za-z0-9]', 'x', text[position:match.start()]))
+            parts.append(self.pseudonym(match.group(0)))
+            position = match.end()
+        parts.append(re.sub(r'[A-Za-z0-9]', 'x', text[position:]))
+        return "".join(parts)
+
+    def redact_value(self, value, key=None):
+        if isinstance(value, dict):
+            return {k: self.redact_value(v, k) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.redact_value(v, key) for v in value]
+        if isinstance(value, str):
+            if key == "text":
+                return self.redact_text(value)
+            if key in ("user", "channel", "team_id", "api_app_id", "bot_id", "user_id"):
+                return self.pseudonym(value)
+        return value
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+class TracingWebClient(WebClient):
+    """A WebClient that records how long each Web API call took."""
+
+    def __init__(self, trace_writer, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.trace_writer = trace_writer
+
+    def api_call(self, api_method, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            return super().api_call(api_method, *args, **kwargs)
+        finally:
+            self.trace_writer.record_latency("slack", api_method, time.monotonic() - started)
+
+
+def worker_path(path, index):
+    """trace.jsonl.gz -> trace.worker<index>.jsonl.gz"""
+    base, compressed = (path[:-3], ".gz") if path.endswith(".gz") else (path, "")
+    base, ext = os.path.splitext(base)
+    return f"{base}.worker{index}{ext}{compressed}"
+
+
+def open_trace_writer():
+    path = os.environ.get("EVENT_TRACE_FILE")
+    if not path:
+        return None
+    redact = os.environ.get("EVENT_TRACE_REDACT", "").lower() in ("1", "true", "yes")
+    print(f"Recording event trace to {path}{' (redacted)' if redact else ''}")
+    return TraceWriter(path, redact)
+
+
+def read_trace(path):
+    """Yield the records of a trace file in order, stopping cleanly at a truncated tail."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt") as f:
+        try:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        except (EOFError, json.JSONDecodeError, zlib.error, gzip.BadGzipFile):
+            # The recording process was killed mid-write (or, for traces recorded before each worker had its own
+            # file, several processes wrote into one stream); everything up to the damage is still good
+            print(f"Trace {path} is truncated; using the records read so far")
@@ -0,0 +1,215 @@
+"""
+Live indexing of public channel messages into a local embedding store, for slackAskBot.py.
+
+The bot already receives a message event for everything posted in the channels it is in, so rather than waiting
+for the next export (or asking Slack's rate-limited search.messages API), new public channel messages are embedded
+in micro-batches and written to an embedding store (see unused/embedding_store.py) that search_exports.py and the
+bot's own search read while it grows:
+    new message       embedded and appended as a row of its own
+    message_changed   the old row is tombstoned and the new text appended
+    message_deleted   the row is tombstoned
+A batch is written once it holds `batch_size` operations or its oldest operation has waited `max_delay` seconds, so
+a message is searchable within a few seconds of being posted.  At most `max_pending` operations are queued; past
+that the oldest are dropped (and counted) rather than letting memory grow while OpenAI is unreachable.  A batch
+that fails is retried with backoff.
+
+The store's BM25 keyword index (see unused/lexical_index.py) is extended with every batch and written every
+`lexical_save_rows` rows, as a delta segment that only holds the rows added since the posting arrays were last
+rebuilt (they are rebuilt once it passes a tenth of the index); searches index the few rows after that themselves.
+
+Which row holds which message is kept in ids.sqlite inside the store directory.  Rows appended after it was last
+updated (if the process died in between) are read back from the store's records on startup.
+"""
+
+import collections
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "unused"))
+from embedding_cache import embed_texts, open_cache  # noqa: E402
+from embedding_store import HEADER_FILE, EmbeddingStore  # noqa: E402
+from lexical_index import LexicalIndex, index_path, open_lexical  # noqa: E402
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+IDS_FILE = "ids.sqlite"
+
+
+def message_operation(event):
+    """(channel, ts, message or None for a delete) for a public channel message event, or None to ignore it."""
+    if event.get("type") != "message" or event.get("channel_type") != "channel":
+        return None
+    subtype = event.get("subtype")
+    if subtype == "message_deleted":
+        return event["channel"], event["deleted_ts"], None
+    message = event["message"] if subtype == "message_changed" else event
+    if message.get("subtype") not in (None, "thread_broadcast") or "bot_id" in message or "user" not in message:
+        return None
+    fields = {key: message[key] for key in ("ts", "user", "text", "thread_ts") if key in message}
+    return event["channel"], message["ts"], fields
+
+
+class LiveIndexer:
+    def __init__(self, path, client, model=EMBEDDING_MODEL, batch_size=64, max_delay=2.0, max_pending=10000,
+                 metrics=None, cache=None, lexical_save_rows=1000):
+        self.path = path
+        self.client = client
+        self.model = model
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.metrics = metrics
+        self.cache = cache if cache is not None else open_cache()
+        self.lexical_save_rows = lexical_save_rows
+        os.makedirs(path, exist_ok=True)
+        self.store = EmbeddingStore(path) if os.path.exists(os.path.join(path, HEADER_FILE)) else None
+        # Only used from the indexing thread once the catch-up below is done
+        self.ids = sqlite3.connect(os.path.join(path, IDS_FILE), check_same_thread=False)
+        self.ids.execute("CREATE TABLE IF NOT EXISTS rows (channel TEXT NOT NULL, ts TEXT NOT NULL, "
+                         "row INTEGER NOT NULL, PRIMARY KEY (channel, ts))")
+        self._catch_up()
+        self.lexical = None
+        self.lexical_saved = 0
+        if self.store is not None:
+            self._update_lexical()
+        # (time received, operation) in arrival order
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        self.closing = False
+        if metrics:
+            metrics.describe("slackaskbot_live_index_rows_total", "Messages embedded into the live index")
+            metrics.describe("slackaskbot_live_index_tombstones_total", "Live index rows tombstoned by edits and deletes")
+            metrics.describe("slackaskbot_live_index_dropped_total", "Message events dropped because the queue was full")
+            metrics.describe("slackaskbot_live_index_pending", "Message events waiting to be indexed")
+            metrics.describe("slackaskbot_live_index_lag_seconds", "Time from receiving a message to it being searchable, for the last batch")
+        self.thread = threading.Thread(target=self._run, name="live-indexer", daemon=True)
+        self.thread.start()
+
+    def _catch_up(self):
+        """Map rows the store has but ids.sqlite doesn't, left by a process that died between the two writes."""
+        if self.store is None:
+            return
+        mapped = self.ids.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM rows").fetchone()[0]
+        if mapped >= len(self.store):
+            return
+        replaced = []
+        for row, record in zip(range(mapped, len(self.store)), self.store.records(range(mapped, len(self.store)))):
+            key = (record["channel"], record["messages"][0]["ts"])
+            previous = self.ids.execute("SELECT row FROM rows WHERE channel = ? AND ts = ?", key).fetchone()
+            if previous and previous[0] != row:
+                replaced.append(previous[0])
+            with self.ids:
+                self.ids.execute("INSERT OR REPLACE INTO rows VALUES (?, ?, ?)", key + (row,))
+        if replaced:
+            self.store.delete(replaced)
+        print(f"Live index: recovered {len(self.store) - mapped} rows written before the last shutdown")
+
+    def observe(self, body):
+        """Queue an event body's message for indexing, if it is one; called from the event handlers."""
+        operation = message_operation(body.get("event", {}))
+        if operation is None:
+            return
+        with self.condition:
+            if len(self.pending) >= self.max_pending:
+                self.pending.popleft()
+                if self.metrics:
+                    self.metrics.inc("slackaskbot_live_index_dropped_total")
+            self.pending.append((time.time(), operation))
+            self._set_pending()
+            self.condition.notify()
+
+    def _set_pending(self):
+        if self.metrics:
+            self.metrics.set("slackaskbot_live_index_pending", len(self.pending))
+
+    def _next_batch(self):
+        with self.condition:
+            while not self.pending and not self.closing:
+                self.condition.wait()
+            # Wait for a full batch, but no longer than max_delay after the oldest operation arrived
+            while len(self.pending) < self.batch_size and not self.closing:
+                remaining = self.pending[0][0] + self.max_delay - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+
+    def _run(self):
+        failures = 0
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            try:
+                self.apply([operation for _, operation in batch])
+            except Exception as e:
+                failures += 1
+                delay = min(60, 2 ** failures)
+                print(f"Live index: failed to index {len(batch)} message events ({e}); retrying in {delay}s")
+                with self.condition:
+                    self.pending.extendleft(reversed(batch))
+                    if self.closing:
+                        return
+                time.sleep(delay)
+                continue
+            failures = 0
+            if self.metrics:
+                self.metrics.set("slackaskbot_live_index_lag_seconds", round(time.time() - batch[0][0], 3))
+                with self.condition:
+                    self._set_pending()
+
+    def apply(self, operations):
+        """Apply (channel, ts, message or None) operations: append new text, tombstone what it replaces or deletes."""
+        # Only the last operation on a message counts, e.g. a message posted and edited within one batch
+        latest = {}
+        for channel, ts, message in operations:
+            latest[(channel, ts)] = message
+        adds = [(key, message) for key, message in latest.items() if message and message.get("text")]
+        replaced = []
+        for key in latest:
+            found = self.ids.execute("SELECT row FROM rows WHERE channel = ? AND ts = ?", key).fetchone()
+            if found:
+                replaced.append(found[0])
+        start = None
+        if adds:
+            embeddings = embed_texts(self.client, [message["text"] for _, message in adds], self.model, self.cache)
+            if self.store is None:
+                self.store = EmbeddingStore.create(self.path, dim=len(embeddings[0]), model=self.model)
+            start = len(self.store)
+            self.store.append(embeddings, [{"messages": [message], "channel": channel, "source": f"{channel}/{ts}"}
+                                           for (channel, ts), message in adds])
+        if replaced:
+            self.store.delete(replaced)
+        if adds:
+            self._update_lexical()
+        with self.ids:
+            self.ids.executemany("DELETE FROM rows WHERE channel = ? AND ts = ?", list(latest))
+            if adds:
+                self.ids.executemany("INSERT INTO rows VALUES (?, ?, ?)",
+                                     [key + (start + i,) for i, (key, _) in enumerate(adds)])
+        if self.metrics:
+            self.metrics.inc("slackaskbot_live_index_rows_total", value=len(adds))
+            self.metrics.inc("slackaskbot_live_index_tombstones_total", value=len(replaced))
+
+    def _update_lexical(self, save=False):
+        """Add the store's new rows to its BM25 index, and write the index once enough rows are waiting."""
+        if self.lexical is None:
+            self.lexical = open_lexical(self.store) or LexicalIndex.empty(index_path(self.store))
+            self.lexical_saved = len(self.lexical)
+        self.lexical.add_rows(self.store)
+        if len(self.lexical) > self.lexical_saved and (save or len(self.lexical) - self.lexical_saved >= self.lexical_save_rows):
+            self.lexical = self.lexical.save()
+            self.lexical_saved = len(self.lexical)
+
+    def close(self, timeout=10):
+        """Index what is still queued (for up to timeout seconds) and stop."""
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            print(f"Live index: gave up on {len(self.pending)} queued message events")
+        elif self.store is not None:
+            self._update_lexical(save=True)
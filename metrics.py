@@ -0,0 +1,67 @@
+"""
+Minimal Prometheus-style metrics for slackAskBot.py: counters and gauges kept in memory and served as text on
+http://<host>:METRICS_PORT/metrics when METRICS_PORT is set.
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted((labels or {}).items())))
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, labels=None, value=1):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                seen = set()
+                for (name, labels), value in sorted(values.items()):
+                    if name not in seen:
+                        if name in self.help:
+                            lines.append(f"# HELP {name} {self.help[name]}")
+                        lines.append(f"# TYPE {name} {kind}")
+                        seen.add(name)
+                    label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                    lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="0.0.0.0"):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                data = metrics.render().encode("utf-8")
+                self.send_response(200 if self.path.startswith("/metrics") else 404)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving metrics on port {port}")
+        return server
@@ -0,0 +1,131 @@
+"""
+Overload controller for slackAskBot.py.
+
+It watches two pressure signals over a sliding window:
+    queue delay        how long requests wait for a free request slot (including any still waiting now)
+    upstream latency   the average duration of OpenAI calls
+and degrades service in steps once either passes its threshold for the next level:
+    0 normal           GPT-3.5 answer, GPT-4 review, tool calls
+    1 no_review        skip the GPT-4 review
+    2 no_tools         also stop offering tools to the model
+    3 capped_tokens    also cap max_tokens
+    4 reject           answer straight away with a short "busy" reply
+Levels go up as soon as pressure crosses a threshold, and come back down one step at a time once pressure has
+stayed below recovery_ratio x the current level's thresholds for `cooldown` seconds.  Every transition is logged
+and counted in the metrics (see metrics.py).
+"""
+
+import collections
+import itertools
+import threading
+import time
+
+NORMAL, NO_REVIEW, NO_TOOLS, CAPPED_TOKENS, REJECT = range(5)
+LEVEL_NAMES = ["normal", "no_review", "no_tools", "capped_tokens", "reject"]
+
+
+def parse_thresholds(text):
+    thresholds = [float(t) for t in text.split(",")]
+    if len(thresholds) != REJECT:
+        raise ValueError(f"Expected {REJECT} comma-separated thresholds, got {text!r}")
+    return thresholds
+
+
+class OverloadController:
+    def __init__(self, queue_delay_thresholds, latency_thresholds, recovery_ratio=0.7, cooldown=30, window=60,
+                 metrics=None):
+        self.queue_delay_thresholds = queue_delay_thresholds
+        self.latency_thresholds = latency_thresholds
+        self.recovery_ratio = recovery_ratio
+        self.cooldown = cooldown
+        self.window = window
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.level = NORMAL
+        self.calm_since = None
+        self.queue_delays = collections.deque()
+        self.latencies = collections.deque()
+        self.waiting = {}
+        self.tickets = itertools.count(1)
+        if metrics:
+            metrics.describe("slackaskbot_overload_level", "Current degradation level (0 normal .. 4 reject)")
+            metrics.describe("slackaskbot_overload_transitions_total", "Degradation level changes")
+            metrics.describe("slackaskbot_queue_delay_seconds", "Queue delay signal used by the overload controller")
+            metrics.describe("slackaskbot_upstream_latency_seconds", "Average OpenAI call duration over the window")
+            metrics.set("slackaskbot_overload_level", NORMAL)
+
+    def queued(self):
+        """Call when a request starts waiting for a slot; pass the returned ticket to started()."""
+        with self.lock:
+            ticket = next(self.tickets)
+            self.waiting[ticket] = time.monotonic()
+        return ticket
+
+    def started(self, ticket):
+        with self.lock:
+            queued_at = self.waiting.pop(ticket, time.monotonic())
+            self.queue_delays.append((time.monotonic(), time.monotonic() - queued_at))
+        self.update()
+
+    def record_upstream_latency(self, seconds):
+        with self.lock:
+            self.latencies.append((time.monotonic(), seconds))
+        self.update()
+
+    def signals(self):
+        """Current (queue delay, upstream latency) in seconds."""
+        now = time.monotonic()
+        with self.lock:
+            for samples in (self.queue_delays, self.latencies):
+                while samples and samples[0][0] < now - self.window:
+                    samples.popleft()
+            # A stalled queue shows up in the age of the oldest waiting request before anything finishes waiting
+            oldest_waiting = now - min(self.waiting.values()) if self.waiting else 0.0
+            delays = sorted(d for _, d in self.queue_delays)
+            p90_delay = delays[int(0.9 * (len(delays) - 1))] if delays else 0.0
+            latency = sum(l for _, l in self.latencies) / len(self.latencies) if self.latencies else 0.0
+        return max(p90_delay, oldest_waiting), latency
+
+    def pressure_level(self, queue_delay, latency):
+        level = NORMAL
+        for i in range(REJECT):
+            if queue_delay >= self.queue_delay_thresholds[i] or latency >= self.latency_thresholds[i]:
+                level = i + 1
+        return level
+
+    def update(self):
+        queue_delay, latency = self.signals()
+        if self.metrics:
+            self.metrics.set("slackaskbot_queue_delay_seconds", round(queue_delay, 3))
+            self.metrics.set("slackaskbot_upstream_latency_seconds", round(latency, 3))
+        target = self.pressure_level(queue_delay, latency)
+        with self.lock:
+            current = self.level
+            if target > current:
+                self._transition(current, target, queue_delay, latency)
+                return
+            threshold_index = current - 1
+            calm = current > NORMAL and \
+                queue_delay < self.queue_delay_thresholds[threshold_index] * self.recovery_ratio and \
+                latency < self.latency_thresholds[threshold_index] * self.recovery_ratio
+            if not calm:
+                self.calm_since = None
+            elif self.calm_since is None:
+                self.calm_since = time.monotonic()
+            elif time.monotonic() - self.calm_since >= self.cooldown:
+                self._transition(current, current - 1, queue_delay, latency)
+
+    def _transition(self, old, new, queue_delay, latency):
+        # Called with self.lock held
+        self.level = new
+        self.calm_since = None
+        print(f"Overload level {LEVEL_NAMES[old]} -> {LEVEL_NAMES[new]} "
+              f"(queue delay {queue_delay:.1f}s, upstream latency {latency:.1f}s)")
+        if self.metrics:
+            self.metrics.inc("slackaskbot_overload_transitions_total", {"from": LEVEL_NAMES[old], "to": LEVEL_NAMES[new]})
+            self.metrics.set("slackaskbot_overload_level", new)
+
+    def current_level(self):
+        # Re-evaluate on read so recovery happens even when no upstream calls are completing
+        self.update()
+        return self.level
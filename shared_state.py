@@ -0,0 +1,79 @@
+"""
+State shared between slackAskBot.py processes, kept in a local SQLite database.
+
+In supervisor mode (python slackAskBot.py --workers N) every worker opens the same database file, so event
+de-duplication, rate limits, the Slack metadata cache (bot user ID, channel and user names) and per-worker load
+reports are consistent across processes.  A single-process bot uses an in-memory database with the same interface.
+"""
+
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS seen_events (event_id TEXT PRIMARY KEY, seen_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS rate_limits (key TEXT NOT NULL, window_start INTEGER NOT NULL, count INTEGER NOT NULL,
+                                        PRIMARY KEY (key, window_start));
+CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS worker_load (worker INTEGER PRIMARY KEY, pid INTEGER, in_flight INTEGER, handled INTEGER,
+                                        updated_at REAL);
+"""
+
+
+class SharedStore:
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self.lock = threading.Lock()
+        # One connection per process, shared by its threads under self.lock
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        if path != ":memory:":
+            # WAL lets workers read while another process writes
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            return self.connection.execute(sql, params)
+
+    def claim_event(self, event_id, retention=3600):
+        """Return True the first time an event ID is seen, False for Slack's retries of the same event."""
+        now = time.time()
+        with self.lock:
+            cursor = self.connection.execute("INSERT OR IGNORE INTO seen_events VALUES (?, ?)", (event_id, now))
+            claimed = cursor.rowcount == 1
+            if claimed and int(now) % 60 == 0:
+                # Occasionally forget old events so the table doesn't grow forever
+                self.connection.execute("DELETE FROM seen_events WHERE seen_at < ?", (now - retention,))
+        return claimed
+
+    def allow(self, key, limit, window=60):
+        """Fixed-window rate limit shared by all processes: True if this call is within `limit` per `window` seconds."""
+        window_start = int(time.time()) // window * window
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute("SELECT count FROM rate_limits WHERE key = ? AND window_start = ?",
+                                              (key, window_start)).fetchone()
+                count = row[0] if row else 0
+                if count >= limit:
+                    return False
+                self.connection.execute("INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?)", (key, window_start, count + 1))
+                self.connection.execute("DELETE FROM rate_limits WHERE window_start < ?", (window_start - window,))
+                return True
+            finally:
+                self.connection.execute("COMMIT")
+
+    def get_metadata(self, key):
+        row = self._execute("SELECT value FROM metadata WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set_metadata(self, key, value, ttl=3600):
+        self._execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?)", (key, value, time.time() + ttl))
+
+    def report_worker_load(self, worker, pid, in_flight, handled):
+        self._execute("INSERT OR REPLACE INTO worker_load VALUES (?, ?, ?, ?, ?)", (worker, pid, in_flight, handled, time.time()))
+
+    def worker_loads(self):
+        rows = self._execute("SELECT worker, pid, in_flight, handled, updated_at FROM worker_load ORDER BY worker").fetchall()
+        return [dict(zip(("worker", "pid", "in_flight", "handled", "updated_at"), row)) for row in rows]
@@ -1,18 +1,38 @@
 import os
 import re
 import json
+import argparse
+import itertools
 
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
+from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 from openai import OpenAI
 
 import threading
 import subprocess
+import time
+import signal
+
+from event_trace import TracingWebClient, open_trace_writer
+from metrics import Metrics
+from overload import CAPPED_TOKENS, LEVEL_NAMES, NO_REVIEW, NO_TOOLS, REJECT, OverloadController, parse_thresholds
+from shared_state import SharedStore
+from supervisor import Supervisor
+
+# Optionally record incoming events and upstream latencies for replay (see event_trace.py)
+trace_writer = open_trace_writer()
 
 # Install the Slack app and get xoxb- token in advance
+# SLACK_API_URL can point the bot at a different Web API (e.g. the fake Slack server in benchmarks/);
+# OPENAI_BASE_URL is picked up by the OpenAI client in the same way.
+slack_client_options = dict(
+    token=os.environ["SLACK_BOT_TOKEN"],
+    base_url=os.environ.get("SLACK_API_URL", WebClient.BASE_URL)
+)
 app = App(
-    token=os.environ["SLACK_BOT_TOKEN"]
+    client=TracingWebClient(trace_writer, **slack_client_options) if trace_writer else WebClient(**slack_client_options)
 )
 
 # Load the channel configuration
@@ -39,7 +59,131 @@ def load_functions_config():
 
 functions_config = load_functions_config()
 
+# State shared with other worker processes in supervisor mode (see shared_state.py); in-memory otherwise
+shared_store = SharedStore(os.environ.get("SHARED_STATE_DB", ":memory:"))
+
+# Optional per-user limit on questions per minute, enforced across all worker processes
+user_rate_limit = int(os.environ.get("USER_RATE_LIMIT_PER_MINUTE", "0"))
+
+# Requests that haven't finished yet, so a shutdown can wait for them or tidy up after them
+active_requests = {}
+active_requests_lock = threading.Lock()
+request_ids = itertools.count(1)
+
+# Set on SIGTERM: no new questions are started while in-flight ones finish
+draining = False
+
+# Seconds a shutdown waits for in-flight requests before giving up on them
+drain_timeout = float(os.environ.get("DRAIN_TIMEOUT", "120"))
+
+# Counters and gauges served on METRICS_PORT (see metrics.py)
+metrics = Metrics()
+metrics.describe("slackaskbot_requests_in_flight", "Questions currently being answered")
+metrics.describe("slackaskbot_requests_rejected_total", "Questions turned away with the busy reply")
+metrics_port = int(os.environ.get("METRICS_PORT", "0"))
+
+# At most this many requests run their model calls at once; the rest wait, and that wait is the queue delay
+request_slots = threading.BoundedSemaphore(int(os.environ.get("MAX_CONCURRENT_REQUESTS", "16")))
+
+# Degrade service step by step when requests queue up or OpenAI slows down (see overload.py)
+overload = OverloadController(
+    queue_delay_thresholds=parse_thresholds(os.environ.get("OVERLOAD_QUEUE_DELAY", "5,15,30,60")),
+    latency_thresholds=parse_thresholds(os.environ.get("OVERLOAD_UPSTREAM_LATENCY", "30,45,60,90")),
+    cooldown=float(os.environ.get("OVERLOAD_COOLDOWN", "30")),
+    metrics=metrics
+)
+overload_max_tokens = int(os.environ.get("OVERLOAD_MAX_TOKENS", "500"))
+busy_message = "I'm getting a lot of questions right now. Please try again in a few minutes."
+
+# Optionally embed public channel messages as they arrive into a local search index (see live_index.py)
+live_index_dir = os.environ.get("LIVE_INDEX_DIR")
+live_indexer = None
+
+def start_live_indexer():
+    # Imported here so the index's dependencies (numpy) are only needed when it's enabled
+    from live_index import LiveIndexer
+    print(f"Indexing public channel messages into {live_index_dir}")
+    return LiveIndexer(live_index_dir, OpenAI(api_key=os.environ["OPENAI_API_KEY"]),
+                       batch_size=int(os.environ.get("LIVE_INDEX_BATCH", "64")),
+                       max_delay=float(os.environ.get("LIVE_INDEX_MAX_DELAY", "2")),
+                       max_pending=int(os.environ.get("LIVE_INDEX_MAX_PENDING", "10000")),
+                       metrics=metrics)
+
+# Embedding stores searched in-process by the built-in search_workspace tool (see workspace_search.py): exports built
+# with unused/pipeline.py, listed in WORKSPACE_SEARCH_STORES, plus the live index
+workspace_search_dirs = [path for path in os.environ.get("WORKSPACE_SEARCH_STORES", "").split(",") if path]
+if live_index_dir:
+    workspace_search_dirs.append(live_index_dir)
+workspace_search_results = int(os.environ.get("WORKSPACE_SEARCH_RESULTS", "5"))
+workspace_search_max_tokens = int(os.environ.get("WORKSPACE_SEARCH_MAX_TOKENS", "3000"))
+WORKSPACE_SEARCH_TOOL = "search_workspace"
+
+def open_workspace_search():
+    # Loaded once at startup, before supervisor mode forks, so workers share the resident indexes
+    from workspace_search import WorkspaceSearch
+    from lexical_index import fusion_settings
+    # Vector results are fused with BM25 keyword matches unless SEARCH_FUSION is off (see unused/lexical_index.py)
+    fusion, lexical_weight = fusion_settings()
+    search = WorkspaceSearch(workspace_search_dirs, OpenAI(api_key=os.environ["OPENAI_API_KEY"]), fusion=fusion,
+                             lexical_weight=lexical_weight,
+                             candidates=int(os.environ.get("SEARCH_FUSION_CANDIDATES", "50")))
+    search.warm()
+    print(f"Workspace search over {', '.join(workspace_search_dirs)}")
+    return search
+
+workspace_search = open_workspace_search() if workspace_search_dirs else None
+
+def token_limit(max_tokens, level):
+    return min(max_tokens, overload_max_tokens) if level >= CAPPED_TOKENS else max_tokens
+
+def get_in_flight_requests():
+    return len(active_requests)
+
+def start_request(channel_id, thread_ts):
+    request = {"channel_id": channel_id, "thread_ts": thread_ts, "status_ts": None, "transient_ts": []}
+    with active_requests_lock:
+        active_requests[next(request_ids)] = request
+        metrics.set("slackaskbot_requests_in_flight", len(active_requests))
+    return request
+
+def finish_request(request):
+    with active_requests_lock:
+        for request_id, active in list(active_requests.items()):
+            if active is request:
+                del active_requests[request_id]
+        metrics.set("slackaskbot_requests_in_flight", len(active_requests))
+
+def get_bot_user_id():
+    # The bot's user ID never changes, so look it up once and share it instead of calling auth.test per message
+    bot_user_id = shared_store.get_metadata("bot_user_id")
+    if bot_user_id is None:
+        bot_user_id = app.client.auth_test()["user_id"]
+        shared_store.set_metadata("bot_user_id", bot_user_id, ttl=86400)
+    return bot_user_id
+
 def ask_chatgpt(text, user_id, channel_id, thread_ts=None, ts=None):
+    if user_rate_limit and not shared_store.allow(f"user:{user_id}", user_rate_limit):
+        print(f"User {user_id} is over the limit of {user_rate_limit} questions per minute")
+        post_message_to_slack(channel_id, "You're asking questions faster than I can answer them. Please try again in a minute.", thread_ts)
+        return
+    if draining:
+        print(f"Not starting a new request in {channel_id}: shutting down")
+        return
+    if overload.current_level() >= REJECT:
+        print(f"Rejecting request in {channel_id}: overloaded")
+        metrics.inc("slackaskbot_requests_rejected_total")
+        post_message_to_slack(channel_id, busy_message, thread_ts)
+        return
+
+    # Register the request before doing anything slow, so a shutdown waits for it
+    request = start_request(channel_id, thread_ts)
+    try:
+        start_answer(request, text, user_id, channel_id, thread_ts, ts)
+    except Exception:
+        finish_request(request)
+        raise
+
+def start_answer(request, text, user_id, channel_id, thread_ts=None, ts=None):
     # Remove any @mentions from the query
     text = re.sub(r'<@\w+>', '', text)
 
@@ -59,7 +203,7 @@ def ask_chatgpt(text, user_id, channel_id, thread_ts=None, ts=None):
     print(f"Using please_wait_message: '{please_wait_message}' for channel/user name: {channel_name}")
 
     # Get the bot's user ID
-    bot_user_id = app.client.auth_test()["user_id"]
+    bot_user_id = get_bot_user_id()
 
     # Construct the conversation history
     conversation_history = construct_conversation_history(messages, bot_user_id, user_id, text, thread_ts, ts)
@@ -67,24 +211,44 @@ def ask_chatgpt(text, user_id, channel_id, thread_ts=None, ts=None):
 
     # Send a message to indicate that GPT-4 is working on the request and capture the timestamp
     status_message_ts = post_message_to_slack(channel_id, please_wait_message, thread_ts)
+    request["status_ts"] = status_message_ts
+
+    ticket = overload.queued()
 
     def worker():
+        try:
+            # Wait for a free slot; the overload controller watches how long this takes
+            with request_slots:
+                overload.started(ticket)
+                answer_question(overload.current_level())
+        finally:
+            finish_request(request)
+
+    def answer_question(level):
         initial_header_ts = None
         initial_response_ts = None
         initial_footer_ts = None
         initial_status_ts = None
+        allow_tools = level < NO_TOOLS
 
         # Generate initial response with GPT-3.5-turbo
         #print(conversation_history)
         try:
-            initial_response, initial_status_ts = gpt(conversation_history, system_prompt, model="gpt-3.5-turbo-16k", max_tokens=1000, channel_id=channel_id, thread_ts=thread_ts)
+            initial_response, initial_status_ts = gpt(conversation_history, system_prompt, model="gpt-3.5-turbo-16k", max_tokens=token_limit(1000, level), channel_id=channel_id, thread_ts=thread_ts, allow_tools=allow_tools)
             # Modify the markdown to strip out the language specifier after the triple backticks
             initial_response = re.sub(r'```[a-zA-Z]+', '```', initial_response)
             print(initial_response)
+            if level >= NO_REVIEW:
+                # Under load the GPT-3.5-turbo response is the final answer: skip the GPT-4 review
+                print(f"Skipping the GPT-4 review (overload level: {LEVEL_NAMES[level]})")
+                post_message_to_slack(channel_id, initial_response, thread_ts)
+                delete_message_from_slack(channel_id, status_message_ts)
+                return
             # Post the GPT-3.5-turbo response and save its timestamp
             initial_header_ts = post_message_to_slack(channel_id, "Initial GPT-3.5-Turbo response:", thread_ts)
             initial_response_ts = post_message_to_slack(channel_id, f"{initial_response}", thread_ts)
             initial_footer_ts = post_message_to_slack(channel_id, "Checking that with GPT-4...", thread_ts)
+            request["transient_ts"] += [initial_header_ts, initial_footer_ts]
             # Append the initial GPT-3.5-turbo response to the conversation history
             conversation_history.append({"role": "assistant", "content": f"GPT-3.5 response: {initial_response}"})
 
@@ -96,7 +260,7 @@ def ask_chatgpt(text, user_id, channel_id, thread_ts=None, ts=None):
         #print(conversation_history)
 
         # Enhance response with GPT-4-Turbo
-        enhanced_response, enhanced_response_ts = gpt(conversation_history, system_prompt, model="gpt-4-turbo-preview", channel_id=channel_id, thread_ts=thread_ts)
+        enhanced_response, enhanced_response_ts = gpt(conversation_history, system_prompt, model="gpt-4-turbo-preview", max_tokens=token_limit(3000, level), channel_id=channel_id, thread_ts=thread_ts, allow_tools=allow_tools)
         # Modify the markdown to strip out the language specifier after the triple backticks
         enhanced_response = re.sub(r'```[a-zA-Z]+', '```', enhanced_response)
         print(enhanced_response)
@@ -130,10 +294,31 @@ def ask_chatgpt(text, user_id, channel_id, thread_ts=None, ts=None):
             delete_message_from_slack(channel_id, initial_header_ts)
         delete_message_from_slack(channel_id, status_message_ts)
 
-    # Start the worker thread
-    thread = threading.Thread(target=worker)
+    # Start the worker thread (a daemon, so shutdown is governed by drain() rather than by stray threads)
+    thread = threading.Thread(target=worker, daemon=True)
     thread.start()
 
+def drain(timeout=None):
+    """Wait up to `timeout` seconds for in-flight requests, then tidy up the status messages of any left over."""
+    global draining
+    draining = True
+    timeout = drain_timeout if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    print(f"Draining {len(active_requests)} in-flight requests (up to {timeout:.0f}s)")
+    while active_requests and time.monotonic() < deadline:
+        time.sleep(0.5)
+    with active_requests_lock:
+        leftovers = list(active_requests.values())
+    for request in leftovers:
+        # Don't leave "please wait" or "Checking that with GPT-4..." messages behind with no answer coming
+        for ts in request["transient_ts"]:
+            if ts:
+                delete_message_from_slack(request["channel_id"], ts)
+        if request["status_ts"]:
+            update_message_in_slack(request["channel_id"], request["status_ts"],
+                                    "Sorry, I was restarted before I could finish answering. Please ask again.")
+    print(f"Drain complete: {len(leftovers)} requests did not finish in time")
+
 def fetch_conversation_history(channel_id, thread_ts):
     try:
         history = app.client.conversations_replies(channel=channel_id, ts=thread_ts)
@@ -153,6 +338,16 @@ def handle_slack_api_error(e):
     return False  # Indicate that the error was not handled and should be re-raised
 
 def determine_channel_or_user_name(channel_id, user_id):
+    # Channel and user names rarely change, so cache them rather than calling the Slack API for every question
+    cache_key = f"name:{channel_id}:{user_id}"
+    name = shared_store.get_metadata(cache_key)
+    if name is None:
+        name = lookup_channel_or_user_name(channel_id, user_id)
+        if name:
+            shared_store.set_metadata(cache_key, name)
+    return name
+
+def lookup_channel_or_user_name(channel_id, user_id):
     try:
         channel_info = app.client.conversations_info(channel=channel_id)
         is_direct_message = channel_info['channel'].get('is_im', False)
@@ -219,6 +414,12 @@ def post_message_to_slack(channel_id, text, thread_ts=None):
         print(f"Failed to post message to Slack: {e}")
         return None
 
+def update_message_in_slack(channel_id, ts, text):
+    try:
+        app.client.chat_update(channel=channel_id, ts=ts, text=text)
+    except Exception as e:
+        print(f"Failed to update message in Slack: {e}")
+
 def delete_message_from_slack(channel_id, ts):
     try:
         app.client.chat_delete(channel=channel_id, ts=ts)
@@ -228,6 +429,10 @@ def delete_message_from_slack(channel_id, ts):
 @app.event("message")
 def handle_message_events(body, logger):
     logger.info(body)
+    if trace_writer:
+        trace_writer.record_event(body)
+    if live_indexer:
+        live_indexer.observe(body)
     # Extract the event object from the body
     event = body["event"]
 
@@ -252,7 +457,7 @@ def handle_message_events(body, logger):
                 ts=thread_ts
             )
             messages = thread_history['messages']
-            bot_user_id = app.client.auth_test()["user_id"]  # Get the bot's user ID
+            bot_user_id = get_bot_user_id()  # Get the bot's user ID
             if any(f"<@{bot_user_id}>" in msg.get("text", "") for msg in messages if msg.get("ts") == thread_ts):
                 ask_chatgpt(text, user_id, channel_id, thread_ts, ts)
             elif event["channel_type"] == "im":
@@ -269,6 +474,8 @@ def handle_message_events(body, logger):
 @app.event("app_mention")
 def handle_app_mention_events(body, logger):
     logger.info(body)
+    if trace_writer:
+        trace_writer.record_event(body)
     # Extract the event object from the body
     event = body["event"]
     # Get the user ID of the sender
@@ -289,7 +496,7 @@ def handle_app_mention_events(body, logger):
             ts=thread_ts
         )
         messages = thread_history['messages']
-        bot_user_id = app.client.auth_test()["user_id"]  # Get the bot's user ID
+        bot_user_id = get_bot_user_id()  # Get the bot's user ID
         if any(f"<@{bot_user_id}>" in msg.get("text", "") for msg in messages):
             ask_chatgpt(text, user_id, channel_id, thread_ts)
         else:
@@ -315,7 +522,7 @@ def app_home_opened(ack, event, logger):
     )
     logger.info(response)
 
-def gpt(conversation_history, system_prompt, channel_id, thread_ts=None, model="gpt-4-turbo-preview", max_tokens=3000, temperature=0):
+def gpt(conversation_history, system_prompt, channel_id, thread_ts=None, model="gpt-4-turbo-preview", max_tokens=3000, temperature=0, allow_tools=True):
     api_key = os.environ["OPENAI_API_KEY"]
     client = OpenAI(api_key=api_key)
 
@@ -325,8 +532,8 @@ def gpt(conversation_history, system_prompt, channel_id, thread_ts=None, model="
     }
     conversation_history_with_system_message = [system_message] + conversation_history
 
-    # Convert functions_config to tools parameter only if functions_config is not empty
-    tools_parameter = convert_functions_config_to_tools_parameter(functions_config) if functions_config else None
+    # Convert functions_config (plus any built-in tools) to the tools parameter, unless we're shedding load
+    tools_parameter = convert_functions_config_to_tools_parameter(functions_config) if allow_tools else None
 
     # Prepare the request payload, conditionally including 'tools' if tools_parameter is not None
     request_payload = {
@@ -338,7 +545,11 @@ def gpt(conversation_history, system_prompt, channel_id, thread_ts=None, model="
     if tools_parameter:
         request_payload["tools"] = tools_parameter
 
+    started = time.monotonic()
     response = client.chat.completions.create(**request_payload)
+    overload.record_upstream_latency(time.monotonic() - started)
+    if trace_writer:
+        trace_writer.record_latency("openai", model, time.monotonic() - started)
 
     # Debugging: Print the entire GPT response
     print("GPT Response:", response)
@@ -351,7 +562,7 @@ def gpt(conversation_history, system_prompt, channel_id, thread_ts=None, model="
         for tool_call in tool_calls:
             function_name = tool_call.function.name
             arguments = json.loads(tool_call.function.arguments)
-            answer, status_ts = handle_function_call(function_name=function_name, arguments=arguments, conversation_history=conversation_history, model=model, channel_id=channel_id, thread_ts=thread_ts)
+            answer, status_ts = handle_function_call(function_name=function_name, arguments=arguments, conversation_history=conversation_history, model=model, channel_id=channel_id, thread_ts=thread_ts, system_prompt=system_prompt, max_tokens=max_tokens)
             answers += answer
         answer = answers
     else:
@@ -385,15 +596,32 @@ def convert_functions_config_to_tools_parameter(functions_config):
 
         tools.append(tool_def)
 
+    # A search_workspace helper configured in functions.json takes precedence over the built-in one
+    if workspace_search and not any(func["name"] == WORKSPACE_SEARCH_TOOL for func in functions_config):
+        tools.append({
+            "type": "function",
+            "function": {
+                "name": WORKSPACE_SEARCH_TOOL,
+                "description": "Search the Slack workspace for messages relevant to a question.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {"question": {"type": "string", "description": "The question"}},
+                    "required": ["question"],
+                },
+            },
+        })
+
     return tools
 
-def handle_function_call(function_name, arguments, channel_id, thread_ts=None, conversation_history={}, model="gpt-3.5-turbo-16k"):
+def handle_function_call(function_name, arguments, channel_id, thread_ts=None, conversation_history={}, model="gpt-3.5-turbo-16k", system_prompt="", max_tokens=3000):
     # Find the helper program path from functions_config
     for func in functions_config:
         if func["name"] == function_name:
             helper_program_path = func.get("helper_program")
             break
     else:
+        if function_name == WORKSPACE_SEARCH_TOOL and workspace_search:
+            return search_workspace(arguments, channel_id, thread_ts, conversation_history, model, system_prompt, max_tokens)
         print(f"No helper program configured for function: {function_name}")
         return "No helper program configured for this function.", None
 
@@ -433,9 +661,110 @@ def handle_function_call(function_name, arguments, channel_id, thread_ts=None, c
         error_message = "Unexpected error when executing the helper program."
         return error_message, status_ts
 
+def search_workspace(arguments, channel_id, thread_ts=None, conversation_history=[], model="gpt-3.5-turbo-16k", system_prompt="", max_tokens=3000):
+    """The built-in search_workspace tool: search the resident indexes, then answer from what was found."""
+    from workspace_search import format_results
+    question = arguments.get("question", "")
+    status_ts = post_message_to_slack(channel_id, f'Searching the workspace for "{question}" with {model}', thread_ts)
+    started = time.monotonic()
+    try:
+        results = workspace_search.search(question, workspace_search_results)
+    except Exception as e:
+        print(f"Workspace search failed: {e}")
+        return "Sorry, I couldn't search the workspace just now.", status_ts
+    print(f"Workspace search found {len(results)} results in {time.monotonic() - started:.3f}s")
+    context = format_results(results, workspace_search_max_tokens, model) if results else "(no matching messages)"
+    search_message = {
+        "role": "system",
+        "content": f'Messages found by searching this Slack workspace for "{question}":\n\n{context}\n\n'
+                   "Answer using these messages, quoting the ones that support the answer. "
+                   "If they aren't relevant to the question, say so."
+    }
+    answer, _ = gpt(conversation_history + [search_message], system_prompt, channel_id, thread_ts, model=model, max_tokens=max_tokens, allow_tools=False)
+    return answer, status_ts
+
+def init_worker(index, shared_store_path):
+    # Runs in each forked worker: SQLite connections can't be shared across processes, so reopen the store
+    global shared_store
+    shared_store = SharedStore(shared_store_path)
+    if trace_writer:
+        # Workers can't share the supervisor's gzip stream, so each records to a file of its own
+        trace_writer.open_worker_file(index)
+    if metrics_port:
+        # The supervisor's own port stays free; worker N serves metrics on METRICS_PORT + 1 + N
+        metrics.serve(metrics_port + 1 + index)
+
+def take_over_from(pidfile):
+    """Hand-off: once our own Socket Mode connection is open, ask the process in the pidfile to drain and exit."""
+    try:
+        with open(pidfile) as f:
+            old_pid = int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        old_pid = None
+    if old_pid and old_pid != os.getpid():
+        try:
+            os.kill(old_pid, signal.SIGTERM)
+            print(f"Connected; asked the previous bot process ({old_pid}) to drain and exit")
+        except ProcessLookupError:
+            print(f"Previous bot process {old_pid} is not running")
+    with open(pidfile, "w") as f:
+        f.write(str(os.getpid()))
+
+def wait_for_shutdown_signal():
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: stop.set())
+    while not stop.wait(1):
+        pass
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Slack bot that answers questions with GPT-3.5-turbo and GPT-4")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("BOT_WORKERS", "1")),
+                        help="Number of worker processes; more than 1 runs a supervisor that routes events by channel/thread")
+    parser.add_argument("--shared-state-db", default=os.environ.get("SHARED_STATE_DB", "slackAskBot_state.db"),
+                        help="SQLite file for state shared between worker processes")
+    parser.add_argument("--pidfile", help="Write this process's PID here; with --handoff, the PID of the process to replace")
+    parser.add_argument("--handoff", action="store_true",
+                        help="Zero-downtime restart: connect first, then tell the process in --pidfile to drain and exit")
+    parser.add_argument("--drain-timeout", type=float, default=drain_timeout,
+                        help="Seconds to let in-flight requests finish after SIGTERM")
+    args = parser.parse_args()
+    drain_timeout = args.drain_timeout
+
     # Turn on INFO logging to see what's happening
     import logging
     logging.basicConfig(level=logging.INFO)
     # Start the app
-    SocketModeHandler(app, os.environ["SLACK_APP_TOKEN"]).start()
+    def on_connected():
+        if args.handoff and args.pidfile:
+            take_over_from(args.pidfile)
+        elif args.pidfile:
+            with open(args.pidfile, "w") as f:
+                f.write(str(os.getpid()))
+
+    if args.workers > 1:
+        # The supervisor sees every event once, so it does the indexing; workers never get an indexer
+        indexer = start_live_indexer() if live_index_dir else None
+        if indexer and metrics_port:
+            metrics.serve(metrics_port)
+        Supervisor(app, os.environ["SLACK_APP_TOKEN"], args.workers, args.shared_state_db, get_in_flight_requests,
+                   on_worker_start=init_worker, on_worker_drain=drain, on_connected=on_connected,
+                   on_event=indexer.observe if indexer else None, drain_timeout=drain_timeout).run()
+        if indexer:
+            indexer.close()
+    else:
+        if metrics_port:
+            metrics.serve(metrics_port)
+        if live_index_dir:
+            live_indexer = start_live_indexer()
+        handler = SocketModeHandler(app, os.environ["SLACK_APP_TOKEN"])
+        handler.connect()
+        on_connected()
+        wait_for_shutdown_signal()
+        # Stop receiving new events, let in-flight answers finish, then exit
+        print("Shutting down: closing the Socket Mode connection")
+        draining = True
+        handler.close()
+        drain()
+        if live_indexer:
+            live_indexer.close()
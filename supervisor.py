@@ -0,0 +1,187 @@
+"""
+Supervisor mode for slackAskBot.py: one process holds the Socket Mode connection and fans events out to N worker
+processes, so JSON parsing, tiktoken and regex work in the handlers no longer contend on a single GIL.
+
+Events are routed by consistent hashing of channel + thread, so every event for a thread lands on the same worker
+(keeping per-thread ordering and any in-process caches local).  The supervisor acks each envelope as soon as it
+arrives, drops Slack's retries of events it has already routed, restarts workers that die, and periodically
+prints per-worker load.  Shared state lives in the SQLite database described in shared_state.py.
+
+On SIGTERM the supervisor closes its Socket Mode connection, tells each worker to finish its queue and drain its
+in-flight requests, and waits for them (up to the drain timeout) before exiting.
+"""
+
+import bisect
+import hashlib
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+
+from slack_bolt.request import BoltRequest
+from slack_sdk.socket_mode.builtin import SocketModeClient
+from slack_sdk.socket_mode.response import SocketModeResponse
+
+from shared_state import SharedStore
+
+
+class HashRing:
+    """Consistent hash ring with virtual nodes, so keys spread evenly and stay put when the ring is rebuilt."""
+
+    def __init__(self, nodes, replicas=100):
+        self.ring = sorted((self._hash(f"{node}:{i}"), node) for node in nodes for i in range(replicas))
+        self.hashes = [h for h, _ in self.ring]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    def node_for(self, key):
+        index = bisect.bisect(self.hashes, self._hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+
+def route_key(body):
+    """Channel + thread for message-like events, so a whole thread is handled by one worker."""
+    event = body.get("event") or {}
+    channel = event.get("channel") or event.get("user") or ""
+    thread = event.get("thread_ts") or event.get("ts") or ""
+    return f"{channel}:{thread}"
+
+
+def worker_main(index, app, event_queue, shared_store_path, get_in_flight, on_start=None, on_drain=None):
+    """Worker process loop: dispatch routed event bodies through the Bolt app and report load."""
+    # Shutdown is coordinated by the supervisor (a None on the queue), not by signals sent to the process group
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if on_start:
+        on_start(index, shared_store_path)
+    # SQLite connections can't cross a fork, so each worker opens its own
+    store = SharedStore(shared_store_path)
+    handled = 0
+    last_report = 0
+    print(f"Worker {index} started (pid {os.getpid()})")
+    while True:
+        try:
+            body = event_queue.get(timeout=1)
+        except queue.Empty:
+            body = False
+        if body is None:
+            # Everything routed to us before the sentinel has been dispatched; let in-flight requests finish
+            print(f"Worker {index} draining")
+            if on_drain:
+                on_drain()
+            store.report_worker_load(index, os.getpid(), get_in_flight(), handled)
+            return
+        if body:
+            # Listeners run on Bolt's thread pool, so this returns as soon as the event is accepted
+            app.dispatch(BoltRequest(body=body, mode="socket_mode"))
+            handled += 1
+        if time.monotonic() - last_report > 2:
+            store.report_worker_load(index, os.getpid(), get_in_flight(), handled)
+            last_report = time.monotonic()
+
+
+class Supervisor:
+    def __init__(self, app, app_token, num_workers, shared_store_path, get_in_flight, on_worker_start=None,
+                 on_worker_drain=None, on_connected=None, on_event=None, drain_timeout=120, status_interval=30):
+        self.app = app
+        self.app_token = app_token
+        self.num_workers = num_workers
+        self.shared_store_path = shared_store_path
+        self.store = SharedStore(shared_store_path)
+        self.get_in_flight = get_in_flight
+        self.on_worker_start = on_worker_start
+        self.on_worker_drain = on_worker_drain
+        self.on_connected = on_connected
+        # Called in the supervisor with every new event body, before it is routed to a worker
+        self.on_event = on_event
+        self.drain_timeout = drain_timeout
+        self.stopping = threading.Event()
+        self.status_interval = status_interval
+        # Workers are forked so they inherit the already-configured Bolt app and its listeners
+        self.context = multiprocessing.get_context("fork")
+        self.queues = [self.context.Queue() for _ in range(num_workers)]
+        self.processes = [None] * num_workers
+        self.restarts = [0] * num_workers
+        self.routed = [0] * num_workers
+        self.ring = HashRing(range(num_workers))
+        self.client = None
+
+    def start_worker(self, index):
+        process = self.context.Process(
+            target=worker_main,
+            args=(index, self.app, self.queues[index], self.shared_store_path, self.get_in_flight, self.on_worker_start,
+                  self.on_worker_drain),
+            name=f"slackAskBot-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[index] = process
+
+    def handle_request(self, client, req):
+        # Ack right away; the worker does the real work, and Slack retries anything not acked within 3 seconds
+        client.send_socket_mode_response(SocketModeResponse(envelope_id=req.envelope_id))
+        if req.type != "events_api" or self.stopping.is_set():
+            return
+        body = req.payload
+        event_id = body.get("event_id")
+        if event_id and not self.store.claim_event(event_id):
+            print(f"Dropping duplicate delivery of {event_id}")
+            return
+        if self.on_event:
+            self.on_event(body)
+        index = self.ring.node_for(route_key(body))
+        self.routed[index] += 1
+        self.queues[index].put(body)
+
+    def print_status(self):
+        loads = {load["worker"]: load for load in self.store.worker_loads()}
+        for index, process in enumerate(self.processes):
+            load = loads.get(index, {})
+            print(f"Worker {index} (pid {process.pid if process else '-'}): routed {self.routed[index]}, "
+                  f"queued {self.queues[index].qsize()}, in flight {load.get('in_flight', '-')}, "
+                  f"handled {load.get('handled', '-')}, restarts {self.restarts[index]}")
+
+    def shutdown(self):
+        """Stop taking events, then give workers until the drain timeout to finish what they have."""
+        print("Shutting down: closing the Socket Mode connection and draining workers")
+        self.client.close()
+        for event_queue in self.queues:
+            event_queue.put(None)
+        # Allow a little longer than the workers' own drain timeout so they can tidy up leftover requests
+        deadline = time.monotonic() + self.drain_timeout + 15
+        for index, process in enumerate(self.processes):
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                # Workers ignore SIGTERM, so only SIGKILL stops one; joining it keeps multiprocessing's exit join
+                # from waiting on it forever
+                print(f"Worker {index} (pid {process.pid}) did not drain in time; killing it")
+                process.kill()
+                process.join()
+        self.print_status()
+
+    def run(self):
+        for index in range(self.num_workers):
+            self.start_worker(index)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: self.stopping.set())
+        self.client = SocketModeClient(app_token=self.app_token, web_client=self.app.client, logger=self.app.logger)
+        self.client.socket_mode_request_listeners.append(self.handle_request)
+        self.client.connect()
+        print(f"Supervisor connected to Socket Mode with {self.num_workers} workers (shared state in {self.shared_store_path})")
+        if self.on_connected:
+            self.on_connected()
+        last_status = time.monotonic()
+        while not self.stopping.wait(1):
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    print(f"Worker {index} (pid {process.pid}) exited with code {process.exitcode}; restarting")
+                    self.restarts[index] += 1
+                    self.start_worker(index)
+            if time.monotonic() - last_status > self.status_interval:
+                self.print_status()
+                last_status = time.monotonic()
+        self.shutdown()
@@ -0,0 +1,291 @@
+"""
+Approximate nearest-neighbour search over an embedding store (see embedding_store.py) with an IVF-flat index.
+
+The embeddings are clustered with spherical k-means into nlist lists; each row is stored (normalized) in the list
+of its nearest centroid, with the lists laid out contiguously so a list is one slice of one file.  A query scores
+the centroids, scans only the nprobe closest lists, and returns the top k by cosine similarity.  Raising nprobe
+trades latency for recall; nprobe = nlist is exact search.
+
+The index lives in an "ivf" directory inside the store, as .npy files that are memory-mapped on load.  Rows
+appended to the store after the index was built are added to a small delta segment (scanned alongside the
+probed lists) and folded into the main layout when the delta grows past a fraction of the index.
+
+Usage:
+    python ann_index.py build <store_dir> [--nlist N] [--nprobe N]
+    python ann_index.py add <store_dir>                       # index rows appended since the last build/add
+    python ann_index.py recall <store_dir> [--nprobe 1,4,16,64] [--k 10] [--queries 100]
+
+search_exports.py uses the index automatically when the store has one (SEARCH_NPROBE overrides its nprobe).
+"""
+
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from embedding_store import EmbeddingStore
+from vector_search import VectorIndex, normalize_rows, top_k
+
+INDEX_DIR = 'ivf'
+FORMAT_VERSION = 1
+
+
+def _blocks(matrix, block_rows=65536):
+    for start in range(0, len(matrix), block_rows):
+        yield start, normalize_rows(matrix[start:start + block_rows])
+
+
+def nearest_centroids(centroids, matrix, block_rows=65536):
+    assignments = np.empty(len(matrix), dtype=np.int32)
+    for start, block in _blocks(matrix, block_rows):
+        assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def cluster_sums(points, assignments, nclusters):
+    """Per-cluster sums and counts of points (a sort and np.add.reduceat; np.add.at is far slower)."""
+    order = np.argsort(assignments, kind='stable')
+    counts = np.bincount(assignments, minlength=nclusters)
+    sums = np.zeros((nclusters, points.shape[1]), dtype=points.dtype)
+    nonempty = counts > 0
+    starts = (np.cumsum(counts) - counts)[nonempty]
+    sums[nonempty] = np.add.reduceat(points[order], starts, axis=0)
+    return sums, counts
+
+
+def train_centroids(embeddings, nlist, train_size=None, iterations=20, seed=0):
+    """Spherical k-means on a random sample of the rows."""
+    rng = np.random.default_rng(seed)
+    # At least one sample row per list, and no more rows than there are
+    train_size = min(len(embeddings), max(nlist, train_size or nlist * 64))
+    sample = normalize_rows(embeddings[np.sort(rng.choice(len(embeddings), train_size, replace=False))])
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+    for _ in range(iterations):
+        assignments = nearest_centroids(centroids, sample)
+        sums, counts = cluster_sums(sample, assignments, nlist)
+        # Re-seed empty lists from random sample rows so every list ends up used
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+def _swap_in(temp_path, path):
+    """Replace the index directory at path with temp_path; a reader sees either the old index or the new one."""
+    # A .old left behind by a crash would make the rename below fail
+    shutil.rmtree(path + '.old', ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, path + '.old')
+    os.replace(temp_path, path)
+    shutil.rmtree(path + '.old', ignore_errors=True)
+
+
+def _new_index_dir(path):
+    temp_path = path + '.new'
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+    return temp_path
+
+
+class IVFIndex:
+    def __init__(self, path, header, centroids, list_offsets, list_ids, list_vectors, delta_ids, delta_lists,
+                 delta_vectors):
+        self.path = path
+        self.nprobe = header['nprobe']
+        self.centroids = centroids
+        self.nlist, self.dim = centroids.shape
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.list_vectors = list_vectors
+        self.delta_ids = delta_ids
+        self.delta_lists = delta_lists
+        self.delta_vectors = delta_vectors
+
+    def __len__(self):
+        return len(self.list_ids) + len(self.delta_ids)
+
+    @classmethod
+    def build(cls, embeddings, path, nlist=None, nprobe=16, dtype=None, train_size=None, iterations=20, seed=0,
+              block_rows=65536):
+        """Cluster embeddings (an array or memmap; ids are the row numbers) and write the index to path."""
+        # 4 x sqrt(rows) is more lists than rows below 16 rows; a list needs a row to seed its centroid
+        nlist = min(nlist or max(1, int(4 * np.sqrt(len(embeddings)))), len(embeddings))
+        centroids = train_centroids(embeddings, nlist, train_size, iterations, seed)
+        assignments = nearest_centroids(centroids, embeddings, block_rows)
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=nlist)
+
+        temp_path = _new_index_dir(path)
+        list_vectors = np.lib.format.open_memmap(os.path.join(temp_path, 'list_vectors.npy'), mode='w+',
+                                                 dtype=dtype or embeddings.dtype, shape=(len(order), embeddings.shape[1]))
+        for start in range(0, len(order), block_rows):
+            rows = order[start:start + block_rows]
+            # Read the source rows in ascending order, then put them back in list order
+            sorted_rows = np.sort(rows)
+            block = normalize_rows(embeddings[sorted_rows])
+            list_vectors[start:start + len(rows)] = block[np.searchsorted(sorted_rows, rows)]
+        list_vectors.flush()
+        del list_vectors
+        cls._write_arrays(temp_path, centroids, counts, order.astype(np.int64), nprobe)
+        _swap_in(temp_path, path)
+        return cls.load(path)
+
+    @staticmethod
+    def _write_arrays(path, centroids, counts, list_ids, nprobe):
+        """Write everything but list_vectors.npy (already written), with an empty delta segment."""
+        np.save(os.path.join(path, 'centroids.npy'), centroids)
+        np.save(os.path.join(path, 'list_offsets.npy'), np.concatenate([[0], np.cumsum(counts)]).astype(np.int64))
+        np.save(os.path.join(path, 'list_ids.npy'), list_ids)
+        vectors = np.load(os.path.join(path, 'list_vectors.npy'), mmap_mode='r')
+        np.savez(os.path.join(path, 'delta.npz'), ids=np.zeros(0, dtype=np.int64), lists=np.zeros(0, dtype=np.int32),
+                 vectors=np.zeros((0, centroids.shape[1]), dtype=vectors.dtype))
+        with open(os.path.join(path, 'ivf.json'), 'w') as header_f:
+            json.dump({'version': FORMAT_VERSION, 'dim': centroids.shape[1], 'nlist': len(centroids),
+                       'count': len(list_ids), 'dtype': vectors.dtype.name, 'nprobe': nprobe},
+                      header_f, indent=4)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'ivf.json')) as header_f:
+            header = json.load(header_f)
+        if header['version'] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported IVF index version {header['version']} in {path}")
+        delta = np.load(os.path.join(path, 'delta.npz'))
+        return cls(path, header,
+                   np.load(os.path.join(path, 'centroids.npy')),
+                   np.load(os.path.join(path, 'list_offsets.npy')),
+                   np.load(os.path.join(path, 'list_ids.npy'), mmap_mode='r'),
+                   np.load(os.path.join(path, 'list_vectors.npy'), mmap_mode='r'),
+                   delta['ids'], delta['lists'], delta['vectors'])
+
+    def add(self, embeddings, ids):
+        """Add rows to the delta segment; they are searchable straight away and written by save()."""
+        vectors = normalize_rows(embeddings)
+        self.delta_ids = np.concatenate([self.delta_ids, np.asarray(ids, dtype=np.int64)])
+        self.delta_lists = np.concatenate([self.delta_lists, nearest_centroids(self.centroids, vectors)])
+        self.delta_vectors = np.concatenate([self.delta_vectors, vectors.astype(self.list_vectors.dtype)])
+
+    def save(self, max_delta_fraction=0.1):
+        """Persist the delta segment, folding it into the list layout once it passes max_delta_fraction of the index."""
+        if len(self.delta_ids) > max_delta_fraction * max(1, len(self.list_ids)):
+            return self.compact()
+        # The list files never change in place; only the delta and the header are rewritten
+        temp_file = os.path.join(self.path, 'delta.new.npz')
+        np.savez(temp_file, ids=self.delta_ids, lists=self.delta_lists, vectors=self.delta_vectors)
+        os.replace(temp_file, os.path.join(self.path, 'delta.npz'))
+        with open(os.path.join(self.path, 'ivf.json')) as header_f:
+            header = json.load(header_f)
+        header['count'] = len(self)
+        with open(os.path.join(self.path, 'ivf.json.tmp'), 'w') as header_f:
+            json.dump(header, header_f, indent=4)
+        os.replace(os.path.join(self.path, 'ivf.json.tmp'), os.path.join(self.path, 'ivf.json'))
+        return self
+
+    def compact(self):
+        """Rewrite the index with the delta segment merged into its lists, and return the reloaded index."""
+        delta_order = np.argsort(self.delta_lists, kind='stable')
+        delta_offsets = np.searchsorted(self.delta_lists[delta_order], np.arange(self.nlist + 1))
+        counts = np.diff(self.list_offsets) + np.diff(delta_offsets)
+
+        temp_path = _new_index_dir(self.path)
+        list_vectors = np.lib.format.open_memmap(os.path.join(temp_path, 'list_vectors.npy'), mode='w+',
+                                                 dtype=self.list_vectors.dtype, shape=(len(self), self.dim))
+        list_ids = np.empty(len(self), dtype=np.int64)
+        position = 0
+        for l in range(self.nlist):
+            main = slice(self.list_offsets[l], self.list_offsets[l + 1])
+            added = delta_order[delta_offsets[l]:delta_offsets[l + 1]]
+            for ids, vectors in ((self.list_ids[main], self.list_vectors[main]),
+                                 (self.delta_ids[added], self.delta_vectors[added])):
+                list_ids[position:position + len(ids)] = ids
+                list_vectors[position:position + len(ids)] = vectors
+                position += len(ids)
+        list_vectors.flush()
+        del list_vectors
+        self._write_arrays(temp_path, self.centroids, counts, list_ids, self.nprobe)
+        _swap_in(temp_path, self.path)
+        return self.load(self.path)
+
+    def search(self, query, k, nprobe=None):
+        """(ids, scores) of the approximate top k rows for one query, best first."""
+        query = normalize_rows(np.atleast_2d(query))[0]
+        lists, _ = top_k(self.centroids @ query, min(nprobe or self.nprobe, self.nlist))
+        ids = [self.list_ids[self.list_offsets[l]:self.list_offsets[l + 1]] for l in lists]
+        vectors = [self.list_vectors[self.list_offsets[l]:self.list_offsets[l + 1]] for l in lists]
+        if len(self.delta_ids):
+            in_probed = np.isin(self.delta_lists, lists)
+            ids.append(self.delta_ids[in_probed])
+            vectors.append(self.delta_vectors[in_probed])
+        ids = np.concatenate(ids)
+        scores = np.concatenate(vectors).astype(np.float32) @ query
+        best, best_scores = top_k(scores, k)
+        return ids[best], best_scores
+
+    def search_batch(self, queries, k, nprobe=None):
+        return [self.search(query, k, nprobe) for query in np.atleast_2d(queries)]
+
+
+def index_path(store):
+    return os.path.join(store.path, INDEX_DIR)
+
+
+def open_index(store):
+    """The store's IVF index, or None if it hasn't been built."""
+    path = index_path(store)
+    return IVFIndex.load(path) if os.path.exists(os.path.join(path, 'ivf.json')) else None
+
+
+def recall_report(index, exact, queries, k, nprobes):
+    """Recall@k against exact search and mean latency for each nprobe."""
+    expected = [set(ids.tolist()) for ids, _ in exact.search_batch(queries, k)]
+    report = []
+    for nprobe in nprobes:
+        started = time.perf_counter()
+        results = index.search_batch(queries, k, nprobe)
+        latency_ms = (time.perf_counter() - started) / len(queries) * 1000
+        recall = np.mean([len(expected_ids & set(ids.tolist())) / len(expected_ids)
+                          for expected_ids, (ids, _) in zip(expected, results)])
+        report.append({'nprobe': nprobe, 'recall_at_k': round(float(recall), 4), 'latency_ms': round(latency_ms, 2)})
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build, extend or evaluate the IVF index of an embedding store')
+    parser.add_argument('command', choices=['build', 'add', 'recall'])
+    parser.add_argument('store_dir')
+    parser.add_argument('--nlist', type=int, default=None, help='Number of lists (default 4 x sqrt(rows))')
+    parser.add_argument('--nprobe', default='16', help='Lists scanned per query (comma-separated for recall)')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=100, help='Queries for the recall report')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    store = EmbeddingStore(args.store_dir)
+    path = index_path(store)
+    if args.command == 'build':
+        started = time.monotonic()
+        index = IVFIndex.build(store.embeddings, path, nlist=args.nlist, nprobe=int(args.nprobe), seed=args.seed)
+        print(f'Indexed {len(index)} rows into {index.nlist} lists in {time.monotonic() - started:.1f}s')
+    elif args.command == 'add':
+        index = IVFIndex.load(path)
+        start = len(index)
+        if start < len(store):
+            index.add(store.embeddings[start:], np.arange(start, len(store)))
+            index = index.save()
+        print(f'Added {len(store) - start} rows; the index now covers {len(index)} rows ({len(index.delta_ids)} in the delta segment)')
+    else:
+        index = IVFIndex.load(path)
+        # Queries near (but not at) stored rows, like real questions about existing messages
+        rng = np.random.default_rng(args.seed)
+        rows = normalize_rows(store.embeddings[np.sort(rng.choice(len(store), min(args.queries, len(store)), replace=False))])
+        queries = rows + rng.standard_normal(rows.shape).astype(np.float32) * (0.5 / np.sqrt(store.dim))
+        exact = VectorIndex(store.embeddings)
+        for row in recall_report(index, exact, queries, args.k, [int(n) for n in args.nprobe.split(',')]):
+            print(f"nprobe {row['nprobe']}: recall@{args.k} {row['recall_at_k']}, {row['latency_ms']} ms/query")
+
+
+if __name__ == '__main__':
+    main()
@@ -9,27 +9,33 @@ It iterates over the subdirectories in the `data_dir` and looks for JSON files.
 It then reads the data from the JSON files and checks for an embeddings file in the `embeddings_dir` with the same name.
 If the embeddings file is found, it is added to the data JSON.
 All the data is then written to the `output_file` in a pretty-printed format.
+If `output_file` does not end in .json, it is written as a binary embedding store directory instead
+(see embedding_store.py), which search_exports.py can open without parsing the whole dataset.
 """
 
 import os
 import json
 import csv
 import sys
+import argparse
 
-# Check for all three arguments
-if len(sys.argv) != 4:
-    print('Usage: combine_into_json.py <data_dir> <embeddings_dir> <output_file>')
-    sys.exit(1)
+from embedding_store import EmbeddingStore
+
+parser = argparse.ArgumentParser(description='Combine message data and embeddings into a single JSON file or embedding store')
+parser.add_argument('data_dir')
+parser.add_argument('embeddings_dir')
+parser.add_argument('output_file', help='Output JSON file, or a directory to write as an embedding store (see embedding_store.py) if it does not end in .json')
+parser.add_argument('--float16', action='store_true', help='Store embeddings as float16 (half the size) in an embedding store')
+args = parser.parse_args()
 
 # Get arguments
-data_dir = sys.argv[1]
-embeddings_dir = sys.argv[2]
-output_file = sys.argv[3]
+data_dir = args.data_dir
+embeddings_dir = args.embeddings_dir
+output_file = args.output_file
 
-all_data = []
 
-# Open output file
-with open(output_file, 'w') as outfile:
+def read_data():
+    """Yield (source, data json, embeddings json) for each data file with an embeddings file."""
     # Iterate over subdirectories in data directory
     for subdir in sorted(os.listdir(data_dir)):
         subdir_path = os.path.join(data_dir, subdir)
@@ -49,15 +55,42 @@ with open(output_file, 'w') as outfile:
                     print(f'Found embeddings file for {subdir_path}/{filename} at {embeddings_path}')
                     with open(embeddings_path) as embeddings_file:
                         embeddings_json = json.load(embeddings_file)
-                        # Add embeddings json to all_data    
                 else:
                     #print('Warning: embeddings file not found for {}'.format(filename))
                     print(f'Warning: embeddings file not found for {subdir_path}/{filename} at {embeddings_path}')
                     continue
 
-                # Add data json and embeddings json to all_data
-                all_data.append({'messages': data_json, 'ada_search': embeddings_json})
+                yield f'{subdir}/{filename}', data_json, embeddings_json
+
+
+if not output_file.endswith('.json'):
+    # Write a binary embedding store, appending in batches so the whole dataset is never held in memory
+    store = None
+    records = []
+    embeddings = []
+    for source, data_json, embeddings_json in read_data():
+        if store is None:
+            store = EmbeddingStore.create(output_file, dim=len(embeddings_json), dtype='float16' if args.float16 else 'float32',
+                                          model='text-embedding-ada-002')
+        records.append({'messages': data_json, 'source': source})
+        embeddings.append(embeddings_json)
+        if len(records) >= 1000:
+            store.append(embeddings, records)
+            records = []
+            embeddings = []
+    if store is not None:
+        store.append(embeddings, records)
+        print(f'Wrote {len(store)} records to {output_file}')
+    sys.exit(0)
+
+all_data = []
+
+# Open output file
+with open(output_file, 'w') as outfile:
+    for source, data_json, embeddings_json in read_data():
+        # Add data json and embeddings json to all_data
+        all_data.append({'messages': data_json, 'ada_search': embeddings_json})
 
     # Write all record to output file, pretty-printed
     #json.dump({'messages': data_json, 'ada_search': embeddings_json}, outfile, indent=4)
-    json.dump(all_data, outfile, indent=4)
\ No newline at end of file
+    json.dump(all_data, outfile, indent=4)
@@ -10,13 +10,11 @@ The output files are named with the start and end dates of the data they contain
 
 import os
 import json
-import tiktoken
+from token_chunker import count_tokens
 
 def get_token_count(data):
-    enc = tiktoken.get_encoding("gpt2")
-    text = json.dumps(data)
-    tokens = enc.encode(text)
-    return len(tokens)
+    # The combined files are embedded with text-embedding-ada-002, so count with its encoding
+    return count_tokens(json.dumps(data), model='text-embedding-ada-002')
 
 def split_old(data, tokens_threshold):
     token_count = 0
@@ -0,0 +1,217 @@
+"""
+Persistent embedding cache shared by get-all-embeddings.py, search_exports.py and search_with_slack_api.py.
+
+Embeddings are stored in SQLite keyed by (model, hash of the normalized text), so identical text is embedded once
+no matter which file, chunk or script it comes from: bot boilerplate, pasted logs and repeated alerts, and anything
+re-chunked, renamed or re-exported.  Text is normalized by Unicode NFC and collapsing runs of whitespace, which is
+also why search_exports.py's newline-to-space replacement doesn't change the key.  Recently used embeddings are
+kept in an in-memory LRU tier in front of the database, and lookups are done in bulk.
+
+The cache is at $EMBEDDING_CACHE (default ~/.cache/slackaskbot/embeddings.sqlite); set EMBEDDING_CACHE=off to
+disable it.  Last-use times are recorded so that compaction can drop the least recently used entries.
+
+Usage:
+    python embedding_cache.py stats [--cache path]
+    python embedding_cache.py compact [--cache path] [--max-rows N] [--max-age-days D]
+"""
+
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_PATH = os.path.join('~', '.cache', 'slackaskbot', 'embeddings.sqlite')
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_text(text):
+    return WHITESPACE.sub(' ', unicodedata.normalize('NFC', text)).strip()
+
+
+def text_key(text):
+    return hashlib.blake2b(normalize_text(text).encode('utf-8'), digest_size=16).digest()
+
+
+class EmbeddingCache:
+    def __init__(self, path=DEFAULT_PATH, memory_items=10000):
+        self.path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Used from the embedding engine's threads and the bot's workers, so share one connection under a lock
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS embeddings (model TEXT NOT NULL, key BLOB NOT NULL, '
+                        'vector BLOB NOT NULL, last_used INTEGER NOT NULL, PRIMARY KEY (model, key)) WITHOUT ROWID')
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_items = memory_items
+        # Hits since the last flush, whose last_used is updated in one write
+        self.touched = set()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get_many(self, texts, model):
+        """Embeddings (float32 arrays) for texts, in order, with None for each text that isn't cached."""
+        keys = [text_key(text) for text in texts]
+        results = [None] * len(texts)
+        missing = {}
+        with self.lock:
+            for i, key in enumerate(keys):
+                vector = self.memory.get((model, key))
+                if vector is not None:
+                    self.memory.move_to_end((model, key))
+                    results[i] = vector
+                    self.memory_hits += 1
+                else:
+                    missing.setdefault(key, []).append(i)
+            found = {}
+            unique = list(missing)
+            # SQLite limits the number of bound parameters per statement
+            for start in range(0, len(unique), 500):
+                chunk = unique[start:start + 500]
+                rows = self.db.execute(f'SELECT key, vector FROM embeddings WHERE model = ? AND key IN '
+                                       f'({",".join("?" * len(chunk))})', [model] + chunk)
+                found.update((key, np.frombuffer(vector, dtype=np.float32)) for key, vector in rows)
+            for key, indices in missing.items():
+                vector = found.get(key)
+                if vector is None:
+                    self.misses += len(indices)
+                    continue
+                self._remember(model, key, vector)
+                self.touched.add((model, key))
+                self.disk_hits += len(indices)
+                for i in indices:
+                    results[i] = vector
+        return results
+
+    def get(self, text, model):
+        return self.get_many([text], model)[0]
+
+    def put_many(self, texts, embeddings, model):
+        """Store embeddings for texts; None embeddings are skipped."""
+        now = int(time.time())
+        rows = []
+        with self.lock:
+            for text, embedding in zip(texts, embeddings):
+                if embedding is None:
+                    continue
+                key = text_key(text)
+                vector = np.asarray(embedding, dtype=np.float32)
+                self._remember(model, key, vector)
+                rows.append((model, key, vector.tobytes(), now))
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)', rows)
+
+    def _remember(self, model, key, vector):
+        self.memory[(model, key)] = vector
+        self.memory.move_to_end((model, key))
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def flush(self):
+        """Record the last-use time of the entries hit since the last flush."""
+        with self.lock:
+            if not self.touched:
+                return
+            now = int(time.time())
+            with self.db:
+                self.db.executemany('UPDATE embeddings SET last_used = ? WHERE model = ? AND key = ?',
+                                    [(now, model, key) for model, key in self.touched])
+            self.touched.clear()
+
+    def compact(self, max_rows=None, max_age_days=None):
+        """Drop entries unused for max_age_days and the least recently used beyond max_rows, then reclaim the space.
+
+        Returns the number of entries removed."""
+        self.flush()
+        with self.lock:
+            before = self.db.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+            with self.db:
+                if max_age_days is not None:
+                    self.db.execute('DELETE FROM embeddings WHERE last_used < ?', (time.time() - max_age_days * 86400,))
+                if max_rows is not None:
+                    self.db.execute('DELETE FROM embeddings WHERE (model, key) IN (SELECT model, key FROM embeddings '
+                                    'ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (max_rows,))
+            after = self.db.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+            self.db.execute('VACUUM')
+            # In WAL mode the file only shrinks once the vacuumed pages are checkpointed back into it
+            self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.memory.clear()
+        return before - after
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0}
+
+    def report(self):
+        stats = self.stats()
+        return (f"Embedding cache: {stats['memory_hits']} memory hits, {stats['disk_hits']} disk hits, "
+                f"{stats['misses']} misses ({stats['hit_rate']:.1%} hit rate)")
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+def open_cache(path=None, memory_items=10000):
+    """The cache at path or $EMBEDDING_CACHE, or None if EMBEDDING_CACHE is off."""
+    path = path or os.environ.get('EMBEDDING_CACHE', DEFAULT_PATH)
+    if path.lower() in ('off', 'none', '0', ''):
+        return None
+    return EmbeddingCache(path, memory_items)
+
+
+def embed_texts(client, texts, model, cache=None, batch_inputs=256):
+    """Embeddings (float32 arrays) for texts, from the cache where possible and one request per batch of the rest.
+
+    The normalized text is what gets embedded, so texts that normalize the same are embedded once."""
+    results = cache.get_many(texts, model) if cache else [None] * len(texts)
+    pending = {}
+    for i, text in enumerate(texts):
+        if results[i] is None:
+            pending.setdefault(normalize_text(text), []).append(i)
+    unique = list(pending)
+    for start in range(0, len(unique), batch_inputs):
+        batch = unique[start:start + batch_inputs]
+        response = client.embeddings.create(model=model, input=batch)
+        embeddings = [np.asarray(d.embedding, dtype=np.float32) for d in sorted(response.data, key=lambda d: d.index)]
+        if cache:
+            cache.put_many(batch, embeddings, model)
+        for text, embedding in zip(batch, embeddings):
+            for i in pending[text]:
+                results[i] = embedding
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or compact the embedding cache')
+    parser.add_argument('command', choices=['stats', 'compact'])
+    parser.add_argument('--cache', help=f'Cache file (default: $EMBEDDING_CACHE or {DEFAULT_PATH})')
+    parser.add_argument('--max-rows', type=int, help='Keep at most this many of the most recently used entries')
+    parser.add_argument('--max-age-days', type=float, help='Drop entries not used for this many days')
+    args = parser.parse_args()
+
+    cache = open_cache(args.cache)
+    if cache is None:
+        parser.error('the embedding cache is disabled (EMBEDDING_CACHE=off)')
+    if args.command == 'compact':
+        size = os.path.getsize(cache.path)
+        removed = cache.compact(args.max_rows, args.max_age_days)
+        print(f'Removed {removed} entries; {size / 1e6:.1f} MB -> {os.path.getsize(cache.path) / 1e6:.1f} MB')
+    for model, count, oldest in cache.db.execute('SELECT model, COUNT(*), MIN(last_used) FROM embeddings GROUP BY model'):
+        print(f'{model}: {count} embeddings, least recently used {time.strftime("%Y-%m-%d", time.localtime(oldest))}')
+    print(f'{cache.path}: {os.path.getsize(cache.path) / 1e6:.1f} MB')
+    cache.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Batched, concurrent, rate-limited calls to the OpenAI embeddings API, used by get-all-embeddings.py and pipeline.py.
+
+EmbeddingEngine packs (key, text, token count) inputs into requests of up to batch_inputs inputs and batch_tokens
+tokens, keeps `concurrency` requests in flight within a RateBudget, retries rate limit, connection and server errors
+with backoff, and splits a batch the API refuses to find the input it objects to.
+"""
+
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import openai
+
+EMBEDDING_MODEL = 'text-embedding-ada-002'
+
+
+class RateBudget:
+    """Requests and tokens per minute allowed across all in-flight requests, refilled continuously."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.capacity = [requests_per_minute, tokens_per_minute]
+        self.available = list(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens):
+        needed = [1, min(tokens, self.capacity[1])]
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.available = [min(c, a + c * (now - self.updated) / 60) for c, a in zip(self.capacity, self.available)]
+                self.updated = now
+                if all(a >= n for a, n in zip(self.available, needed)):
+                    self.available = [a - n for a, n in zip(self.available, needed)]
+                    return
+                delay = max((n - a) * 60 / c for c, a, n in zip(self.capacity, self.available, needed))
+            time.sleep(delay)
+
+
+class EmbeddingEngine:
+    """Packs inputs into batched embedding requests and runs several of them at once."""
+
+    retryable_errors = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+    def __init__(self, client, model=EMBEDDING_MODEL, batch_inputs=256, batch_tokens=100000, concurrency=4,
+                 budget=None, max_retries=6):
+        self.client = client
+        self.model = model
+        self.batch_inputs = batch_inputs
+        self.batch_tokens = batch_tokens
+        self.concurrency = concurrency
+        self.budget = budget
+        self.max_retries = max_retries
+
+    def batches(self, items):
+        """Greedily pack (key, text, token count) items into batches within the input and token limits."""
+        batch = []
+        batch_tokens = 0
+        for item in items:
+            if batch and (len(batch) >= self.batch_inputs or batch_tokens + item[2] > self.batch_tokens):
+                yield batch
+                batch = []
+                batch_tokens = 0
+            batch.append(item)
+            batch_tokens += item[2]
+        if batch:
+            yield batch
+
+    def embed_batch(self, batch):
+        """Embeddings for a batch, in order; None for any input the API refuses."""
+        for attempt in range(self.max_retries + 1):
+            if self.budget:
+                self.budget.acquire(sum(item[2] for item in batch))
+            try:
+                response = self.client.embeddings.create(model=self.model, input=[item[1] for item in batch])
+                return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+            except openai.BadRequestError as e:
+                if len(batch) == 1:
+                    print(f'Skipping input for {batch[0][0]}: {e}')
+                    return [None]
+                # Split the batch to isolate the input the API refused
+                middle = len(batch) // 2
+                return self.embed_batch(batch[:middle]) + self.embed_batch(batch[middle:])
+            except self.retryable_errors as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = min(60, 2 ** attempt) * (0.5 + random.random())
+                print(f'Embedding request for {len(batch)} inputs failed ({e.__class__.__name__}), retrying in {delay:.1f}s')
+                time.sleep(delay)
+
+    def run(self, items, on_batch):
+        """Embed items, calling on_batch(batch, embeddings) in this thread as each request finishes.
+
+        Returns the number of inputs that could not be embedded."""
+        batches = self.batches(items)
+        pending = {}
+        failed = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while True:
+                # Keep a few batches queued behind the in-flight ones so the workers never wait on packing
+                while len(pending) < self.concurrency * 2:
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    pending[executor.submit(self.embed_batch, batch)] = batch
+                if not pending:
+                    return failed
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = pending.pop(future)
+                    try:
+                        embeddings = future.result()
+                    except openai.OpenAIError as e:
+                        print(f'Giving up on {len(batch)} inputs: {e}')
+                        failed += len(batch)
+                        continue
+                    failed += embeddings.count(None)
+                    on_batch(batch, embeddings)
@@ -0,0 +1,159 @@
+"""
+A compact on-disk store for message records and their embeddings, replacing str(list) text files and one big
+pretty-printed JSON file.
+
+A store is a directory holding:
+    store.json       header: format version, embedding dimension, dtype, model and the number of committed records
+    embeddings.bin   the embeddings as one row-major float32 (or float16) matrix, opened with np.memmap
+    records.jsonl    one JSON record per line (e.g. {"messages": [...], "source": "channel/file.json"})
+    offsets.bin      uint64 byte offset of each record in records.jsonl, so any record can be read without a scan
+    deleted.bin      optional tombstones: one byte per row, 1 for rows that have been deleted
+
+Opening a store only reads the header; searches touch the embedding pages they scan and the records they return.
+Records can be appended.  The header's count is updated last, so a store interrupted mid-append still opens
+with the records committed before it, and the next append overwrites the partial tail.  Rows are deleted by
+tombstoning them rather than rewriting the files, so row numbers (and indexes built over them) stay valid;
+searches skip deleted rows.
+"""
+
+import json
+import os
+
+import numpy as np
+
+HEADER_FILE = 'store.json'
+EMBEDDINGS_FILE = 'embeddings.bin'
+RECORDS_FILE = 'records.jsonl'
+OFFSETS_FILE = 'offsets.bin'
+DELETED_FILE = 'deleted.bin'
+FORMAT_VERSION = 1
+
+
+class EmbeddingStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, HEADER_FILE)) as header_f:
+            self.header = json.load(header_f)
+        if self.header['version'] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported embedding store version {self.header['version']} in {path}")
+        self.dim = self.header['dim']
+        self.dtype = np.dtype(self.header['dtype'])
+        self._embeddings = None
+        self._offsets = None
+        self._deleted = None
+
+    @classmethod
+    def create(cls, path, dim, dtype='float32', model=None):
+        """Create an empty store at path (a new or empty directory)."""
+        os.makedirs(path, exist_ok=True)
+        for name in (EMBEDDINGS_FILE, RECORDS_FILE, OFFSETS_FILE):
+            open(os.path.join(path, name), 'wb').close()
+        header = {'version': FORMAT_VERSION, 'dim': dim, 'dtype': np.dtype(dtype).name, 'model': model, 'count': 0}
+        cls._write_header(path, header)
+        return cls(path)
+
+    @staticmethod
+    def _write_header(path, header):
+        temp_path = os.path.join(path, HEADER_FILE + '.tmp')
+        with open(temp_path, 'w') as header_f:
+            json.dump(header, header_f, indent=4)
+        os.replace(temp_path, os.path.join(path, HEADER_FILE))
+
+    def __len__(self):
+        return self.header['count']
+
+    @property
+    def embeddings(self):
+        """Read-only (count, dim) matrix backed by the file; pages are loaded as they are touched."""
+        if self._embeddings is None:
+            if len(self) == 0:
+                self._embeddings = np.zeros((0, self.dim), dtype=self.dtype)
+            else:
+                self._embeddings = np.memmap(os.path.join(self.path, EMBEDDINGS_FILE), dtype=self.dtype, mode='r',
+                                             shape=(len(self), self.dim))
+        return self._embeddings
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            if len(self) == 0:
+                self._offsets = np.zeros(0, dtype=np.uint64)
+            else:
+                self._offsets = np.memmap(os.path.join(self.path, OFFSETS_FILE), dtype=np.uint64, mode='r',
+                                          shape=(len(self),))
+        return self._offsets
+
+    @property
+    def deleted_count(self):
+        return self.header.get('deleted', 0)
+
+    @property
+    def deleted(self):
+        """Boolean array with True for each deleted row."""
+        if self._deleted is None:
+            self._deleted = np.zeros(len(self), dtype=bool)
+            path = os.path.join(self.path, DELETED_FILE)
+            if self.deleted_count and os.path.exists(path):
+                tombstones = np.fromfile(path, dtype=np.uint8)[:len(self)]
+                self._deleted[:len(tombstones)] = tombstones.astype(bool)
+        return self._deleted
+
+    def delete(self, indices):
+        """Tombstone rows; their records and embeddings stay in the files but searches skip them."""
+        deleted = self.deleted.copy()
+        deleted[np.asarray(indices, dtype=np.int64)] = True
+        temp_path = os.path.join(self.path, DELETED_FILE + '.tmp')
+        deleted.astype(np.uint8).tofile(temp_path)
+        os.replace(temp_path, os.path.join(self.path, DELETED_FILE))
+        self.header['deleted'] = int(deleted.sum())
+        self._write_header(self.path, self.header)
+        self._deleted = deleted
+
+    def record(self, index):
+        with open(os.path.join(self.path, RECORDS_FILE), 'rb') as records_f:
+            records_f.seek(int(self.offsets[index]))
+            return json.loads(records_f.readline())
+
+    def records(self, indices):
+        """Records for the given row indices, in the same order."""
+        with open(os.path.join(self.path, RECORDS_FILE), 'rb') as records_f:
+            results = []
+            for index in indices:
+                records_f.seek(int(self.offsets[index]))
+                results.append(json.loads(records_f.readline()))
+            return results
+
+    def append(self, embeddings, records):
+        """Append records and their embeddings (one row per record) and commit them."""
+        embeddings = np.asarray(embeddings, dtype=self.dtype).reshape(-1, self.dim)
+        if len(embeddings) != len(records):
+            raise ValueError(f'Got {len(embeddings)} embeddings for {len(records)} records')
+        if not records:
+            return
+        count = len(self)
+        lines = [json.dumps(record).encode('utf-8') + b'\n' for record in records]
+        with open(os.path.join(self.path, RECORDS_FILE), 'r+b') as records_f:
+            # Anything past the last committed record is left over from an interrupted append
+            records_f.seek(int(self.offsets[-1]) if count else 0)
+            if count:
+                records_f.readline()
+            start = records_f.tell()
+            records_f.truncate()
+            records_f.writelines(lines)
+            records_f.flush()
+            os.fsync(records_f.fileno())
+        offsets = start + np.cumsum([0] + [len(line) for line in lines[:-1]], dtype=np.uint64)
+        for name, data, row_bytes in ((EMBEDDINGS_FILE, embeddings, self.dim * self.dtype.itemsize),
+                                      (OFFSETS_FILE, offsets, 8)):
+            with open(os.path.join(self.path, name), 'r+b') as data_f:
+                data_f.seek(count * row_bytes)
+                data_f.truncate()
+                data_f.write(data.tobytes())
+                data_f.flush()
+                os.fsync(data_f.fileno())
+        self.header['count'] = count + len(records)
+        self._write_header(self.path, self.header)
+        # Re-map on next access so the new rows are visible
+        self._embeddings = None
+        self._offsets = None
+        self._deleted = None
@@ -10,6 +10,8 @@ It then writes them out in a compact pretty-printed format that is valid json wi
 import json
 import sys
 
+from ingest_export import iter_json_array
+
 # Check that the correct number of command-line arguments were provided
 if len(sys.argv) != 3:
     print("Usage: extract_messages.py <input_file> <output_file>")
@@ -19,23 +21,20 @@ if len(sys.argv) != 3:
 input_file = sys.argv[1]
 output_file = sys.argv[2]
 
-# Open the input file and read the JSON data
-with open(input_file, 'r') as f:
-    data = json.load(f)
-
-# Extract the messages with "type": "message"
+# Extract the messages with "type": "message", parsing the input file one item at a time
 messages = []
-for item in data:
-    if item['type'] == 'message':
-        if 'client_msg_id' in item:
-            #print(item['client_msg_id'])
-            message = {
-                'client_msg_id': item['client_msg_id'],
-                'ts': item['ts'],
-                'text': item['text']
-            }
-            #print(message)
-            messages.append(message)
+with open(input_file, 'rb') as f:
+    for item in iter_json_array(f):
+        if item.get('type') == 'message':
+            if 'client_msg_id' in item:
+                #print(item['client_msg_id'])
+                message = {
+                    'client_msg_id': item['client_msg_id'],
+                    'ts': item['ts'],
+                    'text': item.get('text', '')
+                }
+                #print(message)
+                messages.append(message)
 
 # Open the output file and write the messages as JSON
 if messages:
@@ -7,55 +7,130 @@ For each file, it gets the embedding using the OpenAI Text Embedding API
 and writes the embedding to an identically named file in the output directory.
 If the line is longer than 8000 tokens, it will split the line into chunks
 of <8000 tokens and write each chunk to its own file.
+
+Inputs from many files are packed into each API request (up to --batch-inputs inputs and --batch-tokens tokens),
+several requests run at once (--concurrency) within a requests/tokens per minute budget, and failed requests are
+retried with backoff.  Each output file is written as soon as all of its embeddings are back.  Embeddings for files
+that are only partly done are kept in a journal in the output directory, so a restarted run picks up from the last
+completed batch instead of redoing those files.
+
+Embeddings are also kept in the shared embedding cache (see embedding_cache.py), keyed by the text rather than the
+file, so text that has been embedded before (in another file, another chunking or an earlier export) and text that
+repeats within the run is only sent to the API once.  Like every other user of the cache, it embeds the normalized
+text (see embedding_cache.normalize_text).  Pass --cache off to disable it.
 """
 
-import openai
-from openai.embeddings_utils import get_embedding
-import sys
+import json
 import os
-import tiktoken
-import argparse
+import time
 
+from openai import OpenAI
 
-def get_embeddings_old(input_file, output_file):
-    # Open the input file for reading and the output file for writing
-    with open(input_file, 'r') as input_f, open(output_file, 'w') as output_f:
-        # Iterate over the lines in the input file
-        for line in input_f:
-            # Get the embedding for the line
-            embedding = get_embedding(line, engine='text-embedding-ada-002')
-            
-            # Write the embedding to the output file as a string
-            output_f.write(str(embedding) + '\n')
-
-def get_embeddings(input_file, output_file):
-    # Open the input file for reading and the output file for writing
+from embedding_cache import normalize_text, open_cache, text_key
+from embedding_engine import EMBEDDING_MODEL, EmbeddingEngine, RateBudget
+from token_chunker import encode, get_encoder, split_tokens
+
+MAX_INPUT_TOKENS = 8000
+JOURNAL_FILE = '.embeddings-journal.jsonl'
+
+
+def plan_embeddings(input_file, output_file, model=EMBEDDING_MODEL, overlap=0):
+    """Return the (output path, text, token count) inputs to embed for a file, in output order."""
+    parts = []
+    chunk_number = 0
     with open(input_file, 'r') as input_f:
         # Iterate over the lines in the input file
         for line in input_f:
-            # Get the token count of the line
-            enc = tiktoken.get_encoding("gpt2")
-            tokens = enc.encode(line)
+            # Embed the normalized text, as embed_texts does, so the cache holds the same vector for a key whichever
+            # script filled it. A blank line normalizes to '', which the API rejects, so it keeps its raw text as before
+            line = normalize_text(line) or line
+            tokens = encode(line, model)
             line_token_count = len(tokens)
-            
-            # If the token count is >8000, split the line into as many equal-sized chunks as needed so each chunk is <8000 tokens
-            if line_token_count > 8000:
-                num_chunks = line_token_count // 8000
-                print(f'{input_file} is too long ({line_token_count} tokens), splitting into {num_chunks+1} chunks')
-                for i in range(num_chunks+1):
-                    chunk = line[i*8000:(i+1)*8000]
-                    # Get the embedding for the chunk
-                    embedding = get_embedding(chunk, engine='text-embedding-ada-002')
-                    # Write out the chunk embedding to its own file
-                    print(f'Writing chunk {i+1} of {num_chunks+1} to {output_file}-chunk-{i+1}')
-                    with open(output_file + "-chunk-" + str(i+1), 'w') as chunk_f:
-                        chunk_f.write(str(embedding) + '\n')
+
+            # If the token count is >8000, split the line on token boundaries into as many equal-sized chunks as needed
+            if line_token_count > MAX_INPUT_TOKENS:
+                chunks = split_tokens(tokens, MAX_INPUT_TOKENS, overlap)
+                print(f'{input_file} is too long ({line_token_count} tokens), splitting into {len(chunks)} chunks')
+                for chunk_tokens in chunks:
+                    chunk_number += 1
+                    parts.append((output_file + "-chunk-" + str(chunk_number), normalize_text(get_encoder(model).decode(chunk_tokens)), len(chunk_tokens)))
             else:
-                # Get the embedding for the line
-                embedding = get_embedding(line, engine='text-embedding-ada-002')
-                # Write the embedding to the output file as a string
-                with open(output_file, 'w') as output_f:
-                    output_f.write(str(embedding) + '\n')
+                parts.append((output_file, line, line_token_count))
+    return parts
+
+
+class EmbeddingWriter:
+    """Writes each output file once all its embeddings are in, journaling embeddings for partly done files."""
+
+    def __init__(self, output_dir):
+        self.journal_path = os.path.join(output_dir, JOURNAL_FILE)
+        self.parts = {}
+        self.done = {}
+        self.files_written = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as journal_f:
+                for line in journal_f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line may be cut short if the previous run was killed mid-write
+                        continue
+                    self.done.setdefault(entry['file'], {})[entry['part']] = entry['embedding']
+            print(f'Resuming with {sum(len(d) for d in self.done.values())} journaled embeddings')
+        self.journal = open(self.journal_path, 'a')
+
+    def add_file(self, output_file, parts):
+        """Register a file's parts and return the (key, text, token count) inputs still to be embedded."""
+        self.parts[output_file] = parts
+        done = self.done.setdefault(output_file, {})
+        if len(done) == len(parts):
+            self.write_output(output_file)
+            return []
+        return [((output_file, i), text, tokens) for i, (_, text, tokens) in enumerate(parts) if i not in done]
+
+    def on_batch(self, batch, embeddings):
+        finished = []
+        for ((output_file, part), _, _), embedding in zip(batch, embeddings):
+            if embedding is not None:
+                self.done[output_file][part] = embedding
+                if len(self.done[output_file]) == len(self.parts[output_file]):
+                    finished.append(output_file)
+        for output_file in finished:
+            self.write_output(output_file)
+        # Files still in self.parts are only partly done
+        for ((output_file, part), _, _), embedding in zip(batch, embeddings):
+            if embedding is not None and output_file in self.parts:
+                self.journal.write(json.dumps({'file': output_file, 'part': part, 'embedding': embedding}) + '\n')
+        self.journal.flush()
+
+    def write_output(self, output_file):
+        lines = {}
+        for i, (path, _, _) in enumerate(self.parts[output_file]):
+            lines.setdefault(path, []).append(str(self.done[output_file][i]) + '\n')
+        # Reruns skip a file once its output or first chunk exists, so write those last
+        markers = [output_file, output_file + "-chunk-1"]
+        for path in [p for p in lines if p not in markers] + [p for p in reversed(markers) if p in lines]:
+            temp_path = path + '.tmp'
+            with open(temp_path, 'w') as output_f:
+                output_f.writelines(lines[path])
+            os.replace(temp_path, path)
+        del self.done[output_file]
+        del self.parts[output_file]
+        self.files_written += 1
+
+    def close(self):
+        """Drop the journal once nothing is left partly done, or compact it to the files that still are."""
+        self.journal.close()
+        remaining = {f: self.done[f] for f in self.parts if self.done[f]}
+        if not remaining:
+            os.remove(self.journal_path)
+            return
+        with open(self.journal_path + '.tmp', 'w') as journal_f:
+            for file, done in remaining.items():
+                for part, embedding in done.items():
+                    journal_f.write(json.dumps({'file': file, 'part': part, 'embedding': embedding}) + '\n')
+        os.replace(self.journal_path + '.tmp', self.journal_path)
+
 
 def main():
     import argparse
@@ -74,6 +149,17 @@ def main():
     group.add_argument('--subdir', help='A glob pattern for matching subdirectories')
     group.add_argument('--file', help='A glob pattern for matching files')
 
+    # Batching, concurrency and rate limit options
+    parser.add_argument('--model', default=EMBEDDING_MODEL, help='The embedding model to use')
+    parser.add_argument('--batch-inputs', type=int, default=256, help='Maximum inputs per embeddings request (the API allows 2048)')
+    parser.add_argument('--batch-tokens', type=int, default=100000, help='Maximum tokens per embeddings request')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of embeddings requests in flight at once')
+    parser.add_argument('--requests-per-minute', type=float, default=3000, help='Request budget per minute')
+    parser.add_argument('--tokens-per-minute', type=float, default=1000000, help='Token budget per minute')
+    parser.add_argument('--max-retries', type=int, default=6, help='Retries per request on rate limit, connection and server errors')
+    parser.add_argument('--chunk-overlap', type=int, default=0, help='Tokens shared by consecutive chunks of an over-long line')
+    parser.add_argument('--cache', help='Embedding cache file, or "off" (default: $EMBEDDING_CACHE or ~/.cache/slackaskbot/embeddings.sqlite)')
+
     # Parse the command-line arguments
     args = parser.parse_args()
 
@@ -87,6 +173,8 @@ def main():
 
     # Initialize empty list for subdirectories or files to process
     subdirs_or_files = []
+    # (input file, output file) pairs still to be embedded
+    jobs = []
 
     # Check if the --subdir or --file flag was provided
     if args.subdir:
@@ -116,9 +204,7 @@ def main():
             if os.path.exists(output_file + "-chunk-1"):
                 print(f'Skipping {item} because output file chunks already exist')
                 continue
-            # Print the file name
-            print(f'Processing {item}')
-            get_embeddings(input_file, output_file)
+            jobs.append((input_file, output_file))
         else:
             # Create the same subdirectories in the output directory
             subdir = item.replace(input_dir, output_dir)
@@ -137,10 +223,67 @@ def main():
                 if os.path.exists(output_file + "-chunk-1"):
                     print(f'Skipping {subdir}/{file} because output file chunks already exist')
                     continue
-                # Print the file name
-                print(f'Processing {subdir}/{file}')
                 # Process the file and write the output to an identically named file in the output subdirectory
-                get_embeddings(input_file, output_file)
+                jobs.append((input_file, output_file))
+
+    client = OpenAI()
+    budget = RateBudget(args.requests_per_minute, args.tokens_per_minute)
+    engine = EmbeddingEngine(client, args.model, args.batch_inputs, args.batch_tokens, args.concurrency, budget, args.max_retries)
+    writer = EmbeddingWriter(output_dir)
+    cache = open_cache(args.cache)
+    # Inputs waiting on an identical text already sent to the API, by cache key
+    waiting = {}
+    duplicates = 0
+
+    def inputs():
+        nonlocal duplicates
+        # Files are read and tokenized as the engine needs more batches, overlapping with requests in flight
+        for input_file, output_file in jobs:
+            print(f'Processing {input_file}')
+            items = writer.add_file(output_file, plan_embeddings(input_file, output_file, args.model, args.chunk_overlap))
+            if cache is None:
+                yield from items
+                continue
+            cached = cache.get_many([text for _, text, _ in items], args.model)
+            hits = [(item, embedding.tolist()) for item, embedding in zip(items, cached) if embedding is not None]
+            if hits:
+                writer.on_batch([item for item, _ in hits], [embedding for _, embedding in hits])
+            for item, embedding in zip(items, cached):
+                if embedding is None:
+                    key = text_key(item[1])
+                    if key in waiting:
+                        waiting[key].append(item)
+                        duplicates += 1
+                    else:
+                        waiting[key] = [item]
+                        yield item
+
+    def on_batch(batch, embeddings):
+        if cache is None:
+            writer.on_batch(batch, embeddings)
+            return
+        cache.put_many([text for _, text, _ in batch], embeddings, args.model)
+        # Fan each embedding out to the inputs that were waiting on the same text
+        items = []
+        results = []
+        for item, embedding in zip(batch, embeddings):
+            for waiting_item in waiting.pop(text_key(item[1])):
+                items.append(waiting_item)
+                results.append(embedding)
+        writer.on_batch(items, results)
+
+    started = time.monotonic()
+    try:
+        failed = engine.run(inputs(), on_batch)
+    finally:
+        writer.close()
+        if cache:
+            cache.close()
+    print(f'Wrote embeddings for {writer.files_written} of {len(jobs)} files in {time.monotonic() - started:.1f}s')
+    if cache:
+        print(f'{cache.report()}; {duplicates} repeated texts waited on one request')
+    if failed:
+        print(f'{failed} inputs could not be embedded; rerun to retry the files they belong to')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,167 @@
+"""
+Stream messages out of a Slack export zip (or an already unzipped export directory) without loading whole files.
+
+A Slack export holds one JSON array per channel per day (<channel>/<YYYY-MM-DD>.json).  Each day file is read
+straight from the zip and its array parsed one element at a time, keeping only items with "type": "message".
+Messages without a client_msg_id (bot posts, joins, file shares, ...) are kept with client_msg_id set to null
+and their subtype recorded, instead of raising a KeyError.  Channels are processed in parallel, one process each.
+
+Output formats:
+    jsonl   <output_dir>/<channel>.jsonl, one compact message per line in date order (the default)
+    days    <output_dir>/<channel>/<YYYY-MM-DD>.json, a JSON list per day like extract_messages.py writes,
+            so combine_messages.py can run on the result unchanged
+
+Usage:
+    python ingest_export.py export.zip messages/ [--format jsonl|days] [--channels general,random] [--workers N]
+"""
+
+import argparse
+import codecs
+import json
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+MESSAGE_FIELDS = ('ts', 'client_msg_id', 'user', 'text', 'thread_ts', 'subtype')
+
+
+def iter_json_array(stream, chunk_size=1 << 16):
+    """Yield the elements of a JSON array read from a binary stream, holding only one element in memory at a time."""
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    started = False
+    eof = False
+    while True:
+        # Skip whitespace and separators up to the next element
+        while position < len(buffer) and buffer[position] in ' \t\r\n,[':
+            if buffer[position] == '[':
+                if started:
+                    break
+                started = True
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        if position < len(buffer):
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # A number cut off by the end of the chunk (e.g. "1.5e") can parse early, so only accept an element
+                # followed by a separator
+                if eof or (end < len(buffer) and buffer[end] in ' \t\r\n,]'):
+                    yield element
+                    position = end
+                    continue
+        if eof:
+            return
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[position:] + text_decoder.decode(chunk, final=eof)
+        position = 0
+
+
+def compact_message(item, channel):
+    message = {'channel': channel}
+    for field in MESSAGE_FIELDS:
+        if field in item:
+            message[field] = item[field]
+    message.setdefault('client_msg_id', None)
+    message.setdefault('text', '')
+    return message
+
+
+def iter_messages(stream, channel):
+    for item in iter_json_array(stream):
+        if isinstance(item, dict) and item.get('type') == 'message':
+            yield compact_message(item, channel)
+
+
+class ExportReader:
+    """Day files of a Slack export, from a zip or a directory."""
+
+    def __init__(self, path):
+        self.path = path
+        self.zip = zipfile.ZipFile(path) if zipfile.is_zipfile(path) else None
+
+    def day_files(self):
+        """{channel: [member name, ...]} with each channel's day files in date order."""
+        if self.zip:
+            names = [n for n in self.zip.namelist() if not n.endswith('/')]
+        else:
+            names = [os.path.relpath(os.path.join(root, f), self.path).replace(os.sep, '/')
+                     for root, _, files in os.walk(self.path) for f in files]
+        channels = {}
+        for name in names:
+            parts = name.split('/')
+            # Top-level files (channels.json, users.json, ...) describe the workspace, not messages
+            if len(parts) >= 2 and parts[-1].endswith('.json'):
+                channels.setdefault(parts[-2], []).append(name)
+        return {channel: sorted(files) for channel, files in channels.items()}
+
+    def open(self, name):
+        if self.zip:
+            return self.zip.open(name)
+        return open(os.path.join(self.path, name), 'rb')
+
+
+def ingest_channel(export_path, channel, names, output_dir, output_format):
+    """Write one channel's messages; runs in a worker process, so it opens the export itself."""
+    reader = ExportReader(export_path)
+    count = 0
+    if output_format == 'jsonl':
+        temp_path = os.path.join(output_dir, channel + '.jsonl.tmp')
+        with open(temp_path, 'w') as output_f:
+            for name in names:
+                with reader.open(name) as stream:
+                    for message in iter_messages(stream, channel):
+                        output_f.write(json.dumps(message, ensure_ascii=False, separators=(',', ':')) + '\n')
+                        count += 1
+        os.replace(temp_path, os.path.join(output_dir, channel + '.jsonl'))
+    else:
+        channel_dir = os.path.join(output_dir, channel)
+        os.makedirs(channel_dir, exist_ok=True)
+        for name in names:
+            with reader.open(name) as stream:
+                messages = list(iter_messages(stream, channel))
+            if messages:
+                with open(os.path.join(channel_dir, os.path.basename(name)), 'w') as output_f:
+                    json.dump(messages, output_f)
+                count += len(messages)
+    return channel, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract messages from a Slack export zip or directory')
+    parser.add_argument('export', help='The export zip file (or unzipped export directory)')
+    parser.add_argument('output_dir')
+    parser.add_argument('--format', choices=['jsonl', 'days'], default='jsonl')
+    parser.add_argument('--channels', help='Comma-separated channel directories to ingest (default: all)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Channels processed in parallel')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    channels = ExportReader(args.export).day_files()
+    if args.channels:
+        wanted = set(args.channels.split(','))
+        channels = {c: names for c, names in channels.items() if c in wanted}
+
+    started = time.monotonic()
+    total = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        # Biggest channels first, so one large channel doesn't start last and hold up the end of the run
+        futures = [executor.submit(ingest_channel, args.export, channel, names, args.output_dir, args.format)
+                   for channel, names in sorted(channels.items(), key=lambda item: -len(item[1]))]
+        for future in as_completed(futures):
+            channel, count = future.result()
+            total += count
+            print(f'{channel}: {count} messages')
+    print(f'Wrote {total} messages from {len(channels)} channels in {time.monotonic() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
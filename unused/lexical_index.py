@@ -0,0 +1,380 @@
+"""
+BM25 keyword search over an embedding store's records (see embedding_store.py), and fusion with vector search.
+
+Embeddings are good at paraphrases but poor at exact strings: an error code, hostname or ticket number in a
+question usually isn't what makes two texts close in embedding space.  This index finds those offline and
+instantly, without the Slack search API or GPT-generated search terms.  Each row's message text is tokenized into
+lowercase words; compound tokens like db-01.prod.example.com, ERR_CONN_RESET or 10.0.0.12 are indexed whole and
+as their parts, so either form of a query matches.
+
+The posting lists are contiguous numpy arrays in a "bm25" directory inside the store: for each term, a slice of
+row ids (uint32) and term frequencies (uint16), 6 bytes per posting, memory-mapped on load.  Rows appended to the
+store later are added to an in-memory delta (add()); save() writes the rows added since the arrays were built as a
+delta segment beside them (delta.npz), and merges it into the arrays only once it passes a fraction of the index,
+so saving a few new rows doesn't rewrite every posting list.  Scoring a query reads only the posting lists of its
+terms.
+
+Vector and keyword results are combined by reciprocal rank fusion (the default), which needs no score
+calibration, or by a weighted sum of min-max normalized scores.  SEARCH_FUSION selects rrf, weighted or off, and
+SEARCH_LEXICAL_WEIGHT (default 0.5) is the keyword side's share of the weight.
+
+Usage:
+    python lexical_index.py build <store_dir>
+    python lexical_index.py add <store_dir>          # index rows appended since the last build/add
+    python lexical_index.py search <store_dir> "ERR_CONN_RESET on db-01" [--k 10]
+
+search_exports.py and the bot's search_workspace tool use the index automatically when the store has one.
+"""
+
+import argparse
+import json
+import math
+import os
+import re
+import time
+from collections import Counter
+
+import numpy as np
+
+from ann_index import _new_index_dir, _swap_in
+from embedding_store import EmbeddingStore
+from vector_search import top_k
+
+INDEX_DIR = 'bm25'
+FORMAT_VERSION = 1
+# Words, plus anything joined to them by . - : / @ (hostnames, IPs, paths, emails, versions)
+TOKEN = re.compile(r'\w+(?:[.\-:/@]\w+)*')
+PART = re.compile(r'[^\W_]+')
+
+
+def tokenize(text):
+    tokens = []
+    for token in TOKEN.findall(text.lower()):
+        tokens.append(token)
+        parts = PART.findall(token)
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+
+def record_text(record):
+    return '\n'.join(message.get('text', '') for message in record.get('messages', []))
+
+
+class LexicalIndex:
+    def __init__(self, path, header, terms, offsets, docs, tfs, doc_lengths, segment=None, main_rows=None):
+        self.path = path
+        self.k1 = header['k1']
+        self.b = header['b']
+        self.terms = terms
+        self.offsets = offsets
+        self.docs = docs
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths
+        self.total_length = int(doc_lengths.sum())
+        # Rows saved in the delta segment: term -> (row ids, term frequencies), and the rows in the arrays before it
+        self.segment = segment or {}
+        self.main_rows = len(doc_lengths) if main_rows is None else main_rows
+        # Rows saved to disk, so a reader can tell when the writer has saved more
+        self.saved_rows = len(doc_lengths)
+        # Rows added since the index was loaded: term -> ([row ids], [term frequencies])
+        self.delta = {}
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    @classmethod
+    def empty(cls, path=None, k1=1.2, b=0.75):
+        """An index with no rows, e.g. to be filled with add() and kept in memory."""
+        return cls(path, {'k1': k1, 'b': b}, {}, np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.uint32),
+                   np.zeros(0, dtype=np.uint16), np.zeros(0, dtype=np.uint32))
+
+    @classmethod
+    def build(cls, store, path, k1=1.2, b=0.75, block_rows=10000):
+        """Index every row of the store and write the index to path."""
+        terms = {}
+        term_ids = []
+        docs = []
+        tfs = []
+        lengths = []
+        for start in range(0, len(store), block_rows):
+            # Postings are gathered in Python lists a block at a time, then kept as arrays
+            block_terms = []
+            block_docs = []
+            block_tfs = []
+            for row, record in enumerate(store.records(range(start, min(start + block_rows, len(store)))), start):
+                counts = Counter(tokenize(record_text(record)))
+                lengths.append(sum(counts.values()))
+                for term, tf in counts.items():
+                    block_terms.append(terms.setdefault(term, len(terms)))
+                    block_docs.append(row)
+                    block_tfs.append(min(tf, 65535))
+            term_ids.append(np.array(block_terms, dtype=np.int64))
+            docs.append(np.array(block_docs, dtype=np.uint32))
+            tfs.append(np.array(block_tfs, dtype=np.uint16))
+        cls._write(path, {'k1': k1, 'b': b}, terms, np.concatenate(term_ids or [np.zeros(0, dtype=np.int64)]),
+                   np.concatenate(docs or [np.zeros(0, dtype=np.uint32)]),
+                   np.concatenate(tfs or [np.zeros(0, dtype=np.uint16)]), np.array(lengths, dtype=np.uint32))
+        return cls.load(path)
+
+    def add(self, texts):
+        """Index texts as the next rows; they are searchable straight away and written by save()."""
+        lengths = []
+        for row, text in enumerate(texts, len(self)):
+            counts = Counter(tokenize(text))
+            lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                docs, tfs = self.delta.setdefault(term, ([], []))
+                docs.append(row)
+                tfs.append(min(tf, 65535))
+        self.doc_lengths = np.concatenate([self.doc_lengths, np.asarray(lengths, dtype=np.uint32)])
+        self.total_length += sum(lengths)
+
+    def postings(self, term):
+        """(row ids, term frequencies) of the rows containing term."""
+        docs = []
+        tfs = []
+        term_id = self.terms.get(term)
+        if term_id is not None:
+            docs.append(self.docs[self.offsets[term_id]:self.offsets[term_id + 1]])
+            tfs.append(self.tfs[self.offsets[term_id]:self.offsets[term_id + 1]])
+        if term in self.segment:
+            docs.append(self.segment[term][0])
+            tfs.append(self.segment[term][1])
+        if term in self.delta:
+            docs.append(np.asarray(self.delta[term][0], dtype=np.uint32))
+            tfs.append(np.asarray(self.delta[term][1], dtype=np.uint16))
+        if not docs:
+            return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint16)
+        return np.concatenate(docs), np.concatenate(tfs)
+
+    def search(self, query, k, deleted=None):
+        """(row ids, BM25 scores) of the top k rows for query, best first; rows marked in deleted are skipped."""
+        if not len(self):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        average_length = self.total_length / len(self)
+        docs = []
+        scores = []
+        for term in set(tokenize(query)):
+            term_docs, tfs = self.postings(term)
+            if not len(term_docs):
+                continue
+            idf = math.log(1 + (len(self) - len(term_docs) + 0.5) / (len(term_docs) + 0.5))
+            tfs = tfs.astype(np.float32)
+            lengths = self.doc_lengths[term_docs]
+            docs.append(term_docs)
+            scores.append(idf * tfs * (self.k1 + 1) / (tfs + self.k1 * (1 - self.b + self.b * lengths / average_length)))
+        if not docs:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        rows, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(scores)).astype(np.float32)
+        if deleted is not None:
+            live = ~deleted[rows]
+            rows, totals = rows[live], totals[live]
+        best, best_scores = top_k(totals, k)
+        return rows[best].astype(np.int64), best_scores
+
+    def save(self, max_delta_fraction=0.1):
+        """Write the rows added since the posting arrays were built, and return the reloaded index.
+
+        They go into the delta segment, unless it would then hold more than max_delta_fraction of the postings, in
+        which case everything is merged into new posting arrays."""
+        delta = {}
+        for term in self.segment.keys() | self.delta.keys():
+            docs, tfs = self.segment.get(term, ((), ()))
+            added_docs, added_tfs = self.delta.get(term, ([], []))
+            delta[term] = (np.concatenate([np.asarray(docs, dtype=np.uint32), np.asarray(added_docs, dtype=np.uint32)]),
+                           np.concatenate([np.asarray(tfs, dtype=np.uint16), np.asarray(added_tfs, dtype=np.uint16)]))
+        if (sum(len(docs) for docs, _ in delta.values()) > max_delta_fraction * max(1, len(self.docs))
+                or not os.path.exists(os.path.join(self.path, 'bm25.json'))):
+            return self._merge(delta)
+        # The posting arrays never change in place; only the delta segment and the header are rewritten
+        terms = sorted(delta)
+        offsets = np.cumsum([0] + [len(delta[term][0]) for term in terms]).astype(np.int64)
+        temp_file = os.path.join(self.path, 'delta.new.npz')
+        np.savez(temp_file, terms=np.array(terms, dtype=str), offsets=offsets,
+                 docs=np.concatenate([delta[term][0] for term in terms] or [np.zeros(0, dtype=np.uint32)]),
+                 tfs=np.concatenate([delta[term][1] for term in terms] or [np.zeros(0, dtype=np.uint16)]),
+                 doc_lengths=self.doc_lengths[self.main_rows:])
+        os.replace(temp_file, os.path.join(self.path, 'delta.npz'))
+        with open(os.path.join(self.path, 'bm25.json')) as header_f:
+            header = json.load(header_f)
+        header['count'] = len(self)
+        with open(os.path.join(self.path, 'bm25.json.tmp'), 'w') as header_f:
+            json.dump(header, header_f, indent=4)
+        os.replace(os.path.join(self.path, 'bm25.json.tmp'), os.path.join(self.path, 'bm25.json'))
+        return self.load(self.path)
+
+    def _merge(self, delta):
+        """Write new posting arrays holding the delta's postings too (and no delta segment)."""
+        terms = dict(self.terms)
+        for term in delta:
+            terms.setdefault(term, len(terms))
+        # Flatten the delta into (term id, row, tf) and sort it together with the existing postings
+        delta_terms = np.concatenate([np.full(len(docs), terms[term], dtype=np.int64)
+                                      for term, (docs, _) in delta.items()] or [np.zeros(0, dtype=np.int64)])
+        delta_docs = np.concatenate([docs for docs, _ in delta.values()] or [np.zeros(0, dtype=np.uint32)])
+        delta_tfs = np.concatenate([tfs for _, tfs in delta.values()] or [np.zeros(0, dtype=np.uint16)])
+        term_ids = np.concatenate([np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets)), delta_terms])
+        self._write(self.path, {'k1': self.k1, 'b': self.b}, terms, term_ids, np.concatenate([self.docs, delta_docs]),
+                    np.concatenate([self.tfs, delta_tfs]), self.doc_lengths)
+        return self.load(self.path)
+
+    @staticmethod
+    def _write(path, header, terms, term_ids, docs, tfs, doc_lengths):
+        """Sort (term id, row, tf) postings into per-term slices and write them to path."""
+        order = np.lexsort((docs, term_ids))
+        offsets = np.searchsorted(term_ids[order], np.arange(len(terms) + 1)).astype(np.int64)
+        temp_path = _new_index_dir(path)
+        np.save(os.path.join(temp_path, 'offsets.npy'), offsets)
+        np.save(os.path.join(temp_path, 'docs.npy'), docs[order])
+        np.save(os.path.join(temp_path, 'tfs.npy'), tfs[order])
+        np.save(os.path.join(temp_path, 'doc_lengths.npy'), doc_lengths)
+        with open(os.path.join(temp_path, 'terms.json'), 'w') as terms_f:
+            # In term id order, so the list index is the id
+            json.dump(sorted(terms, key=terms.get), terms_f)
+        with open(os.path.join(temp_path, 'bm25.json'), 'w') as header_f:
+            json.dump(dict(header, version=FORMAT_VERSION, count=len(doc_lengths), terms=len(terms), postings=len(docs)),
+                      header_f, indent=4)
+        _swap_in(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'bm25.json')) as header_f:
+            header = json.load(header_f)
+        if header['version'] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported BM25 index version {header['version']} in {path}")
+        with open(os.path.join(path, 'terms.json')) as terms_f:
+            terms = {term: term_id for term_id, term in enumerate(json.load(terms_f))}
+        doc_lengths = np.load(os.path.join(path, 'doc_lengths.npy'))
+        main_rows = len(doc_lengths)
+        segment = {}
+        if os.path.exists(os.path.join(path, 'delta.npz')):
+            delta = np.load(os.path.join(path, 'delta.npz'))
+            offsets, docs, tfs = delta['offsets'], delta['docs'], delta['tfs']
+            segment = {term: (docs[offsets[i]:offsets[i + 1]], tfs[offsets[i]:offsets[i + 1]])
+                       for i, term in enumerate(delta['terms'].tolist())}
+            doc_lengths = np.concatenate([doc_lengths, delta['doc_lengths']])
+        return cls(path, header, terms,
+                   np.load(os.path.join(path, 'offsets.npy')),
+                   np.load(os.path.join(path, 'docs.npy'), mmap_mode='r'),
+                   np.load(os.path.join(path, 'tfs.npy'), mmap_mode='r'),
+                   doc_lengths, segment, main_rows)
+
+    def add_rows(self, store):
+        """Index the store's rows appended since this index was built or last added to."""
+        if len(self) < len(store):
+            self.add([record_text(record) for record in store.records(range(len(self), len(store)))])
+
+
+def index_path(store):
+    return os.path.join(store.path, INDEX_DIR)
+
+
+def open_lexical(store):
+    """The store's BM25 index, or None if it hasn't been built."""
+    path = index_path(store)
+    return LexicalIndex.load(path) if os.path.exists(os.path.join(path, 'bm25.json')) else None
+
+
+def saved_rows(store):
+    """The number of rows the store's BM25 index on disk covers, from its header (0 if it hasn't been built)."""
+    try:
+        with open(os.path.join(index_path(store), 'bm25.json')) as header_f:
+            return json.load(header_f)['count']
+    except FileNotFoundError:
+        return 0
+
+
+def reciprocal_rank_fusion(rankings, weights=None, k=60):
+    """(ids, scores) ranked by the weighted sum of 1 / (k + rank) over the rankings (arrays of ids, best first)."""
+    scores = {}
+    for ranking, weight in zip(rankings, weights or [1] * len(rankings)):
+        for rank, row in enumerate(np.asarray(ranking).tolist()):
+            scores[row] = scores.get(row, 0) + weight / (k + rank + 1)
+    ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+    return (np.array([row for row, _ in ranked], dtype=np.int64),
+            np.array([score for _, score in ranked], dtype=np.float32))
+
+
+def merge_ranked(result_lists, k=60):
+    """The items of several result lists (each best first) in one ranking, by reciprocal rank fusion of their ranks.
+
+    The lists' own scores needn't share a scale (cosine from one store, RRF or min-max scaled fused scores from
+    another), so only each item's rank within its list counts; the items are returned unchanged.
+    """
+    items = [item for results in result_lists for item in results]
+    starts = np.cumsum([0] + [len(results) for results in result_lists])
+    rankings = [np.arange(start, start + len(results)) for start, results in zip(starts, result_lists)]
+    ids, _ = reciprocal_rank_fusion(rankings, k=k)
+    return [items[i] for i in ids.tolist()]
+
+
+def weighted_fusion(results, weights):
+    """(ids, scores) ranked by the weighted sum of each result list's (ids, scores), min-max normalized per list."""
+    scores = {}
+    for (rows, row_scores), weight in zip(results, weights):
+        if not len(rows):
+            continue
+        row_scores = np.asarray(row_scores, dtype=np.float64)
+        spread = row_scores.max() - row_scores.min()
+        normalized = (row_scores - row_scores.min()) / spread if spread > 0 else np.ones(len(row_scores))
+        for row, score in zip(np.asarray(rows).tolist(), normalized.tolist()):
+            scores[row] = scores.get(row, 0) + weight * score
+    ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+    return (np.array([row for row, _ in ranked], dtype=np.int64),
+            np.array([score for _, score in ranked], dtype=np.float32))
+
+
+def fusion_settings():
+    """(method, lexical weight) from SEARCH_FUSION and SEARCH_LEXICAL_WEIGHT."""
+    method = os.environ.get('SEARCH_FUSION', 'rrf').lower()
+    if method not in ('rrf', 'weighted', 'off'):
+        raise ValueError(f'SEARCH_FUSION must be rrf, weighted or off, not {method!r}')
+    return method, float(os.environ.get('SEARCH_LEXICAL_WEIGHT', '0.5'))
+
+
+def fuse(vector, lexical, method='rrf', lexical_weight=0.5):
+    """Combine (ids, scores) from vector and keyword search into one (ids, scores) ranking, best first."""
+    weights = [1 - lexical_weight, lexical_weight]
+    if method == 'weighted':
+        return weighted_fusion([vector, lexical], weights)
+    return reciprocal_rank_fusion([vector[0], lexical[0]], weights)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build, extend or query the BM25 index of an embedding store')
+    parser.add_argument('command', choices=['build', 'add', 'search'])
+    parser.add_argument('store_dir')
+    parser.add_argument('query', nargs='?', help='Keywords to search for (search only)')
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    store = EmbeddingStore(args.store_dir)
+    started = time.monotonic()
+    if args.command == 'build':
+        index = LexicalIndex.build(store, index_path(store))
+        print(f'Indexed {len(index)} rows ({len(index.terms)} terms, {len(index.docs)} postings) '
+              f'in {time.monotonic() - started:.1f}s')
+    elif args.command == 'add':
+        index = LexicalIndex.load(index_path(store))
+        start = len(index)
+        index.add_rows(store)
+        if len(index) > start:
+            index = index.save()
+        print(f'Added {len(index) - start} rows; the index now covers {len(index)} rows')
+    else:
+        if not args.query:
+            parser.error('search needs a query')
+        index = open_lexical(store)
+        if index is None:
+            parser.error(f'{args.store_dir} has no BM25 index; build one first')
+        index.add_rows(store)
+        rows, scores = index.search(args.query, args.k, store.deleted if store.deleted_count else None)
+        print(f'{len(rows)} results in {(time.monotonic() - started) * 1000:.1f} ms')
+        for row, score, record in zip(rows, scores, store.records(rows)):
+            print(f"{score:.3f} {record.get('source', row)}: {record_text(record)[:200]!r}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+Near-duplicate message detection with MinHash LSH, used by pack_messages.py and pipeline.py (--dedup) and to report
+the diversity of search results.
+
+Exports are full of repeated alerts, bot notifications and pasted logs that differ only in timestamps, counters or
+IDs.  Each message's text is normalized (lowercased, and every word containing a digit replaced by a placeholder) and
+cut into overlapping word 3-grams, and a MinHash signature of `num_perm` values estimates the Jaccard similarity of
+two messages' 3-gram sets.  Signatures are split into bands and hashed into buckets (locality-sensitive hashing), so
+a message is only compared with the cluster representatives it shares a bucket with.  A message at least `threshold`
+similar to a representative joins its cluster; otherwise it starts a new one.  Messages with fewer than
+`min_shingles` 3-grams ("thanks!", "+1") are never clustered, as they are alike without being repeats.
+
+When packing, only the first message of each cluster (its representative) goes into a window, so it is embedded
+once and its copies no longer fill windows, and search results, of their own.  The cluster's membership list (the
+timestamps of the copies, by representative) is written to <output_dir>/.clusters/<channel>.json.
+
+Usage:
+    python near_duplicates.py trimmed/ [--threshold 0.8] [--top 5]
+"""
+
+import argparse
+import json
+import os
+import re
+import zlib
+
+import numpy as np
+
+CLUSTERS_DIR = '.clusters'
+WORD = re.compile(r'\w+')
+HAS_DIGIT = re.compile(r'\d')
+PRIME = (1 << 31) - 1
+
+
+def shingles(text, size=3):
+    """The set of word `size`-grams of the normalized text, as 32-bit hashes."""
+    words = ['#' if HAS_DIGIT.search(word) else word for word in WORD.findall(text.lower())]
+    return {zlib.crc32(' '.join(words[i:i + size]).encode('utf-8')) for i in range(len(words) - size + 1)}
+
+
+class NearDuplicates:
+    """Clusters of near-identical texts, found with MinHash signatures and LSH buckets."""
+
+    def __init__(self, threshold=0.8, num_perm=64, rows=4, min_shingles=5, seed=1):
+        self.threshold = threshold
+        self.rows = rows
+        self.min_shingles = min_shingles
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, PRIME, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, PRIME, num_perm, dtype=np.uint64)
+        # (band, band's signature values) -> representatives
+        self.buckets = {}
+        self.signatures = {}
+        # representative -> the keys of its copies
+        self.clusters = {}
+        self.items = 0
+        self.duplicates = 0
+        self.duplicate_tokens = 0
+
+    def signature(self, hashes):
+        x = np.fromiter(hashes, dtype=np.uint64, count=len(hashes))[None, :]
+        return ((self.a[:, None] * x + self.b[:, None]) % PRIME).min(axis=1)
+
+    def add(self, key, text):
+        """The representative of the cluster the text joins, or None if it starts one (or is too short to cluster)."""
+        self.items += 1
+        hashes = shingles(text)
+        if len(hashes) < self.min_shingles:
+            return None
+        signature = self.signature(hashes)
+        bands = [(band, signature[start:start + self.rows].tobytes())
+                 for band, start in enumerate(range(0, len(signature), self.rows))]
+        best, best_similarity = None, self.threshold
+        for candidate in {candidate for band in bands for candidate in self.buckets.get(band, ())}:
+            # The share of equal MinHash values estimates the Jaccard similarity of the 3-gram sets
+            similarity = np.mean(self.signatures[candidate] == signature)
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+        if best is not None:
+            self.clusters[best].append(key)
+            self.duplicates += 1
+            return best
+        self.signatures[key] = signature
+        self.clusters[key] = []
+        for band in bands:
+            self.buckets.setdefault(band, []).append(key)
+        return None
+
+    def collapse(self, messages, token_count=None):
+        """Yield the (date, message) pairs that aren't near-duplicates of an earlier message, in order.
+
+        With token_count, the tokens of the dropped messages are added up in duplicate_tokens."""
+        for i, (date, message) in enumerate(messages):
+            if self.add(message.get('ts', i), message.get('text', '')) is None:
+                yield date, message
+            elif token_count is not None:
+                self.duplicate_tokens += token_count(json.dumps(message)) + 1
+
+    def membership(self):
+        """{representative: [keys of its copies]} for the clusters that have copies."""
+        return {key: members for key, members in self.clusters.items() if members}
+
+    def stats(self):
+        return {'messages': self.items, 'duplicates': self.duplicates,
+                'clusters': sum(1 for members in self.clusters.values() if members),
+                'tokens': self.duplicate_tokens}
+
+
+def write_membership(duplicates, output_dir, channel):
+    path = os.path.join(output_dir, CLUSTERS_DIR, channel + '.json')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as clusters_f:
+        json.dump(duplicates.membership(), clusters_f, separators=(',', ':'))
+    os.replace(path + '.tmp', path)
+
+
+def report(stats):
+    """One line on what deduplication saved, from summed stats() results."""
+    ratio = stats['duplicates'] / stats['messages'] if stats['messages'] else 0.0
+    line = (f"Near-duplicates: {stats['duplicates']} of {stats['messages']} messages ({ratio:.1%}) collapsed into "
+            f"{stats['clusters']} clusters")
+    return line + f"; {stats['tokens']} tokens not embedded" if stats['tokens'] else line
+
+
+def diversity(texts, threshold=0.8):
+    """The share of texts that aren't near-duplicates of an earlier one, e.g. of the top k search results."""
+    if not texts:
+        return 1.0
+    duplicates = NearDuplicates(threshold)
+    for i, text in enumerate(texts):
+        duplicates.add(i, text)
+    return 1 - duplicates.duplicates / len(texts)
+
+
+def main():
+    from pack_messages import find_channels, read_channel
+
+    parser = argparse.ArgumentParser(description='Report the near-duplicate messages in each channel')
+    parser.add_argument('input_dir', help='Directory of channel directories of day files, or of channel .jsonl files')
+    parser.add_argument('--threshold', type=float, default=0.8, help='Estimated Jaccard similarity to count as a copy')
+    parser.add_argument('--top', type=int, default=5, help='Largest clusters to show per channel')
+    args = parser.parse_args()
+
+    totals = {'messages': 0, 'duplicates': 0, 'clusters': 0, 'tokens': 0}
+    for channel, source in find_channels(args.input_dir).items():
+        duplicates = NearDuplicates(args.threshold)
+        texts = {}
+        for i, (_, message) in enumerate(read_channel(source)):
+            key = message.get('ts', i)
+            texts[key] = message.get('text', '')
+            duplicates.add(key, texts[key])
+        stats = duplicates.stats()
+        totals = {name: totals[name] + stats[name] for name in totals}
+        print(f"{channel}: {stats['duplicates']} of {stats['messages']} messages are copies, in {stats['clusters']} clusters")
+        largest = sorted(duplicates.membership().items(), key=lambda item: -len(item[1]))[:args.top]
+        for key, members in largest:
+            print(f"    {len(members) + 1} x {texts[key][:100]!r}")
+    print(report(totals))
+
+
+if __name__ == '__main__':
+    main()
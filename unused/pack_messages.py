@@ -0,0 +1,224 @@
+"""
+Pack a channel's messages into windows of up to a token budget, for embedding.  Replaces combine_messages.py.
+
+Input is either the per-day layout (<input_dir>/<channel>/<YYYY-MM-DD>.json, as extract_messages.py or
+`ingest_export.py --format days` write it) or per-channel JSONL (<input_dir>/<channel>.jsonl, from ingest_export.py).
+Each message is tokenized once, and its count is kept in a cache keyed by a hash of its serialized form, so a re-run
+over an updated export only tokenizes new or edited messages.  Messages are then packed in one pass, in order: a
+window is closed when the next message would take it over --max-tokens, and a message that is over the budget on
+its own gets a window to itself.
+
+With --min-tokens, a window is also closed after a "boundary" message (about one in eight, picked by a hash of its
+content) once it holds at least that many tokens.  Window boundaries then depend on the messages around them rather
+than on everything before them, so editing an old message only changes the windows near it instead of shifting
+every later window; pipeline.py relies on this to re-embed as little as possible.
+
+With --dedup, near-duplicate messages (repeated alerts, bot notifications, pasted logs; see near_duplicates.py) are
+collapsed: only the first of each cluster is packed, and the clusters' membership lists are written alongside.
+
+Windows are written as JSON lists to <output_dir>/<channel>/<first date>-<last date>.json, with -partNN added when
+several windows cover the same dates, so get-all-embeddings.py and combine_into_json.py work on the result as they
+did on combine_messages.py's.  Channels are packed in parallel, and the output only depends on the input.
+
+Usage:
+    python pack_messages.py trimmed/ combined/ [--max-tokens 1000] [--workers N] [--dedup 0.8]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+from near_duplicates import NearDuplicates, report, write_membership
+from token_chunker import count_tokens
+
+EMBEDDING_MODEL = 'text-embedding-ada-002'
+CACHE_DIR = '.token-cache'
+BOUNDARY_ONE_IN = 8
+
+
+class TokenCache:
+    """Token counts of serialized messages, keyed by content hash and saved per channel."""
+
+    def __init__(self, path, model=EMBEDDING_MODEL):
+        self.path = path
+        self.model = model
+        self.counts = {}
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(path):
+            with open(path) as cache_f:
+                cache = json.load(cache_f)
+            if cache.get('model') == model:
+                self.counts = cache['counts']
+
+    def count(self, serialized):
+        key = hashlib.blake2b(serialized.encode('utf-8'), digest_size=16).hexdigest()
+        tokens = self.counts.get(key)
+        if tokens is None:
+            tokens = self.counts[key] = count_tokens(serialized, model=self.model)
+            self.misses += 1
+        else:
+            self.hits += 1
+        return tokens
+
+    def save(self):
+        if not self.misses:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.tmp', 'w') as cache_f:
+            json.dump({'model': self.model, 'counts': self.counts}, cache_f, separators=(',', ':'))
+        os.replace(self.path + '.tmp', self.path)
+
+
+def find_channels(input_dir):
+    """{channel: source} for each channel directory or .jsonl file in input_dir."""
+    channels = {}
+    for name in sorted(os.listdir(input_dir)):
+        path = os.path.join(input_dir, name)
+        if os.path.isdir(path):
+            channels[name] = path
+        elif name.endswith('.jsonl'):
+            channels[name[:-len('.jsonl')]] = path
+    return channels
+
+
+def read_channel(source):
+    """Yield (date, message) in order from a channel directory of day files or a channel .jsonl file."""
+    if os.path.isdir(source):
+        for filename in sorted(os.listdir(source)):
+            if filename.endswith('.json'):
+                with open(os.path.join(source, filename)) as day_f:
+                    for message in json.load(day_f):
+                        # The channel is already given by the output directory
+                        message.pop('channel', None)
+                        yield filename[:-len('.json')], message
+    else:
+        with open(source) as channel_f:
+            for line in channel_f:
+                message = json.loads(line)
+                message.pop('channel', None)
+                yield datetime.fromtimestamp(float(message['ts']), timezone.utc).strftime('%Y-%m-%d'), message
+
+
+def pack(messages, max_tokens, token_count, min_tokens=None):
+    """Yield (first date, last date, messages, tokens) windows from (date, message) pairs in one pass.
+
+    A window's tokens are the sum of its messages' serialized token counts plus one per message for the separator,
+    which comes to about the token count of the window written as a JSON list."""
+    window = []
+    window_tokens = 0
+    first_date = last_date = None
+    boundary = False
+    for date, message in messages:
+        serialized = json.dumps(message)
+        tokens = token_count(serialized) + 1
+        if window and (window_tokens + tokens > max_tokens or boundary):
+            yield first_date, last_date, window, window_tokens
+            window = []
+            window_tokens = 0
+        if not window:
+            first_date = date
+        window.append(message)
+        window_tokens += tokens
+        last_date = date
+        boundary = (min_tokens is not None and window_tokens >= min_tokens
+                    and zlib.crc32(serialized.encode('utf-8')) % BOUNDARY_ONE_IN == 0)
+    if window:
+        yield first_date, last_date, window, window_tokens
+
+
+def write_windows(windows, output_dir):
+    """Write windows named by their date range, numbering the parts of consecutive windows with the same range."""
+    count = 0
+    group = []
+
+    def flush():
+        for part, window in enumerate(group):
+            first_date, last_date, messages, _ = window
+            suffix = '-part' + str(part).zfill(2) if len(group) > 1 else ''
+            with open(os.path.join(output_dir, f'{first_date}-{last_date}{suffix}.json'), 'w') as window_f:
+                json.dump(messages, window_f)
+
+    for window in windows:
+        if group and window[:2] != group[0][:2]:
+            flush()
+            group = []
+        group.append(window)
+        count += 1
+    flush()
+    return count
+
+
+def pack_channel(channel, source, output_dir, max_tokens, model=EMBEDDING_MODEL, min_tokens=None, dedup=None):
+    """Pack one channel into output_dir/channel, replacing any previous windows; runs in a worker process.
+
+    With dedup (a similarity threshold), near-duplicate messages are left out; the last value returned is then the
+    NearDuplicates stats(), otherwise None."""
+    cache = TokenCache(os.path.join(output_dir, CACHE_DIR, channel + '.json'), model)
+    channel_dir = os.path.join(output_dir, channel)
+    temp_dir = channel_dir + '.tmp'
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    messages = read_channel(source)
+    duplicates = NearDuplicates(dedup) if dedup else None
+    if duplicates:
+        messages = duplicates.collapse(messages, cache.count)
+    windows = write_windows(pack(messages, max_tokens, cache.count, min_tokens), temp_dir)
+    # Swap the new windows in whole, so stale windows from an earlier run don't linger
+    if os.path.exists(channel_dir):
+        shutil.rmtree(channel_dir)
+    os.replace(temp_dir, channel_dir)
+    cache.save()
+    if duplicates:
+        write_membership(duplicates, output_dir, channel)
+    return channel, cache.hits + cache.misses, cache.misses, windows, duplicates.stats() if duplicates else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack message files into windows of up to a token budget')
+    parser.add_argument('input_dir', help='Directory of channel directories of day files, or of channel .jsonl files')
+    parser.add_argument('output_dir')
+    parser.add_argument('--max-tokens', type=int, default=1000, help='Token budget per window')
+    parser.add_argument('--min-tokens', type=int, help='Also close a window at a content-defined boundary once it has this many tokens')
+    parser.add_argument('--model', default=EMBEDDING_MODEL, help='Model whose tokenizer to count with')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Channels packed in parallel')
+    parser.add_argument('--dedup', type=float, help='Leave out messages at least this similar to an earlier one (e.g. 0.8)')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    channels = find_channels(args.input_dir)
+    started = time.monotonic()
+    totals = [0, 0, 0]
+    duplicate_totals = {'messages': 0, 'duplicates': 0, 'clusters': 0, 'tokens': 0}
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        # Largest channels first, so the run isn't held up by a big channel started last
+        futures = [executor.submit(pack_channel, channel, source, args.output_dir, args.max_tokens, args.model,
+                                   args.min_tokens, args.dedup)
+                   for channel, source in sorted(channels.items(), key=lambda item: -_size(item[1]))]
+        for future in as_completed(futures):
+            channel, messages, tokenized, windows, duplicates = future.result()
+            totals = [t + n for t, n in zip(totals, (messages, tokenized, windows))]
+            print(f'{channel}: {messages} messages ({tokenized} tokenized) in {windows} windows')
+            if duplicates:
+                duplicate_totals = {name: duplicate_totals[name] + duplicates[name] for name in duplicate_totals}
+    messages, tokenized, windows = totals
+    print(f'Packed {messages} messages ({tokenized} tokenized, {messages - tokenized} cached) into {windows} windows '
+          f'from {len(channels)} channels in {time.monotonic() - started:.1f}s')
+    if args.dedup:
+        print(report(duplicate_totals))
+
+
+def _size(source):
+    if os.path.isdir(source):
+        return sum(entry.stat().st_size for entry in os.scandir(source))
+    return os.path.getsize(source)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,369 @@
+"""
+One command from a Slack export to a searchable embedding store, redoing only what changed since the last run.
+
+Replaces running process_slack_export.py / extract_messages.py, combine_messages.py, get-all-embeddings.py and
+combine_into_json.py in turn.  Everything lives in a work directory:
+    manifest.json   content hashes of every day file and window seen, and the store rows of each window
+    days/           <channel>/<YYYY-MM-DD>.json, each day's messages, accumulated across exports
+    windows/        <channel>/<first date>-<last date>.json, the days packed into windows (see pack_messages.py)
+    store/          the embedding store (see embedding_store.py) that search_exports.py searches
+
+Each run:
+    1. compares the export's day files with the manifest, by the zip's CRC-32 of each member or a hash of each file
+       of an unzipped export.  Only new or changed days are extracted; days missing from the export are kept, so a
+       partial (e.g. daily) export adds to what is already there.
+    2. re-packs the channels with changed days, in a process pool.  Packing is deterministic, token counts are
+       cached, and windows also close at content-defined boundaries (pack_messages.py --min-tokens), so only the
+       windows around a changed day come out different.  Windows are matched by content, so a window whose name
+       changed (a new -partNN) keeps its rows.  With --dedup, near-duplicate messages are collapsed into clusters
+       first (see near_duplicates.py), so only the first of each is embedded and searched.
+    3. embeds the windows whose content hash isn't in the manifest (through the embedding cache, see
+       embedding_cache.py), starting on each channel as soon as it is packed while other channels are still going.
+    4. updates the store in place: new windows are appended, and the rows of changed or vanished windows are
+       tombstoned.  If the store has an IVF index (see ann_index.py), the new rows are added to it, and its BM25
+       keyword index (see lexical_index.py) is built or extended.
+
+The store and the manifest are updated together every --flush-rows rows, so an interrupted run picks up where it
+stopped.  A channel's days are only recorded once all of its windows are in the store.
+
+Usage:
+    python pipeline.py export.zip work/ [--max-tokens 1000] [--workers N] [--concurrency 4] [--dedup 0.8] [--rebuild]
+    python search_exports.py work/store "Your question"
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from openai import OpenAI
+
+from ann_index import open_index
+from embedding_cache import open_cache
+from embedding_engine import EMBEDDING_MODEL, EmbeddingEngine, RateBudget
+from embedding_store import EmbeddingStore
+from ingest_export import ExportReader, iter_messages
+from lexical_index import LexicalIndex, index_path as lexical_index_path, open_lexical
+from near_duplicates import report as duplicates_report
+from pack_messages import pack_channel
+from token_chunker import encode, get_encoder, split_tokens
+
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 1
+DAYS_DIR = 'days'
+WINDOWS_DIR = 'windows'
+STORE_DIR = 'store'
+MAX_INPUT_TOKENS = 8000
+
+
+def file_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def day_signatures(reader):
+    """{channel: {day file: signature}} for every day file in the export."""
+    signatures = {}
+    for channel, names in reader.day_files().items():
+        if reader.zip:
+            # The zip already holds a CRC-32 of each member, so nothing has to be decompressed to compare
+            infos = [reader.zip.getinfo(name) for name in names]
+            signatures[channel] = {os.path.basename(i.filename): f'{i.CRC:08x}-{i.file_size}' for i in infos}
+        else:
+            signatures[channel] = {os.path.basename(name): file_hash(os.path.join(reader.path, name)) for name in names}
+    return signatures
+
+
+def update_channel(export_path, channel, names, work_dir, max_tokens, min_tokens, model, dedup=None):
+    """Extract a channel's changed day files and re-pack the channel; runs in a worker process.
+
+    Returns the channel, {window file: content hash} for all of its windows, and the near-duplicate stats (or
+    None without dedup)."""
+    reader = ExportReader(export_path)
+    days_dir = os.path.join(work_dir, DAYS_DIR, channel)
+    os.makedirs(days_dir, exist_ok=True)
+    for name in names:
+        with reader.open(name) as stream:
+            messages = list(iter_messages(stream, channel))
+        for message in messages:
+            del message['channel']
+        # Days without messages are written too, so they still replace an earlier version of the day
+        day_path = os.path.join(days_dir, os.path.basename(name))
+        with open(day_path + '.tmp', 'w') as day_f:
+            json.dump(messages, day_f)
+        os.replace(day_path + '.tmp', day_path)
+    windows_dir = os.path.join(work_dir, WINDOWS_DIR)
+    duplicates = pack_channel(channel, days_dir, windows_dir, max_tokens, model, min_tokens, dedup)[-1]
+    channel_dir = os.path.join(windows_dir, channel)
+    return (channel, {name: file_hash(os.path.join(channel_dir, name)) for name in sorted(os.listdir(channel_dir))},
+            duplicates)
+
+
+def load_manifest(work_dir):
+    path = os.path.join(work_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as manifest_f:
+        return json.load(manifest_f)
+
+
+def save_manifest(work_dir, manifest):
+    path = os.path.join(work_dir, MANIFEST_FILE)
+    with open(path + '.tmp', 'w') as manifest_f:
+        json.dump(manifest, manifest_f, separators=(',', ':'))
+    os.replace(path + '.tmp', path)
+
+
+class StoreUpdater:
+    """Applies embedded windows to the store and the manifest in batches, keeping the two consistent."""
+
+    def __init__(self, work_dir, manifest, dtype='float32', flush_rows=1000):
+        self.work_dir = work_dir
+        self.manifest = manifest
+        self.dtype = dtype
+        self.flush_rows = flush_rows
+        store_path = os.path.join(work_dir, STORE_DIR)
+        self.store = EmbeddingStore(store_path) if os.path.exists(os.path.join(store_path, 'store.json')) else None
+        if self.store is not None and len(self.store) > manifest['store_count']:
+            # Rows appended by an interrupted run that never made it into the manifest
+            print(f"Removing {len(self.store) - manifest['store_count']} rows left by an interrupted run")
+            self.store.delete(np.arange(manifest['store_count'], len(self.store)))
+            manifest['store_count'] = len(self.store)
+        # (channel, window) -> the window's hash, messages and part embeddings while it is being embedded
+        self.in_flight = {}
+        # Channels waiting for their windows to be applied before their days are recorded
+        self.channels = {}
+        self.finished = []
+        self.deletes = []
+        self.removed = []
+        self.pending_rows = 0
+        self.added = 0
+        self.tombstoned = 0
+        self.failed = 0
+
+    def add_channel(self, channel, windows, days):
+        """Queue a re-packed channel's changes; returns the (key, text, token count) inputs to embed."""
+        known = self.manifest['windows'].setdefault(channel, {})
+        # Windows that are gone under their old name, by content, in case they reappear under a new one
+        vanished = {window['hash']: name for name, window in known.items() if name not in windows}
+        items = []
+        for name, window_hash in windows.items():
+            if known.get(name, {}).get('hash') == window_hash:
+                continue
+            if window_hash in vanished:
+                # Same messages under a new name (e.g. a new -partNN): keep the rows, whose records still give the
+                # old name as their source
+                if name in known:
+                    self.deletes.extend(known[name]['rows'])
+                known[name] = known.pop(vanished.pop(window_hash))
+                continue
+            with open(os.path.join(self.work_dir, WINDOWS_DIR, channel, name)) as window_f:
+                text = window_f.read()
+            tokens = encode(text, self.manifest['model'])
+            parts = split_tokens(tokens, MAX_INPUT_TOKENS) if len(tokens) > MAX_INPUT_TOKENS else [tokens]
+            self.in_flight[(channel, name)] = {'hash': window_hash, 'messages': json.loads(text),
+                                               'embeddings': [None] * len(parts), 'remaining': len(parts)}
+            for part, part_tokens in enumerate(parts):
+                part_text = text if len(parts) == 1 else get_encoder(self.manifest['model']).decode(part_tokens)
+                items.append(((channel, name, part), part_text, len(part_tokens)))
+        self.removed.extend((channel, name) for name in vanished.values())
+        self.channels[channel] = {'days': days, 'outstanding': len({(c, n) for (c, n, _), _, _ in items})}
+        return items
+
+    def on_batch(self, batch, embeddings):
+        for ((channel, name, part), _, _), embedding in zip(batch, embeddings):
+            window = self.in_flight[(channel, name)]
+            window['remaining'] -= 1
+            if embedding is None:
+                window['failed'] = True
+            else:
+                window['embeddings'][part] = embedding
+            if window['remaining'] == 0:
+                del self.in_flight[(channel, name)]
+                if window.get('failed'):
+                    # Left out of the manifest, so the next run tries it again
+                    self.failed += 1
+                else:
+                    self.finished.append((channel, name, window))
+                    self.pending_rows += len(window['embeddings'])
+        if self.pending_rows >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        """Append finished windows, tombstone the rows they replace, and save the manifest."""
+        rows = []
+        records = []
+        for channel, name, window in self.finished:
+            parts = window['embeddings']
+            for part, embedding in enumerate(parts):
+                record = {'messages': window['messages'], 'source': f'{channel}/{name}'}
+                if len(parts) > 1:
+                    record['chunk'] = part
+                records.append(record)
+                rows.append(embedding)
+        if rows:
+            if self.store is None:
+                self.store = EmbeddingStore.create(os.path.join(self.work_dir, STORE_DIR), dim=len(rows[0]),
+                                                   dtype=self.dtype, model=self.manifest['model'])
+            start = len(self.store)
+            self.store.append(rows, records)
+            self.added += len(rows)
+        windows = self.manifest['windows']
+        for channel, name, window in self.finished:
+            old = windows[channel].get(name)
+            if old:
+                self.deletes.extend(old['rows'])
+            windows[channel][name] = {'hash': window['hash'], 'rows': list(range(start, start + len(window['embeddings'])))}
+            start += len(window['embeddings'])
+            self.channels[channel]['outstanding'] -= 1
+        for channel, name in self.removed:
+            self.deletes.extend(windows[channel].pop(name)['rows'])
+        if self.deletes:
+            self.store.delete(self.deletes)
+            self.tombstoned += len(self.deletes)
+        for channel, state in list(self.channels.items()):
+            if state['outstanding'] == 0:
+                self.manifest['days'].setdefault(channel, {}).update(state['days'])
+                del self.channels[channel]
+        self.manifest['store_count'] = len(self.store) if self.store else 0
+        save_manifest(self.work_dir, self.manifest)
+        self.finished = []
+        self.removed = []
+        self.deletes = []
+        self.pending_rows = 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Incrementally update an embedding store from a Slack export')
+    parser.add_argument('export', help='The export zip file (or unzipped export directory)')
+    parser.add_argument('work_dir', help='Directory for the manifest, intermediate files and the store')
+    parser.add_argument('--max-tokens', type=int, default=1000, help='Token budget per window')
+    parser.add_argument('--min-tokens', type=int, help='Tokens a window needs before it can close at a content-defined boundary (default: half of --max-tokens)')
+    parser.add_argument('--model', default=EMBEDDING_MODEL, help='The embedding model to use')
+    parser.add_argument('--float16', action='store_true', help='Store embeddings as float16 (only when creating the store)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Channels extracted and packed in parallel')
+    parser.add_argument('--batch-inputs', type=int, default=256, help='Maximum inputs per embeddings request')
+    parser.add_argument('--batch-tokens', type=int, default=100000, help='Maximum tokens per embeddings request')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of embeddings requests in flight at once')
+    parser.add_argument('--requests-per-minute', type=float, default=3000, help='Request budget per minute')
+    parser.add_argument('--tokens-per-minute', type=float, default=1000000, help='Token budget per minute')
+    parser.add_argument('--flush-rows', type=int, default=1000, help='Rows embedded between store and manifest updates')
+    parser.add_argument('--cache', help='Embedding cache file, or "off" (default: $EMBEDDING_CACHE)')
+    parser.add_argument('--dedup', type=float, help='Collapse messages at least this similar to an earlier one (e.g. 0.8)')
+    parser.add_argument('--rebuild', action='store_true', help='Discard the work directory and start over')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.export):
+        parser.error(f'{args.export} does not exist')
+    started = time.monotonic()
+    if args.min_tokens is None:
+        args.min_tokens = args.max_tokens // 2
+    settings = {'model': args.model, 'max_tokens': args.max_tokens, 'min_tokens': args.min_tokens, 'dedup': args.dedup}
+    manifest = load_manifest(args.work_dir)
+    # Work directories from before --dedup have no dedup setting, which is the same as running without it
+    if manifest and any(manifest.get(key) != value for key, value in settings.items()) and not args.rebuild:
+        parser.error(f"{args.work_dir} was built with " + ', '.join(f'{key} {manifest.get(key)}' for key in settings) +
+                     '; pass --rebuild to start over with different settings')
+    if args.rebuild:
+        for name in (MANIFEST_FILE, DAYS_DIR, WINDOWS_DIR, STORE_DIR):
+            path = os.path.join(args.work_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        manifest = None
+    if manifest is None:
+        manifest = {'version': MANIFEST_VERSION, **settings, 'store_count': 0, 'days': {}, 'windows': {}}
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    reader = ExportReader(args.export)
+    changed = {}
+    for channel, signatures in day_signatures(reader).items():
+        known = manifest['days'].get(channel, {})
+        days = {day: signature for day, signature in signatures.items() if known.get(day) != signature}
+        if days:
+            changed[channel] = days
+    day_files = reader.day_files()
+    print(f'{sum(len(d) for d in changed.values())} new or changed day files in {len(changed)} channels')
+
+    updater = StoreUpdater(args.work_dir, manifest, 'float16' if args.float16 else 'float32', args.flush_rows)
+    cache = open_cache(args.cache)
+    engine = EmbeddingEngine(OpenAI(), args.model, args.batch_inputs, args.batch_tokens, args.concurrency,
+                             RateBudget(args.requests_per_minute, args.tokens_per_minute))
+    unchanged = 0
+    duplicates = {'messages': 0, 'duplicates': 0, 'clusters': 0, 'tokens': 0}
+
+    def inputs():
+        nonlocal unchanged, duplicates
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            # Channels with the most changed days first, so a big one doesn't start last
+            futures = {executor.submit(update_channel, args.export, channel,
+                                       [name for name in day_files[channel] if os.path.basename(name) in days],
+                                       args.work_dir, args.max_tokens, args.min_tokens, args.model, args.dedup): channel
+                       for channel, days in sorted(changed.items(), key=lambda item: -len(item[1]))}
+            for future in as_completed(futures):
+                channel, windows, channel_duplicates = future.result()
+                if channel_duplicates:
+                    duplicates = {name: duplicates[name] + channel_duplicates[name] for name in duplicates}
+                items = updater.add_channel(channel, windows, changed[channel])
+                unchanged += len(windows) - len({key[:2] for key, _, _ in items})
+                print(f'{channel}: {len(changed[channel])} changed days, {len(windows)} windows, '
+                      f'{len({key[:2] for key, _, _ in items})} to embed')
+                if cache is None:
+                    yield from items
+                    continue
+                cached = cache.get_many([text for _, text, _ in items], args.model)
+                hits = [(item, embedding.tolist()) for item, embedding in zip(items, cached) if embedding is not None]
+                if hits:
+                    updater.on_batch([item for item, _ in hits], [embedding for _, embedding in hits])
+                yield from (item for item, embedding in zip(items, cached) if embedding is None)
+
+    def on_batch(batch, embeddings):
+        if cache:
+            cache.put_many([text for _, text, _ in batch], embeddings, args.model)
+        updater.on_batch(batch, embeddings)
+
+    try:
+        failed = engine.run(inputs(), on_batch)
+    finally:
+        updater.flush()
+        if cache:
+            cache.close()
+
+    store = updater.store
+    if store is not None and updater.added:
+        ivf = open_index(store)
+        if ivf is not None and len(ivf) < len(store):
+            print(f'Adding {len(store) - len(ivf)} rows to the IVF index')
+            ivf.add(store.embeddings[len(ivf):], np.arange(len(ivf), len(store)))
+            ivf.save()
+    if store is not None:
+        lexical = open_lexical(store)
+        if lexical is None:
+            print(f'Building the BM25 index over {len(store)} rows')
+            LexicalIndex.build(store, lexical_index_path(store))
+        elif len(lexical) < len(store):
+            print(f'Adding {len(store) - len(lexical)} rows to the BM25 index')
+            lexical.add_rows(store)
+            lexical.save()
+    print(f'{updater.added} rows added, {updater.tombstoned} tombstoned, {unchanged} windows unchanged; '
+          f'store has {len(store) - store.deleted_count if store else 0} live rows '
+          f'({time.monotonic() - started:.1f}s)')
+    if args.dedup:
+        # Counted over the re-packed channels; a copy left out saves embedding its tokens on every re-embed
+        print(duplicates_report(duplicates))
+    if cache:
+        print(cache.report())
+    if failed or updater.failed:
+        print(f'{failed} inputs could not be embedded, leaving out {updater.failed} windows; rerun to retry them')
+
+
+if __name__ == '__main__':
+    main()
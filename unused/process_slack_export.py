@@ -1,10 +1,13 @@
 import json
 import sys
 
+from ingest_export import iter_json_array
+
 """
 This script processes a Slack export file and extracts the messages with "type": "message".
 It takes two command-line arguments: the input file path and the output file path.
-It reads the input file as JSON, extracts the messages, and writes them as JSON to the output file.
+It parses the input file's JSON array one message at a time, and writes the messages as JSON to the output file.
+Messages without a client_msg_id (bot posts, joins, ...) are kept with a null client_msg_id.
 """
 
 # Check that the correct number of command-line arguments were provided
@@ -16,20 +19,17 @@ if len(sys.argv) != 3:
 input_file = sys.argv[1]
 output_file = sys.argv[2]
 
-# Open the input file and read the JSON data
-with open(input_file, 'r') as input_f:
-    data = json.load(input_f)
-
-# Extract the messages with "type": "message"
-messages = [
-    {
-        "client_msg_id": m["client_msg_id"],
-        "ts": m["ts"],
-        "text": m["text"]
-    }
-    for m in data
-    if m["type"] == "message"
-]
+# Open the input file and extract the messages with "type": "message" as they are parsed
+with open(input_file, 'rb') as input_f:
+    messages = [
+        {
+            "client_msg_id": m.get("client_msg_id"),
+            "ts": m["ts"],
+            "text": m.get("text", "")
+        }
+        for m in iter_json_array(input_f)
+        if m.get("type") == "message"
+    ]
 
 # Open the output file and write the messages as JSON
 with open(output_file, 'w') as output_f:
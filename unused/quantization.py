@@ -0,0 +1,239 @@
+"""
+Compressed embedding codes for an embedding store (see embedding_store.py), so search can run from RAM when the
+full-precision matrix doesn't fit.
+
+Two encodings of the normalized embeddings are supported:
+    int8   scalar quantization: each dimension scaled by its largest absolute value to [-127, 127]
+           (1 byte per dimension, 4x smaller than float32)
+    pq     product quantization: the vector is split into `subspaces` parts and each part is replaced by the
+           index of its nearest of 256 k-means centroids (1 byte per subspace, e.g. 96 bytes for ada-002)
+
+A search scores every row on its codes, keeps the best `rerank` candidates, and re-ranks those exactly against
+the full-precision rows read from the store's memory map.  Codes live in a "quantized/<mode>" directory inside
+the store.
+
+Usage:
+    python quantization.py build <store_dir> --mode int8|pq [--subspaces 96]
+    python quantization.py report <store_dir> [--k 10] [--rerank 100] [--queries 100]
+
+search_exports.py searches with the codes when SEARCH_QUANTIZATION is set to int8 or pq.
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from ann_index import cluster_sums
+from embedding_store import EmbeddingStore
+from vector_search import VectorIndex, normalize_rows, top_k
+
+QUANTIZED_DIR = 'quantized'
+MODES = ('int8', 'pq')
+
+
+def _blocks(matrix, block_rows=65536):
+    for start in range(0, len(matrix), block_rows):
+        yield start, normalize_rows(matrix[start:start + block_rows])
+
+
+def train_codebooks(embeddings, subspaces, train_size=10000, iterations=20, seed=0):
+    """256 k-means centroids per subspace, shape (subspaces, 256, dim / subspaces).
+
+    About 40 training points per centroid is plenty, and training time grows with the sample."""
+    rng = np.random.default_rng(seed)
+    sample = normalize_rows(embeddings[np.sort(rng.choice(len(embeddings), min(len(embeddings), train_size), replace=False))])
+    parts = sample.reshape(len(sample), subspaces, -1)
+    codebooks = np.empty((subspaces, 256, parts.shape[2]), dtype=np.float32)
+    for s in range(subspaces):
+        points = parts[:, s]
+        centroids = points[rng.choice(len(points), 256, replace=len(points) < 256)]
+        for _ in range(iterations):
+            assignments = _nearest(points, centroids)
+            sums, counts = cluster_sums(points, assignments, 256)
+            centroids = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centroids)
+        codebooks[s] = centroids
+    return codebooks
+
+
+def _nearest(points, centroids):
+    # argmin of squared distance, dropping the |point|^2 term that is the same for every centroid
+    return np.argmin((centroids ** 2).sum(axis=1) - 2 * points @ centroids.T, axis=1)
+
+
+class QuantizedIndex:
+    def __init__(self, store, mode, codes, scales=None, codebooks=None):
+        self.store = store
+        self.mode = mode
+        self.codes = codes
+        self.scales = scales
+        self.codebooks = codebooks
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        """Memory needed to search: the codes plus the scales or codebooks."""
+        return self.codes.nbytes + (self.scales if self.mode == 'int8' else self.codebooks).nbytes
+
+    @classmethod
+    def build(cls, store, mode, subspaces=96, seed=0, block_rows=65536):
+        """Encode every row of the store and write the codes to its quantized/<mode> directory."""
+        path = os.path.join(store.path, QUANTIZED_DIR, mode)
+        os.makedirs(path, exist_ok=True)
+        embeddings = store.embeddings
+        header = {'mode': mode, 'count': len(store)}
+        if mode == 'int8':
+            scales = np.full(store.dim, 1e-12, dtype=np.float32)
+            for _, block in _blocks(embeddings, block_rows):
+                scales = np.maximum(scales, np.abs(block).max(axis=0))
+            scales /= 127
+            np.save(os.path.join(path, 'scales.npy'), scales)
+            codes = np.lib.format.open_memmap(os.path.join(path, 'codes.npy'), mode='w+', dtype=np.int8,
+                                              shape=(len(store), store.dim))
+            for start, block in _blocks(embeddings, block_rows):
+                codes[start:start + len(block)] = np.clip(np.rint(block / scales), -127, 127)
+        elif mode == 'pq':
+            if store.dim % subspaces:
+                raise ValueError(f'{subspaces} subspaces do not divide the embedding dimension {store.dim}')
+            codebooks = train_codebooks(embeddings, subspaces, seed=seed)
+            np.save(os.path.join(path, 'codebooks.npy'), codebooks)
+            codes = np.lib.format.open_memmap(os.path.join(path, 'codes.npy'), mode='w+', dtype=np.uint8,
+                                              shape=(len(store), subspaces))
+            for start, block in _blocks(embeddings, block_rows):
+                parts = block.reshape(len(block), subspaces, -1)
+                for s in range(subspaces):
+                    codes[start:start + len(block), s] = _nearest(parts[:, s], codebooks[s])
+            header['subspaces'] = subspaces
+        else:
+            raise ValueError(f'Unknown quantization mode {mode!r}; expected one of {MODES}')
+        codes.flush()
+        del codes
+        with open(os.path.join(path, 'quantized.json'), 'w') as header_f:
+            json.dump(header, header_f, indent=4)
+        return cls.load(store, mode)
+
+    @classmethod
+    def load(cls, store, mode):
+        path = os.path.join(store.path, QUANTIZED_DIR, mode)
+        with open(os.path.join(path, 'quantized.json')) as header_f:
+            header = json.load(header_f)
+        if header['count'] != len(store):
+            print(f"Warning: {mode} codes cover {header['count']} of {len(store)} rows; rebuild them to search the rest")
+        # The codes are small enough to keep in RAM, which is the point
+        codes = np.load(os.path.join(path, 'codes.npy'))
+        if mode == 'int8':
+            return cls(store, mode, codes, scales=np.load(os.path.join(path, 'scales.npy')))
+        return cls(store, mode, codes, codebooks=np.load(os.path.join(path, 'codebooks.npy')))
+
+    def candidate_scores(self, queries, block_rows=16384):
+        """Approximate cosine similarity of every row with each normalized query, from the codes: (count, queries)."""
+        scores = np.empty((len(self.codes), len(queries)), dtype=np.float32)
+        if self.mode == 'int8':
+            # Decoding a block dominates, so score it against every query at once
+            scaled_queries = (queries * self.scales).T
+            for start in range(0, len(self.codes), block_rows):
+                block = self.codes[start:start + block_rows]
+                scores[start:start + len(block)] = block.astype(np.float32) @ scaled_queries
+        else:
+            subspaces = len(self.codebooks)
+            # Asymmetric distance: one table of query-part x centroid dot products per query, then a lookup per code
+            tables = np.einsum('qsd,scd->qsc', queries.reshape(len(queries), subspaces, -1), self.codebooks)
+            for start in range(0, len(self.codes), block_rows):
+                block = self.codes[start:start + block_rows]
+                for q, table in enumerate(tables):
+                    scores[start:start + len(block), q] = table[np.arange(subspaces), block].sum(axis=1)
+        return scores
+
+    def search_batch(self, queries, k, rerank=100):
+        """(ids, scores) of the top k rows per query: the best `rerank` by code score, re-ranked on full-precision rows."""
+        queries = normalize_rows(np.atleast_2d(queries))
+        scores = self.candidate_scores(queries)
+        results = []
+        for q, query in enumerate(queries):
+            candidates = np.sort(top_k(scores[:, q], max(k, rerank))[0])
+            exact = normalize_rows(self.store.embeddings[candidates]) @ query
+            best, best_scores = top_k(exact, k)
+            results.append((candidates[best], best_scores))
+        return results
+
+    def search(self, query, k, rerank=100):
+        return self.search_batch(query, k, rerank)[0]
+
+
+def open_quantized(store, mode):
+    """The store's codes for mode, or None if they haven't been built."""
+    if os.path.exists(os.path.join(store.path, QUANTIZED_DIR, mode, 'quantized.json')):
+        return QuantizedIndex.load(store, mode)
+    return None
+
+
+def report(store, k, rerank, queries, seed=0):
+    """Memory, throughput and recall@k of exact search and of each built quantization mode."""
+    rng = np.random.default_rng(seed)
+    rows = normalize_rows(store.embeddings[np.sort(rng.choice(len(store), min(queries, len(store)), replace=False))])
+    queries = rows + rng.standard_normal(rows.shape).astype(np.float32) * (0.5 / np.sqrt(store.dim))
+
+    exact = VectorIndex(store.embeddings)
+    started = time.perf_counter()
+    expected = [set(ids.tolist()) for ids, _ in (exact.search(query, k) for query in queries)]
+    qps = len(queries) / (time.perf_counter() - started)
+    started = time.perf_counter()
+    exact.search_batch(queries, k)
+    batch_qps = len(queries) / (time.perf_counter() - started)
+    results = [{'mode': 'float32 (exact)', 'memory_bytes': len(store) * store.dim * 4, 'qps': round(qps, 1),
+                'batch_qps': round(batch_qps, 1), 'recall_at_k': 1.0}]
+    for mode in MODES:
+        index = open_quantized(store, mode)
+        if index is None:
+            continue
+        started = time.perf_counter()
+        found = [index.search(query, k, rerank) for query in queries]
+        qps = len(queries) / (time.perf_counter() - started)
+        started = time.perf_counter()
+        index.search_batch(queries, k, rerank)
+        batch_qps = len(queries) / (time.perf_counter() - started)
+        recall = np.mean([len(e & set(ids.tolist())) / len(e) for e, (ids, _) in zip(expected, found)])
+        # Recall before re-ranking shows how much the exact pass recovers
+        scores = index.candidate_scores(normalize_rows(queries))
+        raw_recall = np.mean([len(e & set(top_k(scores[:, q], k)[0].tolist())) / len(e) for q, e in enumerate(expected)])
+        results.append({'mode': mode, 'memory_bytes': index.nbytes, 'qps': round(qps, 1), 'batch_qps': round(batch_qps, 1),
+                        'recall_at_k': round(float(recall), 4), 'recall_at_k_without_rerank': round(float(raw_recall), 4)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or evaluate quantized codes for an embedding store')
+    parser.add_argument('command', choices=['build', 'report'])
+    parser.add_argument('store_dir')
+    parser.add_argument('--mode', choices=MODES, help='Encoding to build')
+    parser.add_argument('--subspaces', type=int, default=96, help='Product quantization subspaces (must divide the dimension)')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--rerank', type=int, default=100, help='Candidates re-ranked at full precision')
+    parser.add_argument('--queries', type=int, default=100, help='Queries for the report')
+    parser.add_argument('--json', help='Write the report as JSON to this file')
+    args = parser.parse_args()
+
+    store = EmbeddingStore(args.store_dir)
+    if args.command == 'build':
+        if not args.mode:
+            parser.error('build needs --mode')
+        started = time.monotonic()
+        index = QuantizedIndex.build(store, args.mode, subspaces=args.subspaces)
+        print(f'Encoded {len(index)} rows as {args.mode} ({index.nbytes / 1e6:.1f} MB) in {time.monotonic() - started:.1f}s')
+    else:
+        results = report(store, args.k, args.rerank, args.queries)
+        for row in results:
+            extra = f", {row['recall_at_k_without_rerank']} before re-ranking" if 'recall_at_k_without_rerank' in row else ''
+            print(f"{row['mode']}: {row['memory_bytes'] / 1e6:.1f} MB, {row['qps']} queries/s ({row['batch_qps']} batched), "
+                  f"recall@{args.k} {row['recall_at_k']}{extra}")
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
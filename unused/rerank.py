@@ -0,0 +1,102 @@
+"""
+Local re-ranking of retrieved contexts before they are summarized, for search_exports.py and
+search_with_slack_api.py.
+
+Every context that retrieval returns costs a GPT-4-class call to summarize, and many of them turn out to be
+irrelevant or repeat each other.  rerank() scores the candidates locally, from what retrieval already has:
+    similarity   cosine similarity of the context's embedding to the question's, rescaled so that
+                 `similarity_floor` (about what unrelated text scores with ada-002) is 0 and 1 is 1
+    overlap      the share of the question's terms (see lexical_index.tokenize) that the context contains
+    recency      0.5 ** (age / half-life), age measured back from the newest candidate
+weighted into one relevance score.  Candidates that are near-duplicates of a better one (embeddings at least
+`duplicate_similarity` alike, or term sets at least `duplicate_overlap` alike) are dropped, the rest are picked by
+maximal marginal relevance (MMR) so the picks don't all say the same thing, and only those scoring at least
+`threshold` are kept (but at least `min_keep`, so a question always gets an answer).
+
+The settings come from the environment (see rerank_settings()): RERANK=off disables re-ranking, RERANK_THRESHOLD
+(default 0.3), RERANK_MMR (the MMR lambda, default 0.7; 1 ranks by relevance alone) and RERANK_HALF_LIFE_DAYS
+(default 180; 0 ignores recency).
+"""
+
+import os
+
+import numpy as np
+
+from lexical_index import tokenize
+
+WEIGHTS = {'similarity': 0.6, 'overlap': 0.3, 'recency': 0.1}
+
+
+def rerank_settings():
+    """Keyword arguments for rerank() from the environment, or None if RERANK is off."""
+    if os.environ.get('RERANK', 'on').lower() in ('off', 'none', '0'):
+        return None
+    return {'threshold': float(os.environ.get('RERANK_THRESHOLD', '0.3')),
+            'mmr_lambda': float(os.environ.get('RERANK_MMR', '0.7')),
+            'half_life_days': float(os.environ.get('RERANK_HALF_LIFE_DAYS', '180'))}
+
+
+def relevance(query, texts, embeddings=None, query_embedding=None, timestamps=None, half_life_days=180,
+              similarity_floor=0.7):
+    """Each text's weighted relevance to the query, and its unit-length embedding (None without embeddings)."""
+    query_terms = set(tokenize(query))
+    overlap = np.array([len(query_terms.intersection(tokenize(text))) / len(query_terms) if query_terms else 0.0
+                        for text in texts])
+    scores = WEIGHTS['overlap'] * overlap
+    weights = WEIGHTS['overlap']
+    vectors = None
+    if embeddings is not None and query_embedding is not None:
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        query_vector = np.asarray(query_embedding, dtype=np.float32)
+        similarity = vectors @ (query_vector / max(np.linalg.norm(query_vector), 1e-12))
+        scores = scores + WEIGHTS['similarity'] * np.clip((similarity - similarity_floor) / (1 - similarity_floor), 0, 1)
+        weights += WEIGHTS['similarity']
+    if timestamps is not None and half_life_days:
+        times = np.asarray(timestamps, dtype=np.float64)
+        age_days = (times.max() - times) / 86400
+        scores = scores + WEIGHTS['recency'] * 0.5 ** (age_days / half_life_days)
+        weights += WEIGHTS['recency']
+    # Scale by the weights actually used, so the threshold means the same with or without embeddings and timestamps
+    return scores / weights, vectors
+
+
+def rerank(query, texts, embeddings=None, query_embedding=None, timestamps=None, n=None, threshold=0.3,
+           mmr_lambda=0.7, half_life_days=180, duplicate_similarity=0.97, duplicate_overlap=0.9, min_keep=1):
+    """(index into texts, relevance) for up to n of the texts worth summarizing, in the order to use them."""
+    if not texts:
+        return []
+    n = len(texts) if n is None else n
+    scores, vectors = relevance(query, texts, embeddings, query_embedding, timestamps, half_life_days)
+    terms = [set(tokenize(text)) for text in texts]
+
+    def alike(i, j):
+        """How alike two texts are: the cosine similarity of their embeddings, or the Jaccard index of their terms."""
+        if vectors is not None:
+            return float(vectors[i] @ vectors[j])
+        union = len(terms[i] | terms[j])
+        return len(terms[i] & terms[j]) / union if union else 1.0
+
+    def duplicate(i, j):
+        if vectors is not None and vectors[i] @ vectors[j] >= duplicate_similarity:
+            return True
+        union = len(terms[i] | terms[j])
+        return union == 0 or len(terms[i] & terms[j]) / union >= duplicate_overlap
+
+    # Drop near-duplicates, keeping the most relevant copy
+    candidates = []
+    for i in np.argsort(-scores, kind='stable').tolist():
+        if not any(duplicate(i, j) for j in candidates):
+            candidates.append(i)
+
+    selected = []
+    while candidates and len(selected) < n:
+        if selected and mmr_lambda < 1:
+            mmr = [mmr_lambda * scores[i] - (1 - mmr_lambda) * max(alike(i, j) for j in selected) for i in candidates]
+            best = candidates[int(np.argmax(mmr))]
+        else:
+            best = candidates[0]
+        candidates.remove(best)
+        if scores[best] >= threshold or len(selected) < min_keep:
+            selected.append(best)
+    return [(i, float(scores[i])) for i in selected]
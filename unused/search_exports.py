@@ -2,8 +2,17 @@
 This script searches through a given dataset for messages that are similar to a given search string.
 It uses OpenAI's text-embedding-ada-002 engine to generate embeddings for the search string
 and the messages in the dataset, and then uses cosine similarity to find the most similar messages.
-It then prints out the top n results, and uses OpenAI's GPT-4 Turbo engine to generate a summary
-of the context and answer the question.
+The dataset is either the JSON file written by combine_into_json.py or an embedding store directory
+(see embedding_store.py), which is memory-mapped rather than parsed, and searched through its approximate
+nearest-neighbour index if it has one (see ann_index.py), or through int8 / product-quantized codes
+when SEARCH_QUANTIZATION is set (see quantization.py), or a sharded store (see sharded_store.py), searched
+exactly on every core and narrowed down with SEARCH_CHANNELS, SEARCH_AFTER and SEARCH_BEFORE.  If the store also has a BM25 index (see
+lexical_index.py), keyword matches are fused with the vector results, so exact terms like error codes
+and hostnames are found even when the embeddings miss them.
+Search string embeddings are kept in the shared embedding cache (see embedding_cache.py), so repeated
+searches don't call the embeddings API again.
+It then prints out the top results and re-ranks them locally (see rerank.py), so that only the relevant,
+distinct ones, at most n, are sent to OpenAI's GPT-4 Turbo engine to summarize and answer the question.
 """
 
 import sys
@@ -13,26 +22,48 @@ import json
 import os
 from openai import OpenAI
 
-client = OpenAI(api_key=api_key)
-import tiktoken
+client = OpenAI()
 
-from openai.embeddings_utils import get_embedding, cosine_similarity
+from embedding_store import EmbeddingStore
+from vector_search import VectorIndex
+from ann_index import open_index
+from quantization import open_quantized
+from lexical_index import fuse, fusion_settings, open_lexical
+from near_duplicates import diversity
+from rerank import rerank, rerank_settings
+from sharded_store import ShardedSearch, ShardedStore, parse_date
+from token_chunker import count_tokens
+from embedding_cache import embed_texts, open_cache
 
+embedding_cache = open_cache()
 
-# search through the messages
-def search_messages(df, search_string, n, pprint=True):
-    embedding = get_embedding(
-        search_string,
-        engine="text-embedding-ada-002"
-    )
-    df["similarities"] = df.ada_search.apply(lambda x: cosine_similarity(x, embedding))
-    print(df.sort_values("similarities", ascending=False).head(n))
+
+# openai.embeddings_utils was removed in openai 1.0; these are the equivalents
+def get_embedding(text, engine="text-embedding-ada-002"):
+    # Newlines are collapsed to spaces along with other whitespace when the text is normalized for the cache
+    return embed_texts(client, [text], engine, embedding_cache)[0]
+
+def cosine_similarity(a, b):
+    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+
+
+# search through the messages; with_vectors also returns the top rows' embeddings and newest timestamps
+def search_messages(df, search_string, n, pprint=True, embedding=None, with_vectors=False):
+    if embedding is None:
+        embedding = get_embedding(
+            search_string,
+            engine="text-embedding-ada-002"
+        )
+    # Score every row with one matrix-vector product and pick the top n with argpartition
+    index = VectorIndex(np.vstack(df.ada_search.values))
+    indices, similarities = index.search(embedding, n)
+    top = df.iloc[indices].assign(similarities=similarities)
+    print(top)
 
     res = (
-        df.sort_values("similarities", ascending=False)
+        top
         # get the nth element
         #.head(n).tail(1)
-        .head(n)
         .messages
         # Get all the elements of the list
         .apply(lambda x: x)
@@ -47,6 +78,94 @@ def search_messages(df, search_string, n, pprint=True):
             # Print the entire message json using a json pretty printer
             print(json.dumps(r, indent=4))
 
+    if with_vectors:
+        return res, np.vstack(top.ada_search.values), [newest_ts(messages) for messages in top.messages]
+    return res
+
+# the time of the newest message in a list of messages, or None if they have no timestamps
+def newest_ts(messages):
+    times = [float(message['ts']) for message in messages if 'ts' in message]
+    return max(times) if times else None
+
+# rows of an embedding store best matching the search string: (row indices, scores), best first
+def search_rows(store, search_string, embedding, n, block_rows=65536):
+    fusion, lexical_weight = fusion_settings()
+    lexical = open_lexical(store) if fusion != 'off' else None
+    # With keyword results to fuse, take a deeper list of candidates from each side
+    candidates = max(n, int(os.environ.get("SEARCH_FUSION_CANDIDATES", "50"))) if lexical else n
+    # Ask for enough extra results to still have n once deleted rows are dropped
+    k = min(candidates + store.deleted_count, len(store))
+    quantization = os.environ.get("SEARCH_QUANTIZATION")
+    quantized = open_quantized(store, quantization) if quantization else None
+    if quantization and quantized is None:
+        print(f"Warning: no {quantization} codes in {store.path} (build them with quantization.py); searching without them")
+    ivf = open_index(store) if quantized is None else None
+    if quantized is not None:
+        # Score the compressed codes in RAM, then re-rank the best candidates on the full-precision rows
+        top, similarities = quantized.search(embedding, k, int(os.environ.get("SEARCH_RERANK", "100")))
+    elif ivf is not None:
+        # Approximate search: only the nprobe closest lists of the store's IVF index are scanned (see ann_index.py)
+        if len(ivf) < len(store):
+            # Rows appended since the index was last updated are searchable too, just not saved into it
+            ivf.add(store.embeddings[len(ivf):], np.arange(len(ivf), len(store)))
+        top, similarities = ivf.search(embedding, k, int(os.environ.get("SEARCH_NPROBE", ivf.nprobe)))
+    else:
+        # Stores too big for RAM are scored a block of rows at a time straight from the memory map
+        index = VectorIndex(store.embeddings, block_rows=block_rows)
+        top, similarities = index.search(embedding, k)
+    if store.deleted_count:
+        live = ~store.deleted[top]
+        top, similarities = top[live][:candidates], similarities[live][:candidates]
+    if lexical is not None:
+        # Rows appended since the BM25 index was last updated are searchable too, just not saved into it
+        lexical.add_rows(store)
+        keyword = lexical.search(search_string, candidates, store.deleted if store.deleted_count else None)
+        top, similarities = fuse((top, similarities), keyword, fusion, lexical_weight)
+    return top[:n], similarities[:n]
+
+# search through an embedding store, reading only the embeddings and the top n records
+def search_store(store, search_string, n, pprint=True, block_rows=65536, embedding=None, with_vectors=False):
+    if embedding is None:
+        embedding = get_embedding(
+            search_string,
+            engine="text-embedding-ada-002"
+        )
+    top, similarities = search_rows(store, search_string, embedding, n, block_rows)
+    records = store.records(top)
+    for row, similarity, record in zip(top, similarities, records):
+        print(f"{similarity:.4f} {record.get('source', row)}")
+
+    # Just the 'text' field of each message, like search_messages
+    res = [[i['text'] for i in record['messages']] for record in records]
+    if pprint:
+        for r in res:
+            # Print the entire message json using a json pretty printer
+            print(json.dumps(r, indent=4))
+
+    if with_vectors:
+        return res, np.asarray(store.embeddings[top]), [newest_ts(record['messages']) for record in records]
+    return res
+
+# search through a sharded store: exact scores from every shard the filters leave, scored in a process pool
+def search_sharded(path, search_string, n, embedding=None, with_vectors=False):
+    if embedding is None:
+        embedding = get_embedding(
+            search_string,
+            engine="text-embedding-ada-002"
+        )
+    channels = [c for c in os.environ.get("SEARCH_CHANNELS", "").split(",") if c] or None
+    after, before = parse_date(os.environ.get("SEARCH_AFTER")), parse_date(os.environ.get("SEARCH_BEFORE"))
+    workers = int(os.environ.get("SEARCH_WORKERS", os.cpu_count()))
+    with ShardedSearch(path, workers) as searcher:
+        results = searcher.search(embedding, n, channels, after, before)
+        records = searcher.store.records(results)
+        embeddings = searcher.store.embeddings(results)
+    for (similarity, name, row), record in zip(results, records):
+        print(f"{similarity:.4f} {record.get('source', f'{name}/{row}')}")
+
+    res = [[i['text'] for i in record['messages']] for record in records]
+    if with_vectors:
+        return res, embeddings.reshape(-1, len(embedding)), [newest_ts(record['messages']) for record in records]
     return res
 
 def convert_res_to_json(res):
@@ -138,7 +257,7 @@ def ask_gpt(prompt, model="gpt-4-1106-preview", max_tokens=3000, temperature=0):
 def main():
     # Check for arguments
     if len(sys.argv) < 3:
-        print('Usage: search.py file.csv "Your question" [number of results]')
+        print('Usage: search.py file.json|store_dir "Your question" [number of results]')
         sys.exit(1)
 
     # Get arguments
@@ -150,12 +269,38 @@ def main():
     #df = pd.read_csv(file)
     #df["ada_search"] = df.ada_search.apply(eval).apply(np.array)
 
-    # load the data
-    df = pd.read_json(file)
-    #df["ada_search"] = df.ada_search.apply(eval).apply(np.array)
-    df.ada_search.apply(np.array)
-
-    res = search_messages(df, question_string, n, pprint=False)
+    # With re-ranking on, retrieve a deeper list of candidates for it to choose the n to summarize from
+    settings = rerank_settings()
+    k = n * 3 if settings else n
+    embedding = get_embedding(question_string, engine="text-embedding-ada-002")
+    if os.path.isdir(file) and ShardedStore.is_sharded(file):
+        res, embeddings, timestamps = search_sharded(file, question_string, k, embedding=embedding, with_vectors=True)
+    elif os.path.isdir(file):
+        # open the embedding store (only its header is read here)
+        store = EmbeddingStore(file)
+        res, embeddings, timestamps = search_store(store, question_string, k, pprint=False, embedding=embedding,
+                                                   with_vectors=True)
+    else:
+        # load the data
+        df = pd.read_json(file)
+        #df["ada_search"] = df.ada_search.apply(eval).apply(np.array)
+        df.ada_search.apply(np.array)
+
+        res, embeddings, timestamps = search_messages(df, question_string, k, pprint=False, embedding=embedding,
+                                                      with_vectors=True)
+    if embedding_cache:
+        print(embedding_cache.report())
+        embedding_cache.close()
+
+    # The share of the results that aren't near-copies of a better one
+    texts = ["\n".join(r) for r in res]
+    print(f"Top-{len(res)} diversity: {diversity(texts):.0%}")
+    if settings:
+        ranked = rerank(question_string, texts, embeddings, embedding,
+                        None if None in timestamps else timestamps, n=n, **settings)
+        print(f"Re-ranked {len(res)} results: summarizing {len(ranked)} " +
+              ", ".join(f"#{i + 1} ({score:.2f})" for i, score in ranked))
+        res = [res[i] for i, _ in ranked]
 
     # Loop through each result
     for i in range(len(res)):
@@ -169,9 +314,7 @@ def main():
         results_string = json.dumps(result)
         
         # Get the token length of the string
-        enc = tiktoken.get_encoding("gpt2")
-        tokens = enc.encode(results_string)
-        token_count = len(tokens)
+        token_count = count_tokens(results_string, model="gpt-4-1106-preview")
         # print the length of the string in characters and tokens
         #print("String length: " + str(len(results_string)) + " characters, "Token count: " + str(token_count))
         print(f"String length: {len(results_string)} characters, Token count: {token_count}")
@@ -183,7 +326,7 @@ def main():
             "Inquiry: " + question_string + "\nIf it is posed as a question, answer it, provide a quote from the context to support your answer," + \
             "and provide a summariziation of the relevant portions of the context.\n" + \
             "If the context is not relevant to the inquiry, reply with 'The context is not relevant to the inquiry.'"
-        answer = ask_gpt(results, prompt)
+        answer = ask_gpt(prompt)
         print(answer)    
 
 def old():
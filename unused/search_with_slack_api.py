@@ -3,19 +3,55 @@ import sys
 import json
 import datetime
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 import openai
-from openai.embeddings_utils import cosine_similarity
-import tiktoken
 import pandas as pd
 import numpy as np
+from embedding_cache import embed_texts, open_cache
+from embedding_engine import RateBudget
+from embedding_store import EmbeddingStore
+from lexical_index import merge_ranked, tokenize
+from near_duplicates import diversity
+from rerank import rerank, rerank_settings
+from search_exports import search_rows
+from slack_history import HistoryFetcher, open_history_cache
+from token_chunker import encode, get_encoder, truncate
 #from langchain.llms import OpenAI
 #from langchain.embeddings import OpenAIEmbeddings
 
 #from langchain.llms import OpenAIChat
 #from langchain import PromptTemplate, LLMChain
 
+EMBEDDING_MODEL = "text-embedding-ada-002"
+ANSWER_MODEL = "gpt-4-1106-preview"
+client = openai.OpenAI()
+# Context windows overlap and repeat across searches, so their embeddings are usually cached already
+embedding_cache = open_cache()
+# Context windows fetched for earlier questions, reused when the same stretch of a channel comes up again
+history_cache = open_history_cache()
+# Embedding stores (comma-separated) searched before Slack, e.g. a pipeline.py store and the bot's LIVE_INDEX_DIR.
+# Their BM25 indexes find exact terms like error codes and hostnames offline, without GPT-generated search terms.
+LOCAL_SEARCH_STORES = [path for path in os.environ.get("LOCAL_SEARCH_STORES", "").split(",") if path]
+# search.messages is a tier 2 method (about 20 requests a minute), so only a few search terms are run at once
+SEARCH_CONCURRENCY = 5
+# perform_search results by (query, num_results); retries with more general terms often repeat earlier ones
+search_cache = {}
+# auth.test results by client, so filtering out the bot's own messages costs one call per process
+user_ids = {}
+user_ids_lock = threading.Lock()
+# The best_of_n summaries are requested at once, within a requests and tokens per minute budget
+SUMMARY_CONCURRENCY = 4
+SUMMARY_MAX_TOKENS = 1000
+summary_budget = RateBudget(500, 150000)
+
+
+# openai.embeddings_utils was removed in openai 1.0; this is the equivalent
+def cosine_similarity(a, b):
+    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+
 
 def main(query, num_results=50, best_of_n=3):
     botclient, userclient, channels = slack_api_setup()
@@ -24,85 +60,56 @@ def main(query, num_results=50, best_of_n=3):
     # Call the search function to get the results
     search_terms, results = search(query, userclient, channels, num_results)
 
-    # For each result, get the surrounding context
-    all_results = []
-    results_context = []
-    for result in results:
-        # Check that result is not None
-        if result is None or result == []:
-            continue
-        #print(result)
-        #print(result[0]['text'])
-        result_context = get_message_context(result, channels, userclient)
-        #print(f"result_context for {result}: {result_context}")
-        all_results.append(result)
-        results_context.append(result_context)
-    
-    # Get embeddings for each result and its surrounding context
+    # Get the surrounding context of every result at once, so overlapping windows are only fetched once
+    all_results = [message for result in results if result for message in result]
+    fetcher = HistoryFetcher(userclient, history_cache)
+    results_context = fetcher.contexts(all_results)
+    print(fetcher.report())
+
+    # Get embeddings for each result and its surrounding context, keeping each context's result alongside it
+    hits = []
     contexts = []
-    embeddings = []
-    for result in results_context:
-        for context in result:
-            context_string = ''
-            for message in context:
-                #print(message['text'])
-                context_string += message['text'] + "\n"
-            #print(context_string)
-
-            if context_string == '':
-                continue
-            # while context_string is more than 8000 tokens, remove the last 1000 characters and try again
-            enc = tiktoken.get_encoding("gpt2")
-            tokens = enc.encode(context_string)
-            line_token_count = len(tokens)
-            while line_token_count > 8000:
-                context_string = context_string[:-1000]
-                tokens = enc.encode(context_string)
-                line_token_count = len(tokens)
-
-            lc_embedding = OpenAIEmbeddings(openai_api_key=os.environ["OPENAI_API_KEY"])
-            embedding = lc_embedding.embed_documents([context_string])
-
-            #embedding = openai.embeddings_utils.get_embedding(
-            #    context_string,
-            #    engine="text-embedding-ada-002"
-            #)
-            contexts.append(context_string)
-            embeddings.append(embedding)
-            #print(len(embeddings))
+    for result, context in zip(all_results, results_context):
+        context_string = ''
+        for message in context:
+            #print(message['text'])
+            context_string += message['text'] + "\n"
+        #print(context_string)
+
+        if context_string == '':
+            continue
+        # if context_string is more than 8000 tokens, cut it to the first 8000
+        context_string = truncate(context_string, 8000, model=EMBEDDING_MODEL)
+        hits.append(result)
+        contexts.append(context_string)
 
     # If there are no results, return None
     #if typeof(all_results) == 'NoneType' or len(all_results) == 0:
-    if all_results == [] or all_results == None:
-        return None, None, None, None
+    if hits == []:
+        return None, None, None, None, None
+    # Embed all the contexts at once, skipping any already in the embedding cache
+    embeddings = embed_texts(client, contexts, EMBEDDING_MODEL, embedding_cache)
 
     # Search the embeddings for the search term
     print(contexts)
-    df = semantic_search(all_results, contexts, embeddings, query)
-    #contextualize_results(df, query, best_of_n)
-    answers, permalinks, timestamps = contextualize_results(df, query, best_of_n)
-    return search_terms, answers, permalinks, timestamps
+    print(f"Top-{len(contexts)} diversity: {diversity(contexts):.0%}")
+    df = semantic_search(hits, contexts, embeddings, query)
+    answers, permalinks, timestamps, best_answer = contextualize_results(df, query, best_of_n)
+    if embedding_cache:
+        print(embedding_cache.report())
+    return search_terms, answers, permalinks, timestamps, best_answer
 
-def semantic_search(all_results, contexts, embeddings, query):
+def semantic_search(results, contexts, embeddings, query):
 
-    # Create a dictionary containing results and embeddings
+    # Create a dictionary containing results and embeddings, one row per result
     data = {}
     # Print length of results, contexts and embeddings
-    print("Length of results: " + str(len(all_results[0])))
+    print("Length of results: " + str(len(results)))
     print("Length of contexts: " + str(len(contexts)))
     print("Length of embeddings: " + str(len(embeddings)))
-    #print(all_results[0])
-    data['results'] = all_results[0]
+    data['results'] = results
     data['contexts'] = contexts
     data['embeddings'] = embeddings
-    
-    # Get the length of the shortest list
-    n = min(len(data['results']), len(data['contexts']), len(data['embeddings']))
-    # Truncate all lists to the same length
-    data['results'] = data['results'][:n]
-    data['contexts'] = data['contexts'][:n]
-    data['embeddings'] = data['embeddings'][:n]
-
 
     # load the data from the embeddings variable into a pandas dataframe
     df = pd.DataFrame(data)
@@ -111,8 +118,7 @@ def semantic_search(all_results, contexts, embeddings, query):
     #df["ada_search"] = df.ada_search.apply(eval).apply(np.array)
     df.embeddings.apply(np.array)
 
-    lc_embedding = OpenAIEmbeddings(openai_api_key=os.environ["OPENAI_API_KEY"])
-    embedding = lc_embedding.embed_query(query)
+    embedding = embed_texts(client, [query], EMBEDDING_MODEL, embedding_cache)[0]
 
     # Get the embedding for the search term
     #embedding = get_embedding(
@@ -122,99 +128,99 @@ def semantic_search(all_results, contexts, embeddings, query):
     #print(f"query_embedding: {query_embedding}, embedding: {embedding}")
 
     df["similarities"] = df.embeddings.apply(lambda x: cosine_similarity(x, embedding))
-    print(df.sort_values("similarities", ascending=False).head(n))
+    # As a list: pandas compares attrs with == when combining frames (e.g. in nlargest), which fails for arrays
+    df.attrs["query_embedding"] = embedding.tolist()
+    print(df.sort_values("similarities", ascending=False).head(len(df)))
 
     return df
 
 def contextualize_results(df, query, best_of_n):
-    
-    n=best_of_n
-
-    contexts = (
-        df.sort_values("similarities", ascending=False)
-        .head(n)
-        .contexts
-        # Get all the elements of the list
-        .apply(lambda x: x)
-    )
-
-    #print(res)
-    #return res
-    #if pprint:
-    answers = []
+    """Answer the question from each of the best_of_n most relevant contexts at once, then pick the best answer.
+
+    The contexts are re-ranked locally first (see rerank.py), so near-duplicates and contexts below the relevance
+    threshold never reach the model.  The rows are taken by index, so identical contexts from different results
+    keep their own timestamp and permalink.  The summaries are requested concurrently within summary_budget, and
+    the final choice between them is printed as it streams in, and returned after the answers, permalinks and
+    timestamps (with a single answer, that answer; with none, None)."""
+    settings = rerank_settings()
+    if settings:
+        ranked = rerank(query, df["contexts"].tolist(), np.stack(df["embeddings"].values), df.attrs["query_embedding"],
+                        [float(result["ts"]) for result in df["results"]], n=best_of_n, **settings)
+        print(f"Re-ranked {len(df)} results: summarizing {len(ranked)} " +
+              ", ".join(f"#{i + 1} ({score:.2f})" for i, score in ranked))
+        rows = df.index[[i for i, _ in ranked]]
+    else:
+        rows = df["similarities"].nlargest(best_of_n).index
+
+    prompts = []
+    for index in rows:
+        context_string = json.dumps(df.at[index, 'contexts'])
+
+        # If the token count is greater than 3000, cut the string to its first 3000 tokens, encoding it only once
+        tokens = encode(context_string, model=ANSWER_MODEL)
+        print(f"String length: {len(context_string)} characters, Token count: {len(tokens)}")
+        if len(tokens) > 3000:
+            context_string = get_encoder(ANSWER_MODEL).decode(tokens[:3000])
+            print(f"String length: {len(context_string)} characters, Token count: 3000")
+
+        prompt = "Given the following context:\n" + context_string + \
+            "\nIf the context is not relevant to the question, reply with 'This may be related, but I'm not sure whether it answers your question.'\n" +\
+            "Question: " + query + "\nOtherwise, answer the question and provide a quote or summarization from the context to support your answer.\n"
+        prompts.append((prompt, min(len(tokens), 3000) + 200))
+
+    def summarize(prompt_and_tokens):
+        prompt, prompt_tokens = prompt_and_tokens
+        summary_budget.acquire(prompt_tokens + SUMMARY_MAX_TOKENS)
+        return ask_gpt(None, prompt, max_tokens=SUMMARY_MAX_TOKENS)
+
+    with ThreadPoolExecutor(max_workers=SUMMARY_CONCURRENCY) as executor:
+        answers = list(executor.map(summarize, prompts))
+
     permalinks = []
     timestamps = []
-    for context in contexts:
-
-        context_string = json.dumps(context)
-        
-        # Get the token length of the string
-        enc = tiktoken.get_encoding("gpt2")
-        tokens = enc.encode(context_string)
-        token_count = len(tokens)
-        # print the length of the string in characters and tokens
-        #print("String length: " + str(len(results_string)) + " characters, "Token count: " + str(token_count))
-        print(f"String length: {len(context_string)} characters, Token count: {token_count}")
-
-        # If the token count is greater than 3000, remove the last 1000 characters until the token count is less than 3000
-        while token_count > 3000:
-            context_string = context_string[:-1000]
-            tokens = enc.encode(context_string)
-            token_count = len(tokens)
-            print(f"String length: {len(context_string)} characters, Token count: {token_count}")
-
-
-        # Get the index of the current context in the dataframe
-        index = df[df['contexts'] == context].index[0]
-
-        # Print the timestamp
+    for index, answer in zip(rows, answers):
         # Get the unix time from the ts field of the corresponding results object and convert it to a datetime object
-        print(df.loc[index, 'results']['ts'])
-        timestamp = datetime.datetime.utcfromtimestamp(float(df.loc[index, 'results']['ts']))
-        
-        
+        result = df.at[index, 'results']
+        timestamp = datetime.datetime.utcfromtimestamp(float(result['ts']))
         print(timestamp)
         timestamps.append(timestamp)
-
-        prompt = "Given the following context:\n" + context_string + \
-            "\nIf the context is not relevant to the question, reply with 'This may be related, but I'm not sure whether it answers your question.'\n" +\
-            "Question: " + query + "\nOtherwise, answer the question and provide a quote or summarization from the context to support your answer.\n"
-        #print(prompt)
-        #return
-        answer = ask_gpt(context_string, prompt)
-        
         print(answer)
-        answers.append(answer)
-        #print(json.dumps(df["results"]))
-        #print(context_string)    
-
         # Get the value of the "permalink" key for the corresponding results object
-        permalink = df.loc[index, 'results']['permalink']
-        
-
-        # Print the permalink
-        print(permalink)
-        permalinks.append(permalink)
-
-    return answers, permalinks, timestamps
-        
-    # Get GPT-3 to choose the best of its previous answers
-    prompt = "Given the following" + str(n) + " answers to the question '" + query + "':\n" + \
-        "\n".join([f"{i+1}. {answers[i]} ({timestamps[i]})" for i in range(n)]) + "\n" + \
-        "which answer is the most recent, most relevant to the question, and/or most consistent with the overall context?\n" + \
-        "Please provide a quote or summarization from the context to support your answer."
-    print(prompt)
-    answer = ask_gpt(context_string, prompt)
-    print(answer)
+        print(result['permalink'])
+        permalinks.append(result['permalink'])
+
+    if len(answers) > 1:
+        # Get GPT to choose the best of its previous answers, printing the choice as it arrives
+        prompt = "Given the following " + str(len(answers)) + " answers to the question '" + query + "':\n" + \
+            "\n".join([f"{i+1}. {answers[i]} ({timestamps[i]})" for i in range(len(answers))]) + "\n" + \
+            "which answer is the most recent, most relevant to the question, and/or most consistent with the overall context?\n" + \
+            "Please provide a quote or summarization from the context to support your answer."
+        print(prompt)
+        chunks = []
+        for text in ask_gpt(None, prompt, stream=True):
+            print(text, end="", flush=True)
+            chunks.append(text)
+        print()
+        best_answer = "".join(chunks)
+    else:
+        best_answer = answers[0] if answers else None
+
+    return answers, permalinks, timestamps, best_answer
 
 
 def search(query, userclient, channels, num_results):
+    # Try the local index with the query as it is first; only fall back to Slack search if it has nothing
+    if LOCAL_SEARCH_STORES:
+        matches = search_local(query, userclient, channels, num_results)
+        if matches:
+            print(f"Found {len(matches)} results in the local index for query: {query}.")
+            return [query], [matches]
     search_terms_tried = []
     results = []
     max_tries = 5
     # As long as there are no results, keep trying to search until we have tried max_tries times
     search_tries = 0
-    while len(results) == 0 or results[len(results)-1] == [] and search_tries < max_tries:
+    while len(results) == 0 and search_tries < max_tries:
         # Call the get_search_terms function to get the search terms
         if len(search_terms_tried) > 0:
             print ("No results found. Trying again with more general search terms.")
@@ -222,60 +228,65 @@ def search(query, userclient, channels, num_results):
         else:
             search_terms = get_search_terms(query)
         print(search_terms)
-        # if search_terms has multiple lines that contain search text, search for each line
+        # if search_terms has multiple lines that contain search text, search for all of them at once
+        terms = list(dict.fromkeys(term.strip() for term in search_terms.split('\n') if term.strip()))
+        with ThreadPoolExecutor(max_workers=SEARCH_CONCURRENCY) as executor:
+            term_results = list(executor.map(lambda term: perform_search(term, userclient, num_results) or [], terms))
         number_of_results = 0
-        if search_terms.count('\n') > 0:
-            for term in search_terms.split('\n'):
-                if term:
-                    result = perform_search(term, userclient, num_results)
-                    results.append(result)
-                    # Calculate the total number of results across all result fields in results
-                    number_of_results += len(result)
-
-                    print(f"Found {len(result)} results for {term}, for a total of {number_of_results} results so far.")
-        else:
-            messages = perform_search(search_terms, userclient, num_results)
-            results.append(messages)
+        for term, result in zip(terms, term_results):
+            number_of_results += len(result)
+            print(f"Found {len(result)} results for {term}, for a total of {number_of_results} results so far.")
+        results = merge_results(term_results)
+        print(f"{len(results)} distinct results across {len(terms)} search terms.")
 
-        #print(results[0])
-        
         search_terms_tried.append(search_terms)
         search_tries += 1
         print(search_terms_tried)
-    return search_terms_tried, results
-
-def get_message_context(messages, channels, userclient):
-    # Create a list to store the messages' context
-    messages_context = []
-    # Iterate over the messages
-    for message in messages:
-        # Look up the message channel in the channels list
-        #channel = next((channel for channel in channels if channel["id"] == message["channel"]["id"]), None)
-        channel = message["channel"]
-        if channel is None:
-            print(".", end="")
+    return search_terms_tried, [results]
+
+def merge_results(term_results):
+    """Interleave each search term's matches by rank, keeping the first of any message found by several terms."""
+    merged = {}
+    for rank in range(max((len(result) for result in term_results), default=0)):
+        for result in term_results:
+            if rank < len(result):
+                message = result[rank]
+                merged.setdefault((message["channel"]["id"], message["ts"]), message)
+    return list(merged.values())
+
+def search_local(query, userclient, channels, num_results):
+    """Matches from LOCAL_SEARCH_STORES, shaped like search.messages matches so the rest of the script can use them."""
+    embedding = embed_texts(client, [query], EMBEDDING_MODEL, embedding_cache)[0]
+    store_hits = []
+    for path in LOCAL_SEARCH_STORES:
+        store = EmbeddingStore(path)
+        top, scores = search_rows(store, query, embedding, num_results)
+        store_hits.append(list(zip(scores.tolist(), store.records(top))))
+    # Stores with and without a keyword index score on different scales, so rank them together by rank alone
+    hits = merge_ranked(store_hits)
+    query_terms = set(tokenize(query))
+    matches = []
+    for _, record in hits[:num_results]:
+        # Export records name their channel in the source (channel/window); live index records carry its ID
+        channel_key = record.get("channel") or record["source"].split("/")[0]
+        channel = next((c for c in channels if channel_key in (c["id"], c["name"])), None)
+        if channel is None or channel.get("is_private"):
             continue
-        # Print the channel name and message text
-        #print(message)
-        #print("#" + channel["name"], message["text"])
-        #print(f"#{channel['name']} {message['text']}")
-
-        # Retrieve all other messages in the channel up to 1 hour before and 24h after the current message
-        date = int(message["ts"].split(".")[0])
-        #print(message["ts"])
-        lookback = 3600 # 1 hour in seconds
-        lookahead = 86400 # 24 hours in seconds
-        response = userclient.conversations_history(channel=channel["id"], oldest=date-lookback, latest=date+lookahead)
-        # append the messages to the messages_context list
-        messages_context.append(response["messages"])
-        #messages_context = response["messages"]
-        #print(messages_context)
-        # Print the messages in the channel on the same date
-        #for message in messages_context:
-            #print(message["text"])
-        
+        # Point at the message in the window that shares the most terms with the query
+        message = max(record["messages"], key=lambda m: len(query_terms.intersection(tokenize(m.get("text", "")))))
+        try:
+            permalink = userclient.chat_getPermalink(channel=channel["id"], message_ts=message["ts"])["permalink"]
+        except SlackApiError as e:
+            print("Error: {}".format(e))
+            continue
+        matches.append({"channel": {"id": channel["id"], "name": channel["name"], "is_private": False},
+                        "ts": message["ts"], "user": message.get("user"), "text": message.get("text", ""),
+                        "permalink": permalink})
+    return matches
 
-    return messages_context
+def get_message_context(messages, channels, userclient):
+    # Retrieve all other messages in each message's channel up to 1 hour before and 24h after it
+    return HistoryFetcher(userclient, history_cache).contexts(messages)
 
 def slack_api_setup():
     # Set the SLACK_APP_TOKEN and SLACK_BOT_TOKEN environment variables
@@ -327,35 +338,40 @@ def get_search_terms(query, previous_search_terms=None):
     else:
         return query
 
-def ask_chatgpt(question, prompt, temperature=0):
-    llm = OpenAIChat(temperature=temperature)
+def ask_chatgpt(question, prompt, model="gpt-3.5-turbo", temperature=0):
     print(prompt)
     print(question)
-    prompt = PromptTemplate(template=prompt, input_variables=["question"])
-    llm_chain = LLMChain(prompt=prompt, llm=llm)
-    
-    output = llm_chain.run(question)
-    return output
-
-
-def ask_gpt(text, prompt, model="gpt-4-1106-preview", max_tokens=3000, temperature=0):
-    # Get the API key from the environment variable
-    api_key = os.environ["OPENAI_API_KEY"]
-
-    # Set the max token count for the summary
-    if model == "gpt-4-1106-preview":
-        max_tokens = 10000
-    else:
-        max_tokens = 5000
-    
-    llm = OpenAI(model_name=model, temperature=temperature, max_tokens=max_tokens)
-
-    output = llm(prompt)
-
-    return output
+    response = client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt.replace("{question}", question)}],
+        temperature=temperature)
+    return response.choices[0].message.content
+
+
+def ask_gpt(text, prompt, model=ANSWER_MODEL, max_tokens=3000, temperature=0, stream=False):
+    """The model's answer to the prompt, or with stream=True, a generator of the answer's text as it arrives."""
+    response = client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=max_tokens,
+        temperature=temperature,
+        stream=stream)
+    if not stream:
+        return response.choices[0].message.content
+    return (chunk.choices[0].delta.content for chunk in response if chunk.choices and chunk.choices[0].delta.content)
+
+
+def get_user_id(userclient):
+    """The user ID the client's token belongs to, looked up once per process even when searches run concurrently."""
+    with user_ids_lock:
+        if userclient not in user_ids:
+            user_ids[userclient] = userclient.auth_test()["user_id"]
+        return user_ids[userclient]
 
 
 def perform_search(query, userclient, num_results):
+    if (query, num_results) in search_cache:
+        return search_cache[(query, num_results)]
     # Search for messages containing the query
     try:
         # Call the search.messages method using the WebClient
@@ -380,13 +396,13 @@ def perform_search(query, userclient, num_results):
         print(f"Found {len(messages)} public channel results for query: {query}.")
 
         # Get the bot's user ID
-        bot_info = userclient.auth_test()
-        bot_user_id = bot_info['user_id']
+        bot_user_id = get_user_id(userclient)
         print("The bot's user ID is: ", bot_user_id)
         # Filter out the bot's own messages
         messages = [message for message in messages if message["user"] != bot_user_id]
         print(f"Found {len(messages)} public channel results with the bot excluded, for query: {query}.")
 
+        search_cache[(query, num_results)] = messages
         return messages
         #print(messages)
         #for message in messages:
@@ -0,0 +1,344 @@
+"""
+Exact search over an embedding store split into shards, scored on every core, for exports too big for one
+matrix-vector product on one core.
+
+A sharded store is a directory holding:
+    shards.json     header: format version, dimension, dtype, model, how it was split, and each shard's name,
+                    channel, first and last message time and row count
+    shards/<name>/  each shard, an embedding store of its own (see embedding_store.py), plus
+        norms.npy   the inverse norm of each row, so searches don't have to compute them
+        times.npy   the first and last message time of each row, for date filters
+        channels.npy  for shards that mix channels (by month), each row's channel as an index into the shard's
+                    "channels" list in shards.json, for channel filters
+It is built from a store (e.g. the one pipeline.py keeps) with one shard per channel, per month, or per channel and
+month, leaving out deleted rows; rebuild it to pick up rows added to the store since.
+
+A search first prunes the shards a channel or date filter rules out, then scores the rest in a process pool.  The
+shards are memory-mapped, so every worker reads the same pages from the OS page cache rather than its own copy, and
+the normalized queries are put in shared memory once instead of being pickled for each shard.  Each worker scores
+its shard a block of rows at a time and returns each query's top k; the per-shard lists, already sorted, are merged
+with a heap.  Queries are scored in batches: one pass over the shards answers all of them.  Scores are exact cosine
+similarities, the same as VectorIndex over the whole store (see vector_search.py).
+
+Usage:
+    python sharded_store.py build store/ sharded/ [--by channel|month|channel-month]
+    python sharded_store.py search sharded/ "question" ["another question" ...] [-k 10] [--channel general]
+        [--after 2023-01-01] [--before 2023-07-01] [--workers N]
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from embedding_store import EmbeddingStore
+from vector_search import normalize_rows, top_k
+
+SHARDS_FILE = 'shards.json'
+SHARDS_DIR = 'shards'
+NORMS_FILE = 'norms.npy'
+TIMES_FILE = 'times.npy'
+CHANNELS_FILE = 'channels.npy'
+FORMAT_VERSION = 1
+
+
+def record_channel(record):
+    # Export records name their channel in the source (channel/window); live index records carry its ID
+    return record.get('channel') or record['source'].split('/')[0]
+
+
+def record_times(record):
+    """The first and last message time of a record, or NaN if its messages have no timestamps."""
+    times = [float(message['ts']) for message in record.get('messages', []) if 'ts' in message]
+    return (min(times), max(times)) if times else (np.nan, np.nan)
+
+
+def shard_key(by, channel, first):
+    month = datetime.fromtimestamp(first, timezone.utc).strftime('%Y-%m') if first == first else 'undated'
+    return {'channel': channel, 'month': month, 'channel-month': f'{channel}.{month}'}[by]
+
+
+def parse_date(date):
+    """Unix time of the start of a YYYY-MM-DD day (UTC), or None."""
+    return datetime.strptime(date, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp() if date else None
+
+
+class ShardedStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, SHARDS_FILE)) as header_f:
+            self.header = json.load(header_f)
+        if self.header['version'] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported sharded store version {self.header['version']} in {path}")
+        self.dim = self.header['dim']
+        self.shards = self.header['shards']
+        self._stores = {}
+
+    def __len__(self):
+        return sum(shard['count'] for shard in self.shards)
+
+    @staticmethod
+    def is_sharded(path):
+        return os.path.exists(os.path.join(path, SHARDS_FILE))
+
+    def shard_path(self, name):
+        return os.path.join(self.path, SHARDS_DIR, name)
+
+    def store(self, name):
+        if name not in self._stores:
+            self._stores[name] = EmbeddingStore(self.shard_path(name))
+        return self._stores[name]
+
+    def select(self, channels=None, after=None, before=None):
+        """The shards that can hold rows in the given channels and with messages from after up to before."""
+        selected = []
+        for shard in self.shards:
+            if channels and shard['channel'] is not None and shard['channel'] not in channels:
+                continue
+            if channels and shard['channel'] is None:
+                if 'channels' not in shard:
+                    raise ValueError(f"Shard {shard['name']} of {self.path} has no per-row channels to filter on; "
+                                     f"rebuild the sharded store to search it by channel")
+                if not set(channels) & set(shard['channels']):
+                    continue
+            # Shards without message times can't be ruled out by date
+            if after is not None and shard['last'] is not None and shard['last'] < after:
+                continue
+            if before is not None and shard['first'] is not None and shard['first'] >= before:
+                continue
+            selected.append(shard)
+        return selected
+
+    def records(self, results):
+        """Records for (score, shard name, row) results, in the same order."""
+        return [self.store(name).record(row) for _, name, row in results]
+
+    def embeddings(self, results):
+        return np.array([self.store(name).embeddings[row] for _, name, row in results], dtype=np.float32)
+
+    @classmethod
+    def build(cls, source, path, by='channel', block_rows=10000):
+        """Split the live rows of an embedding store into shards at path, replacing any shards already there."""
+        shutil.rmtree(os.path.join(path, SHARDS_DIR), ignore_errors=True)
+        os.makedirs(os.path.join(path, SHARDS_DIR))
+        # name -> (shard store, its channel or None, [(first, last) message time of each row], [channel of each row])
+        shards = {}
+        deleted = source.deleted if source.deleted_count else None
+        for start in range(0, len(source), block_rows):
+            rows = np.arange(start, min(start + block_rows, len(source)))
+            if deleted is not None:
+                rows = rows[~deleted[rows]]
+            groups = {}
+            for row, record in zip(rows.tolist(), source.records(rows)):
+                channel = record_channel(record)
+                first, last = record_times(record)
+                name = shard_key(by, channel, first)
+                if name not in shards:
+                    store = EmbeddingStore.create(os.path.join(path, SHARDS_DIR, name), source.dim, source.dtype,
+                                                  source.header.get('model'))
+                    shards[name] = (store, channel if by != 'month' else None, [], [])
+                groups.setdefault(name, []).append((row, record))
+                shards[name][2].append((first, last))
+                shards[name][3].append(channel)
+            # Rows are appended a block at a time, so a shard's rows keep the store's order
+            for name, members in groups.items():
+                shards[name][0].append(source.embeddings[[row for row, _ in members]], [record for _, record in members])
+        entries = []
+        for name, (store, channel, times, row_channels) in sorted(shards.items()):
+            inverse_norms = np.empty(len(store), dtype=np.float32)
+            for start in range(0, len(store), block_rows):
+                block = np.asarray(store.embeddings[start:start + block_rows], dtype=np.float32)
+                inverse_norms[start:start + len(block)] = 1 / np.maximum(np.linalg.norm(block, axis=1), 1e-12)
+            np.save(os.path.join(store.path, NORMS_FILE), inverse_norms)
+            shard_times = np.array(times, dtype=np.float64).reshape(-1, 2)
+            np.save(os.path.join(store.path, TIMES_FILE), shard_times)
+            dated = shard_times[~np.isnan(shard_times[:, 0])]
+            entry = {'name': name, 'channel': channel, 'count': len(store),
+                     'first': float(dated[:, 0].min()) if len(dated) else None,
+                     'last': float(dated[:, 1].max()) if len(dated) else None}
+            if channel is None:
+                # A month's shard holds every channel, so channel filters have to be applied row by row
+                names, codes = np.unique(np.array(row_channels, dtype=str), return_inverse=True)
+                entry['channels'] = names.tolist()
+                np.save(os.path.join(store.path, CHANNELS_FILE), codes.astype(np.uint32))
+            entries.append(entry)
+        header = {'version': FORMAT_VERSION, 'dim': source.dim, 'dtype': source.dtype.name,
+                  'model': source.header.get('model'), 'by': by, 'source': os.path.abspath(source.path),
+                  'built': int(time.time()), 'shards': entries}
+        with open(os.path.join(path, SHARDS_FILE + '.tmp'), 'w') as header_f:
+            json.dump(header, header_f, indent=4)
+        os.replace(os.path.join(path, SHARDS_FILE + '.tmp'), os.path.join(path, SHARDS_FILE))
+        return cls(path)
+
+
+# Shards opened by this process (a pool worker, or the searching process itself): path -> (store, norms, times)
+_open_shards = {}
+
+
+def _open_shard(path):
+    if path not in _open_shards:
+        store = EmbeddingStore(path)
+        channels_path = os.path.join(path, CHANNELS_FILE)
+        _open_shards[path] = (store, np.load(os.path.join(path, NORMS_FILE), mmap_mode='r'),
+                              np.load(os.path.join(path, TIMES_FILE), mmap_mode='r'),
+                              np.load(channels_path, mmap_mode='r') if os.path.exists(channels_path) else None)
+    return _open_shards[path]
+
+
+def search_shard(path, shm_name, shape, k, after=None, before=None, block_rows=65536, channel_codes=None):
+    """Each query's top k rows of one shard as (row indices, scores); runs in a worker process.
+
+    The normalized queries are read from the shared memory block shm_name.  With channel_codes, only rows whose
+    entry in the shard's channels.npy is one of them are searched."""
+    store, inverse_norms, times, row_channels = _open_shard(path)
+    excluded = store.deleted.copy() if store.deleted_count else None
+    if channel_codes is not None:
+        outside = ~np.isin(row_channels, channel_codes)
+        excluded = outside if excluded is None else excluded | outside
+    if after is not None or before is not None:
+        # Rows whose messages all fall outside the range; undated rows are left out too
+        outside = np.isnan(times[:, 0])
+        if after is not None:
+            outside |= times[:, 1] < after
+        if before is not None:
+            outside |= times[:, 0] >= before
+        excluded = outside if excluded is None else excluded | outside
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        queries = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        candidates = [[] for _ in range(shape[0])]
+        for start in range(0, len(store), block_rows):
+            block = np.asarray(store.embeddings[start:start + block_rows], dtype=np.float32)
+            scores = block @ queries.T * inverse_norms[start:start + len(block), None]
+            if excluded is not None:
+                scores[excluded[start:start + len(block)]] = -np.inf
+            for q in range(shape[0]):
+                candidates[q].append(top_k(scores[:, q], k, offset=start))
+        del queries
+    finally:
+        shm.close()
+    results = []
+    for query_candidates in candidates:
+        indices = np.concatenate([c[0] for c in query_candidates]) if query_candidates else np.zeros(0, dtype=np.int64)
+        scores = np.concatenate([c[1] for c in query_candidates]) if query_candidates else np.zeros(0, dtype=np.float32)
+        best = np.lexsort((indices, -scores))[:k]
+        best = best[np.isfinite(scores[best])]
+        results.append((indices[best], scores[best]))
+    return results
+
+
+def _channel_codes(shard, channels):
+    """Indices of the filtered channels in a mixed shard's channel list, or None if the shard needs no row filter."""
+    if not channels or shard['channel'] is not None:
+        return None
+    return [i for i, channel in enumerate(shard['channels']) if channel in channels]
+
+
+class ShardedSearch:
+    """Exact top-k search over a sharded store, one shard per task in a pool of `workers` processes."""
+
+    def __init__(self, path, workers=None, block_rows=65536):
+        self.store = ShardedStore(path)
+        self.workers = workers or os.cpu_count()
+        self.block_rows = block_rows
+        self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def search_batch(self, queries, k, channels=None, after=None, before=None):
+        """[(score, shard name, row), ...] of the top k rows for each query, best first."""
+        queries = normalize_rows(np.atleast_2d(queries))
+        shards = self.store.select(channels, after, before)
+        # Largest shards first, so the pool isn't left waiting on a big one started last
+        shards.sort(key=lambda shard: -shard['count'])
+        shm = shared_memory.SharedMemory(create=True, size=max(queries.nbytes, 1))
+        try:
+            np.ndarray(queries.shape, dtype=np.float32, buffer=shm.buf)[:] = queries
+            args = [(self.store.shard_path(shard['name']), shm.name, queries.shape, k, after, before, self.block_rows,
+                     _channel_codes(shard, channels)) for shard in shards]
+            if self.workers > 1 and len(shards) > 1:
+                if self.executor is None:
+                    self.executor = ProcessPoolExecutor(max_workers=self.workers)
+                per_shard = [future.result() for future in [self.executor.submit(search_shard, *a) for a in args]]
+            else:
+                per_shard = [search_shard(*a) for a in args]
+        finally:
+            shm.close()
+            shm.unlink()
+        results = []
+        for q in range(len(queries)):
+            # Each shard's list is sorted best first, so a heap merge of them yields the overall best first
+            lists = [list(zip(found[q][1].tolist(), itertools.repeat(shard['name']), found[q][0].tolist()))
+                     for shard, found in zip(shards, per_shard)]
+            results.append(list(itertools.islice(heapq.merge(*lists, key=lambda result: -result[0]), k)))
+        return results
+
+    def search(self, query, k, channels=None, after=None, before=None):
+        return self.search_batch(query, k, channels, after, before)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or search a sharded embedding store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='Split an embedding store into shards')
+    build.add_argument('store')
+    build.add_argument('output')
+    build.add_argument('--by', choices=['channel', 'month', 'channel-month'], default='channel')
+    search = subparsers.add_parser('search', help='Print the best matches for one or more queries')
+    search.add_argument('sharded')
+    search.add_argument('queries', nargs='+')
+    search.add_argument('-k', type=int, default=10, help='Results per query')
+    search.add_argument('--channel', action='append', help='Only search this channel (may be repeated)')
+    search.add_argument('--after', help='Only rows with messages on or after this date (YYYY-MM-DD)')
+    search.add_argument('--before', help='Only rows with messages before this date (YYYY-MM-DD)')
+    search.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes scoring shards')
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    if args.command == 'build':
+        sharded = ShardedStore.build(EmbeddingStore(args.store), args.output, args.by)
+        print(f'Split {len(sharded)} rows into {len(sharded.shards)} shards by {args.by} '
+              f'({time.monotonic() - started:.1f}s)')
+        return
+
+    from openai import OpenAI
+    from embedding_cache import embed_texts, open_cache
+
+    sharded = ShardedStore(args.sharded)
+    cache = open_cache()
+    embeddings = embed_texts(OpenAI(), args.queries, sharded.header['model'] or 'text-embedding-ada-002', cache)
+    after, before = parse_date(args.after), parse_date(args.before)
+    selected = sharded.select(args.channel, after, before)
+    with ShardedSearch(args.sharded, args.workers) as searcher:
+        started = time.monotonic()
+        results = searcher.search_batch(np.stack(embeddings), args.k, args.channel, after, before)
+        elapsed = time.monotonic() - started
+    print(f'Searched {sum(shard["count"] for shard in selected)} rows in {len(selected)} of {len(sharded.shards)} '
+          f'shards for {len(args.queries)} queries in {elapsed:.3f}s')
+    for query, query_results in zip(args.queries, results):
+        print(query)
+        for (score, name, row), record in zip(query_results, sharded.records(query_results)):
+            print(f'    {score:.4f} {record.get("source", f"{name}/{row}")}')
+    if cache:
+        cache.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""
+Channel history around search hits, for search_with_slack_api.py.
+
+Each search hit is shown to the model with the messages from an hour before it to a day after it.  Fetching that
+window with one conversations.history call per hit fetches the same history over and over when hits are close in
+time, and silently stops at the first page.  HistoryFetcher instead:
+    - merges the hits' windows into the fewest ranges per channel that cover them all
+    - serves windows that a cached range already covers from the cache
+    - fetches the remaining ranges `concurrency` at a time, every page of them, within `requests_per_minute`
+      (conversations.history is a tier 3 method, about 50 requests a minute), waiting out 429 responses
+    - cuts each hit's own window back out of the merged ranges, so callers still get one list of messages per hit
+
+Fetched ranges are cached in SQLite at $SLACK_HISTORY_CACHE (default ~/.cache/slackaskbot/history.sqlite; set it
+to off to disable the cache), so asking the same or a related question again makes no history calls.  A range that
+ended before it was fetched is kept for `max_age_days`; one that reached past the time it was fetched may have
+gained messages since, so it is only used for `open_ttl` seconds.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from slack_sdk.errors import SlackApiError
+
+from embedding_engine import RateBudget
+
+DEFAULT_PATH = os.path.join('~', '.cache', 'slackaskbot', 'history.sqlite')
+LOOKBACK = 3600  # 1 hour in seconds
+LOOKAHEAD = 86400  # 24 hours in seconds
+
+
+def message_window(message, lookback=LOOKBACK, lookahead=LOOKAHEAD):
+    """The (oldest, latest) unix times of the history shown around a search hit."""
+    date = int(message['ts'].split('.')[0])
+    return date - lookback, date + lookahead
+
+
+def merge_windows(windows):
+    """Merge (channel, oldest, latest) windows into {channel: [(oldest, latest), ...]} of non-overlapping ranges."""
+    by_channel = {}
+    for channel, oldest, latest in windows:
+        by_channel.setdefault(channel, []).append((oldest, latest))
+    merged = {}
+    for channel, ranges in by_channel.items():
+        ranges.sort()
+        merged[channel] = [ranges[0]]
+        for oldest, latest in ranges[1:]:
+            last_oldest, last_latest = merged[channel][-1]
+            if oldest <= last_latest:
+                merged[channel][-1] = (last_oldest, max(last_latest, latest))
+            else:
+                merged[channel].append((oldest, latest))
+    return merged
+
+
+def in_window(messages, oldest, latest):
+    """The messages strictly between oldest and latest, as conversations.history returns them by default."""
+    return [message for message in messages if oldest < float(message['ts']) < latest]
+
+
+class HistoryCache:
+    def __init__(self, path=DEFAULT_PATH, open_ttl=300, max_age_days=7):
+        self.path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Written from the fetcher's threads, so share one connection under a lock
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS ranges (channel TEXT NOT NULL, oldest REAL NOT NULL, '
+                        'latest REAL NOT NULL, fetched INTEGER NOT NULL, messages TEXT NOT NULL, '
+                        'PRIMARY KEY (channel, oldest, latest))')
+        self.lock = threading.Lock()
+        self.open_ttl = open_ttl
+        self.max_age_days = max_age_days
+
+    def get(self, channel, oldest, latest):
+        """The messages in the window from a cached range covering it, or None if no usable range does."""
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT messages FROM ranges WHERE channel = ? AND oldest <= ? AND latest >= ? '
+                                  'AND fetched >= ? AND (latest < fetched OR fetched >= ?) ORDER BY latest - oldest '
+                                  'LIMIT 1', (channel, oldest, latest, now - self.max_age_days * 86400,
+                                              now - self.open_ttl)).fetchone()
+        if row is None:
+            return None
+        return in_window(json.loads(row[0]), oldest, latest)
+
+    def put(self, channel, oldest, latest, messages):
+        now = int(time.time())
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO ranges VALUES (?, ?, ?, ?, ?)',
+                            (channel, oldest, latest, now, json.dumps(messages)))
+            self.db.execute('DELETE FROM ranges WHERE fetched < ?', (now - self.max_age_days * 86400,))
+
+    def close(self):
+        self.db.close()
+
+
+def open_history_cache(path=None):
+    """The cache at path or $SLACK_HISTORY_CACHE, or None if SLACK_HISTORY_CACHE is off."""
+    path = path or os.environ.get('SLACK_HISTORY_CACHE', DEFAULT_PATH)
+    if path.lower() in ('off', 'none', '0', ''):
+        return None
+    return HistoryCache(path)
+
+
+class HistoryFetcher:
+    """Fetches the history around many search hits with as few conversations.history calls as it can."""
+
+    def __init__(self, userclient, cache=None, concurrency=4, requests_per_minute=50, page_size=200, max_retries=5):
+        self.userclient = userclient
+        self.cache = cache
+        self.concurrency = concurrency
+        # conversations.history is limited by requests alone, so the budget's token side is never drawn on
+        self.budget = RateBudget(requests_per_minute, 1)
+        self.page_size = page_size
+        self.max_retries = max_retries
+        # The counters are updated from the fetch threads, and contexts() may itself be called from several threads
+        self.stats_lock = threading.Lock()
+        self.windows = 0
+        self.cache_hits = 0
+        self.ranges = 0
+        self.requests = 0
+
+    def history(self, channel, oldest, latest):
+        """Every message in the channel between oldest and latest, newest first, following the pagination cursor."""
+        messages = []
+        cursor = None
+        while True:
+            response = self._call(channel=channel, oldest=oldest, latest=latest, limit=self.page_size, cursor=cursor)
+            messages += response['messages']
+            cursor = (response.get('response_metadata') or {}).get('next_cursor')
+            if not response.get('has_more') or not cursor:
+                return messages
+
+    def _call(self, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            self.budget.acquire(0)
+            with self.stats_lock:
+                self.requests += 1
+            try:
+                return self.userclient.conversations_history(**kwargs)
+            except SlackApiError as e:
+                if e.response.status_code != 429 or attempt == self.max_retries:
+                    raise
+                delay = int(e.response.headers.get('Retry-After', 1))
+                print(f"conversations.history is rate limited; retrying in {delay}s")
+                time.sleep(delay)
+
+    def _fetch(self, channel, oldest, latest):
+        messages = self.history(channel, oldest, latest)
+        if self.cache:
+            self.cache.put(channel, oldest, latest, messages)
+        return messages
+
+    def contexts(self, messages, lookback=LOOKBACK, lookahead=LOOKAHEAD):
+        """For each search hit, in order, the messages in its channel from lookback before it to lookahead after it.
+
+        Hits without a channel, or whose history couldn't be fetched, get an empty list."""
+        windows = [(message['channel']['id'],) + message_window(message, lookback, lookahead)
+                   if message.get('channel') else None for message in messages]
+        results = [[] for _ in windows]
+        missing = []
+        cache_hits = 0
+        for i, window in enumerate(windows):
+            cached = self.cache.get(*window) if self.cache and window else None
+            if cached is not None:
+                results[i] = cached
+                cache_hits += 1
+            elif window:
+                missing.append(i)
+        ranges = [(channel, oldest, latest)
+                  for channel, channel_ranges in merge_windows(windows[i] for i in missing).items()
+                  for oldest, latest in channel_ranges]
+        with self.stats_lock:
+            self.windows += sum(window is not None for window in windows)
+            self.cache_hits += cache_hits
+            self.ranges += len(ranges)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {key: executor.submit(self._fetch, *key) for key in ranges}
+        fetched = {}
+        for key, future in futures.items():
+            try:
+                fetched[key] = future.result()
+            except SlackApiError as e:
+                print("Error: {}".format(e))
+        for i in missing:
+            channel, oldest, latest = windows[i]
+            for key, history in fetched.items():
+                if key[0] == channel and key[1] <= oldest and latest <= key[2]:
+                    results[i] = in_window(history, oldest, latest)
+                    break
+        return results
+
+    def report(self):
+        with self.stats_lock:
+            return (f"Channel history: {self.windows} windows, {self.cache_hits} from the cache, {self.ranges} ranges "
+                    f"fetched in {self.requests} requests")
@@ -0,0 +1,71 @@
+"""
+Token counting, truncation and chunking shared by the export and search scripts.
+
+Encoders are loaded once per process and per model, using the model's own encoding (cl100k_base for
+text-embedding-ada-002 and the GPT-3.5/GPT-4 chat models) rather than gpt2.  Truncation encodes the text once and
+slices the tokens, instead of repeatedly dropping characters and re-encoding; chunking splits on token
+boundaries, so every chunk is within the limit and nothing is dropped.
+"""
+
+import functools
+
+import tiktoken
+
+DEFAULT_ENCODING = 'cl100k_base'
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoder(model=None):
+    """The tiktoken encoder for a model (cl100k_base if the model is unknown or not given), loaded once."""
+    if model:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            pass
+    return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+def encode(text, model=None):
+    # Message text can contain strings like <|endoftext|>; treat them as ordinary text rather than raising
+    return get_encoder(model).encode(text, disallowed_special=())
+
+
+def count_tokens(text, model=None):
+    return len(encode(text, model))
+
+
+def truncate(text, max_tokens, model=None):
+    """text cut to at most max_tokens tokens (unchanged if it already fits)."""
+    tokens = encode(text, model)
+    if len(tokens) <= max_tokens:
+        return text
+    return get_encoder(model).decode(tokens[:max_tokens])
+
+
+def split_tokens(tokens, max_tokens, overlap=0, balanced=True):
+    """Slices of tokens of at most max_tokens each, consecutive slices sharing `overlap` tokens.
+
+    With balanced=True the slices are made as equal in size as possible rather than leaving a small remainder."""
+    if overlap >= max_tokens:
+        raise ValueError(f'overlap ({overlap}) must be smaller than max_tokens ({max_tokens})')
+    if len(tokens) <= max_tokens:
+        return [tokens]
+    step = max_tokens - overlap
+    num_chunks = -(-(len(tokens) - overlap) // step)
+    if balanced:
+        step = -(-(len(tokens) - overlap) // num_chunks)
+    return [tokens[start:start + step + overlap] for start in range(0, num_chunks * step, step)]
+
+
+def chunk_text(text, max_tokens, overlap=0, model=None, balanced=True):
+    """(chunk text, token count) pairs covering text, each at most max_tokens tokens."""
+    encoder = get_encoder(model)
+    return [(encoder.decode(tokens), len(tokens))
+            for tokens in split_tokens(encode(text, model), max_tokens, overlap, balanced)]
+
+
+def iter_chunks(texts, max_tokens, overlap=0, model=None, balanced=True):
+    """Stream (index of the source text, chunk text, token count) for an iterable of texts, e.g. a file's lines."""
+    for index, text in enumerate(texts):
+        for chunk, token_count in chunk_text(text, max_tokens, overlap, model, balanced):
+            yield index, chunk, token_count
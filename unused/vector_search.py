@@ -0,0 +1,97 @@
+"""
+Vectorized top-k cosine similarity search over an embedding matrix.
+
+VectorIndex keeps the corpus normalized, so a query is scored against every row with one matrix-vector product
+(or one matrix-matrix product for a batch of queries), and the top k come from np.argpartition instead of sorting
+every row.  Corpora that fit in max_memory_bytes are normalized into RAM once; larger ones (e.g. a memory-mapped
+embedding store, see embedding_store.py) stay on disk with only their row norms kept in memory, and are scored a
+block of rows at a time.
+
+Ties are broken by row index, so results are deterministic.
+"""
+
+import numpy as np
+
+
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def top_k(scores, k, offset=0):
+    """Indices (plus offset) and scores of the k highest scores, best first."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=scores.dtype)
+    if k < len(scores):
+        # argpartition picks arbitrarily among scores tied with the k-th, so take all of those and let the sort
+        # below keep the lowest row indices
+        kth = scores[np.argpartition(-scores, k - 1)[k - 1]]
+        candidates = np.flatnonzero(scores >= kth)
+    else:
+        candidates = np.arange(len(scores))
+    order = np.lexsort((candidates, -scores[candidates]))[:k]
+    candidates = candidates[order]
+    return candidates + offset, scores[candidates]
+
+
+class VectorIndex:
+    def __init__(self, embeddings, block_rows=65536, max_memory_bytes=2 << 30):
+        self.block_rows = block_rows
+        self.count, self.dim = embeddings.shape
+        # Spare capacity behind an in-RAM matrix, so add() doesn't copy the whole corpus for every few rows
+        self._buffer = None
+        if self.count * self.dim * 4 <= max_memory_bytes:
+            self.matrix = normalize_rows(embeddings)
+            self.inverse_norms = None
+        else:
+            # Too big to hold normalized in RAM: keep the (possibly memory-mapped) matrix and scale scores instead
+            self.matrix = embeddings
+            self.inverse_norms = np.empty(self.count, dtype=np.float32)
+            for start, block in self._blocks():
+                self.inverse_norms[start:start + len(block)] = 1 / np.maximum(np.linalg.norm(block, axis=1), 1e-12)
+
+    def __len__(self):
+        return self.count
+
+    def add(self, embeddings):
+        """Append rows to an index held in RAM (a disk-backed one is rebuilt over the longer matrix instead)."""
+        if self.inverse_norms is not None:
+            raise ValueError('Only an index held in RAM can be appended to')
+        rows = normalize_rows(np.atleast_2d(embeddings))
+        count = self.count + len(rows)
+        if self._buffer is None or count > len(self._buffer):
+            self._buffer = np.empty((max(count, 2 * self.count), self.dim), dtype=np.float32)
+            self._buffer[:self.count] = self.matrix
+        self._buffer[self.count:count] = rows
+        # Searches running meanwhile see either the old rows or all of them
+        self.matrix = self._buffer[:count]
+        self.count = count
+
+    def _blocks(self):
+        for start in range(0, self.count, self.block_rows):
+            yield start, np.asarray(self.matrix[start:start + self.block_rows], dtype=np.float32)
+
+    def search_batch(self, queries, k):
+        """(indices, scores) of the top k rows for each query."""
+        queries = normalize_rows(np.atleast_2d(queries))
+        if self.inverse_norms is None:
+            scores = self.matrix @ queries.T
+            return [top_k(scores[:, q], k) for q in range(len(queries))]
+        # Keep only each block's top k per query, so memory stays at block_rows x queries
+        candidates = [[] for _ in queries]
+        for start, block in self._blocks():
+            scores = block @ queries.T * self.inverse_norms[start:start + len(block), None]
+            for q in range(len(queries)):
+                candidates[q].append(top_k(scores[:, q], k, offset=start))
+        results = []
+        for query_candidates in candidates:
+            indices = np.concatenate([c[0] for c in query_candidates])
+            scores = np.concatenate([c[1] for c in query_candidates])
+            best = np.lexsort((indices, -scores))[:k]
+            results.append((indices[best], scores[best]))
+        return results
+
+    def search(self, query, k):
+        return self.search_batch(query, k)[0]
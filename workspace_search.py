@@ -0,0 +1,159 @@
+"""
+In-process search over local embedding stores, for slackAskBot.py's built-in search_workspace tool.
+
+The search helper scripts in unused/ start a new Python process for every question, import pandas, numpy and
+tiktoken, and load the whole export before scoring a single row.  WorkspaceSearch opens its stores (exports built
+with unused/pipeline.py, and the live index kept by live_index.py) once and keeps them resident: each store's IVF
+index if it has one (see unused/ann_index.py), otherwise its rows normalized in RAM, or memory-mapped and scored a
+block at a time if they don't fit (see unused/vector_search.py).  A search is then one embedding lookup (usually a
+cache hit for a repeated question) plus a matrix-vector product per store.  Keyword matches from each store's
+BM25 index (see unused/lexical_index.py) are fused with the vector results, so exact terms like error codes and
+hostnames are found even when the embeddings miss them.  Rows the index on disk doesn't cover yet are indexed in
+memory, up to `max_unsaved_rows` of them; a store with more than that unindexed (say, one without a BM25 index)
+is searched on the part the index covers, or by vector alone, rather than tokenizing it all on a search.
+
+Stores that grow while the bot runs, like the live index, are picked up by checking their header before each
+search: new rows are added to the resident index and tombstoned rows are skipped.  A store that doesn't exist yet
+is searched once it does.
+"""
+
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "unused"))
+import numpy as np  # noqa: E402
+
+from ann_index import open_index  # noqa: E402
+from embedding_cache import embed_texts, open_cache  # noqa: E402
+from embedding_store import HEADER_FILE, EmbeddingStore  # noqa: E402
+from lexical_index import LexicalIndex, fuse, merge_ranked, open_lexical, saved_rows  # noqa: E402
+from token_chunker import truncate  # noqa: E402
+from vector_search import VectorIndex  # noqa: E402
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+
+class ResidentStore:
+    """One embedding store and the index searched over it, refreshed when the store's header changes."""
+
+    def __init__(self, path, fusion="rrf", lexical_weight=0.5, candidates=50, max_unsaved_rows=10000):
+        self.path = path
+        self.fusion = fusion
+        self.lexical_weight = lexical_weight
+        self.candidates = candidates
+        self.lock = threading.Lock()
+        self.version = None
+        self.store = None
+        self.index = None
+        self.indexed = 0
+        self.lexical = None
+        self.max_unsaved_rows = max_unsaved_rows
+        self.warned = False
+
+    def refresh(self):
+        with self.lock:
+            self._refresh()
+
+    def _refresh(self):
+        try:
+            stat = os.stat(os.path.join(self.path, HEADER_FILE))
+        except FileNotFoundError:
+            return
+        version = (stat.st_mtime_ns, stat.st_size)
+        if version != self.version:
+            store = EmbeddingStore(self.path)
+            if self.index is None or len(store) < self.indexed:
+                self.index = open_index(store)
+                self.indexed = len(self.index) if self.index is not None else 0
+            if self.indexed < len(store):
+                added = store.embeddings[self.indexed:]
+                if self.index is None:
+                    self.index = VectorIndex(added)
+                elif isinstance(self.index, VectorIndex) and self.index.inverse_norms is None:
+                    self.index.add(added)
+                elif isinstance(self.index, VectorIndex):
+                    self.index = VectorIndex(store.embeddings)
+                else:
+                    # Rows appended since the IVF index was last saved go into its in-memory delta segment
+                    self.index.add(added, np.arange(self.indexed, len(store)))
+                self.indexed = len(store)
+            if self.fusion != "off":
+                self._refresh_lexical(store)
+            self.store = store
+            self.version = version
+
+    def _refresh_lexical(self, store):
+        saved = saved_rows(store)
+        if self.lexical is None or saved > self.lexical.saved_rows or len(store) < len(self.lexical):
+            # The writer (e.g. the live indexer) has saved more rows, so load them rather than growing the in-memory
+            # delta; the rows it held are either in the saved index now or added back below
+            self.lexical = open_lexical(store) if saved else None
+        if len(store) - saved > self.max_unsaved_rows:
+            if not self.warned:
+                print(f"{self.path}: {len(store) - saved} rows have no BM25 index on disk; keyword search leaves them "
+                      f"out (index them with unused/lexical_index.py)")
+                self.warned = True
+            return
+        if self.lexical is None:
+            self.lexical = LexicalIndex.empty()
+        self.lexical.add_rows(store)
+
+    def search(self, query, embedding, n):
+        """(score, record) for the top n live rows: cosine similarity, or the fused score with keyword matches."""
+        # Searches hold the lock too, as adding rows to an index replaces or extends its arrays one at a time
+        with self.lock:
+            self._refresh()
+            store = self.store
+            if store is None or not len(store):
+                return []
+            deleted = store.deleted if store.deleted_count else None
+            candidates = max(n, self.candidates) if self.lexical is not None else n
+            # Ask for enough extra results to still have enough once deleted rows are dropped
+            top, similarities = self.index.search(embedding, min(candidates + store.deleted_count, len(store)))
+            if deleted is not None:
+                live = ~deleted[top]
+                top, similarities = top[live][:candidates], similarities[live][:candidates]
+            if self.lexical is not None:
+                keyword = self.lexical.search(query, candidates, deleted)
+                top, similarities = fuse((top, similarities), keyword, self.fusion, self.lexical_weight)
+        top, similarities = top[:n], similarities[:n]
+        return list(zip(similarities.tolist(), store.records(top)))
+
+
+class WorkspaceSearch:
+    def __init__(self, paths, client, model=EMBEDDING_MODEL, fusion="rrf", lexical_weight=0.5, candidates=50):
+        self.stores = [ResidentStore(path, fusion, lexical_weight, candidates) for path in paths]
+        self.client = client
+        self.model = model
+        # Opened on first use rather than here, so a process forked after this doesn't share the SQLite connection
+        self.cache = None
+        self.cache_lock = threading.Lock()
+
+    def warm(self):
+        """Load every store's index now rather than on the first search."""
+        for store in self.stores:
+            store.refresh()
+
+    def embed(self, text):
+        with self.cache_lock:
+            if self.cache is None:
+                self.cache = open_cache() or False
+        return embed_texts(self.client, [text], self.model, self.cache or None)[0]
+
+    def search(self, query, n=5):
+        """(score, record) for the n best matches across all stores, best first; each score is on its store's scale."""
+        embedding = self.embed(query)
+        # Stores score on different scales (cosine, RRF, min-max scaled), so rank them together by rank alone
+        return merge_ranked([store.search(query, embedding, n) for store in self.stores])[:n]
+
+
+def format_results(results, max_tokens, model=None):
+    """The records' messages as plain text for a prompt, best match first, cut off at max_tokens."""
+    sections = []
+    for _, record in results:
+        lines = [f"From {record.get('source', record.get('channel', 'unknown'))}:"]
+        for message in record["messages"]:
+            lines.append(f"{message.get('user', 'unknown')}: {message.get('text', '')}")
+        sections.append("\n".join(lines))
+    return truncate("\n\n".join(sections), max_tokens, model=model)